@@ -0,0 +1,493 @@
+# coding:utf-8
+'''Optional asyncio front end for the local proxy servers, python 3 only'''
+
+import os
+import io
+import ssl
+import errno
+import socket
+import asyncio
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from . import clogging as logging
+from .compat import httplib, urlparse
+from .common import web_dir, NetWorkIOError
+from .GlobalConfig import GC
+from .FilterUtil import get_action
+from .ForwardUtil import relay_engine
+from .ProxyHandler import block_headers, block_gif
+
+#请求头最大长度
+max_head = 65536
+#直接在事件循环中读取的本地文件最大长度
+max_local_file = 1048576
+#交给线程处理的阻塞请求共用一个有界线程池，每次只占用一个请求的时间
+executor = ThreadPoolExecutor(GC.LISTEN_ASYNCIO_WORKERS)
+
+class RequestHead(object):
+    '''A parsed request line and headers'''
+
+    def __init__(self, data):
+        requestline, _, headers = data.partition(b'\r\n')
+        words = requestline.decode('iso-8859-1').split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            raise ValueError('bad request line: %r' % requestline)
+        self.command, self.path, self.version = words
+        self.headers = httplib.parse_headers(io.BytesIO(headers + b'\r\n'))
+        connection = self.headers.get('Connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+        self.chunked = 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+        self.length = int(self.headers.get('Content-Length') or 0)
+
+def split_host(host):
+    # IPv6 必须使用方括号
+    host, has_br, port = host.partition(']')
+    if has_br:
+        return host[1:], port[1:]
+    host, _, port = host.partition(':')
+    return host, port
+
+class PrefixedSocketIO(io.RawIOBase):
+    '''Read the bytes already received by the event loop before the socket'''
+
+    def __init__(self, prefix, sock):
+        self.prefix = memoryview(prefix)
+        self.raw = socket.SocketIO(sock, 'rb')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.prefix:
+            n = min(len(b), len(self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        return self.raw.readinto(b)
+
+def read_buffered(rfile, sock):
+    '''Return what rfile has read ahead, without blocking'''
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        return rfile.peek(1)
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return b''
+    finally:
+        sock.settimeout(timeout)
+
+class HandoffHandlerMixin(object):
+    '''Handle one request at a time on a socket which the event loop has read from
+
+    A keep-alive connection does not hold the thread while idle. After each
+    request, a plain connection goes back to the loop with the bytes already
+    read ahead. A fake-cert TLS session waits in the loop until it is
+    readable again.
+    '''
+
+    def __init__(self, request, client_address, server, prefix=b''):
+        self.prefix = prefix
+        #请求处理完后交还事件循环：明文连接为预读的数据，加密连接为 True
+        self.park = None
+        super(HandoffHandlerMixin, self).__init__(request, client_address, server)
+
+    def setup(self):
+        super(HandoffHandlerMixin, self).setup()
+        if self.prefix:
+            self.rfile = io.BufferedReader(PrefixedSocketIO(self.prefix, self.connection))
+            #只在第一次使用，伪造证书后重新 setup 时不再需要
+            self.prefix = None
+
+    def handle(self):
+        self.park = None
+        while True:
+            self.close_connection = True
+            self.handle_one_request()
+            if self.close_connection or relay_engine.owns(self.connection):
+                return
+            data = read_buffered(self.rfile, self.connection)
+            if not isinstance(self.connection, ssl.SSLSocket):
+                self.park = data
+                return
+            if not (data or self.connection.pending()):
+                self.park = True
+                return
+
+    def handle_ssl(self, ssl_sock):
+        #加密会话交给事件循环等待下一个请求
+        self.close_connection = False
+
+    def resume(self):
+        '''Handle the next request of a parked TLS session'''
+        self.setup()
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+class ProxyProtocol(asyncio.Protocol):
+    '''Parse requests incrementally, reply simple ones in the loop'''
+
+    def __init__(self, server, prefix=b''):
+        self.server = server
+        #处理器交还连接时已经预读的数据
+        self.buffer = bytearray(prefix)
+        #待丢弃的请求主体长度
+        self.skip = 0
+        self.closing = False
+        self.writing_paused = False
+        self.handoff_pending = False
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')
+        #写缓冲非空时暂停，移交前必须保证已发送完毕
+        transport.set_write_buffer_limits(0)
+        if self.buffer:
+            self.process()
+        self.wait_idle()
+
+    def connection_lost(self, exc):
+        self.cancel_idle()
+
+    def data_received(self, data):
+        self.cancel_idle()
+        self.buffer += data
+        self.process()
+        self.wait_idle()
+
+    def wait_idle(self):
+        #与线程服务器中套接字超时相同，空闲的连接到时关闭
+        timeout = self.server.idle_timeout
+        if timeout and not (self.closing or self.handoff_pending):
+            self.timer = self.server.loop.call_later(timeout, self.idle)
+
+    def cancel_idle(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def idle(self):
+        self.timer = None
+        self.closing = True
+        self.transport.close()
+
+    def eof_received(self):
+        self.closing = True
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.handoff_pending:
+            self.handoff()
+
+    def process(self):
+        buffer = self.buffer
+        while not (self.closing or self.handoff_pending):
+            if self.skip:
+                n = min(self.skip, len(buffer))
+                del buffer[:n]
+                self.skip -= n
+                if self.skip:
+                    return
+            end = buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(buffer) > max_head:
+                    self.reply(b'HTTP/1.1 431\r\nConnection: close\r\n\r\n', False)
+                return
+            try:
+                head = RequestHead(bytes(buffer[:end]))
+            except Exception as e:
+                logging.warning(u'%s 无效的请求：%r', self.address_string(), e)
+                self.reply(b'HTTP/1.1 400\r\nConnection: close\r\n\r\n', False)
+                return
+            response = self.server.dispatch(head, self.address_string())
+            if response is None:
+                #包括请求头一起交给阻塞处理器
+                self.handoff_pending = True
+                self.transport.pause_reading()
+                if not self.writing_paused:
+                    self.handoff()
+                return
+            del buffer[:end+4]
+            self.skip = head.length
+            #分块上传的主体不解析，回应后直接关闭
+            self.reply(response, head.keep_alive and not head.chunked)
+
+    def reply(self, response, keep_alive):
+        self.transport.write(response)
+        if not keep_alive:
+            self.closing = True
+            self.transport.close()
+
+    def handoff(self):
+        self.cancel_idle()
+        transport = self.transport
+        sock = transport.get_extra_info('socket').dup()
+        sock.settimeout(socket.getdefaulttimeout())
+        prefix = bytes(self.buffer)
+        del self.buffer[:]
+        #原套接字由事件循环关闭，复制的套接字仍然保持连接
+        transport.abort()
+        self.server.submit(sock, self.client_address, prefix)
+
+    def address_string(self):
+        return '%s:%s' % self.client_address[:2]
+
+class AsyncProxyServer(object):
+    '''Local Proxy Server on an asyncio event loop'''
+    allow_reuse_address = True
+    request_queue_size = 48
+
+    def __init__(self, server_address, RequestHandlerClass, use_filter=True):
+        self.RequestHandlerClass = type('Handoff' + RequestHandlerClass.__name__, (HandoffHandlerMixin, RequestHandlerClass), {})
+        #为假时所有请求都交给处理器，例如 GAE 代理
+        self.use_filter = use_filter
+        self.socket = socket.socket(socket.AF_INET6 if ':' in server_address[0] else socket.AF_INET)
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.server_address = self.socket.getsockname()
+        self.socket.listen(self.request_queue_size)
+        self.loop = None
+        #等待请求的连接空闲超过这个时间后关闭
+        self.idle_timeout = GC.LINK_KEEPTIME or socket.getdefaulttimeout()
+
+    def serve_forever(self):
+        if self.loop:
+            return
+        self.loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(loop.create_server(lambda: ProxyProtocol(self), sock=self.socket))
+        loop.run_forever()
+
+    def shutdown(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def dispatch(self, head, address):
+        '''Return a response for requests served in the loop, or None to hand off'''
+        if head.command == 'CONNECT':
+            return
+        host = head.headers.get('Host')
+        port = None
+        if host:
+            host, port = split_host(host)
+        url_parts = urlparse.urlsplit(head.path)
+        chost, _ = split_host(url_parts.netloc)
+        host = host or chost
+        if head.path[0] == '/':
+            path = head.path
+            url = urlparse.SplitResult('http', host, url_parts.path, url_parts.query, '').geturl()
+        else:
+            url = urlparse.SplitResult(url_parts.scheme, host, url_parts.path, url_parts.query, '').geturl()
+            path = url[url.find('/', url.find('//')+3):]
+        localhosts = getattr(self.RequestHandlerClass, 'localhosts', ('127.0.0.1', 'localhost'))
+        if host.startswith(localhosts):
+            return self.do_LOCAL(head, url, path, address)
+        if not self.use_filter or url.lower().startswith(self.RequestHandlerClass.CAfile):
+            return
+        action, _ = get_action(url_parts.scheme or 'http', host, path[1:], url)
+        if action == 'do_BLOCK':
+            return self.do_BLOCK(head, url, url_parts, address)
+
+    def do_BLOCK(self, head, url, url_parts, address):
+        logging.warning(u'%s "%s %s" 已经被拦截', address, head.command, url)
+        if url_parts.path.endswith(('.jpg', '.gif', '.jpeg', '.png', '.bmp')):
+            return block_headers + b'Content-Type: image/gif\r\nContent-Length: %d\r\n\r\n' % len(block_gif) + block_gif
+        return block_headers + b'Content-Length: 0\r\n\r\n'
+
+    def do_LOCAL(self, head, url, path, address):
+        filename = os.path.join(web_dir, path[1:])
+        if not os.path.isfile(filename):
+            logging.warning(u'%s "%s %s HTTP/1.1" 404 -，无法找到本地文件：%r', address, head.command, url, filename)
+            return b'HTTP/1.1 404\r\nContent-Type: text/plain\r\nContent-Length: 13\r\n\r\n404 Not Found'
+        if os.path.getsize(filename) > max_local_file:
+            return
+        if filename.endswith('.pac'):
+            content_type = 'text/plain'
+        else:
+            content_type = mimetypes.types_map.get(os.path.splitext(filename)[1], 'application/octet-stream')
+        try:
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+        except Exception as e:
+            logging.warning(u'%s "%s %s HTTP/1.1" 403 -，无法打开本地文件：%r', address, head.command, url, filename)
+            data = ('open %r failed: %r' % (filename, e)).encode()
+            return b'HTTP/1.1 403\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s' % (len(data), data)
+        logging.info('%s "%s %s HTTP/1.1" 200 %d', address, head.command, url, len(data))
+        return b'HTTP/1.1 200\r\nContent-Length: %d\r\nContent-Type: %s\r\n\r\n%s' % (len(data), content_type.encode(), data)
+
+    def submit(self, sock, client_address, prefix):
+        executor.submit(self.finish_request, sock, client_address, prefix)
+
+    def finish_request(self, sock, client_address, prefix):
+        handler = None
+        try:
+            handler = self.RequestHandlerClass(sock, client_address, self, prefix)
+        except Exception as e:
+            self.handle_error(client_address, e)
+        self.done(handler, sock)
+
+    def resume_request(self, handler):
+        try:
+            handler.resume()
+        except Exception as e:
+            handler.park = None
+            self.handle_error(handler.client_address, e)
+        self.done(handler, handler.connection)
+
+    def handle_error(self, client_address, e):
+        if isinstance(e, NetWorkIOError) and e.args[0] in (errno.ECONNABORTED, errno.ECONNRESET, errno.EPIPE):
+            return
+        logging.exception(u'%s:%s 处理请求出错：%r', client_address[0], client_address[1], e)
+
+    def done(self, handler, sock):
+        #加密后原套接字已经分离，使用处理器的连接
+        if handler:
+            sock = handler.connection
+        park = handler and handler.park
+        if park is True:
+            self.loop.call_soon_threadsafe(self.park_ssl, handler)
+        elif park is not None:
+            self.loop.call_soon_threadsafe(self.park_plain, sock, park)
+        #已交给转发引擎的连接由引擎关闭
+        elif not relay_engine.owns(sock):
+            self.close(sock)
+
+    def close(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except Exception:
+            pass
+        sock.close()
+
+    def park_plain(self, sock, prefix):
+        #明文连接重新由事件循环解析请求
+        protocol = ProxyProtocol(self, prefix)
+        self.loop.create_task(self.loop.connect_accepted_socket(lambda: protocol, sock))
+
+    def park_ssl(self, handler):
+        #加密会话可读时再交给线程处理下一个请求
+        fd = handler.connection.fileno()
+        timer = None
+        def readable():
+            if timer:
+                timer.cancel()
+            self.loop.remove_reader(fd)
+            executor.submit(self.resume_request, handler)
+        def idle():
+            self.loop.remove_reader(fd)
+            self.close(handler.connection)
+        self.loop.add_reader(fd, readable)
+        if self.idle_timeout:
+            timer = self.loop.call_later(self.idle_timeout, idle)
+
+def test(clients=32, connections=4000):
+    '''Compare connections per second and p99 latency with the threaded server,
+    then check that idle keep-alive connections do not hold the workers'''
+    import threading
+    from time import time
+    from .compat import thread, BaseHTTPServer, SocketServer
+    from .ProxyServer import LocalProxyServer
+    from .ProxyHandler import AutoProxyHandler
+
+    level = logging.log.level
+    localhosts = AutoProxyHandler.__dict__.get('localhosts')
+    AutoProxyHandler.localhosts = ('127.0.0.1', 'localhost')
+    request = b'GET /gotox-benchmark HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'
+
+    def client(address, n, latencies):
+        for _ in range(n):
+            start = time()
+            sock = socket.create_connection(address)
+            sock.sendall(request)
+            while sock.recv(65536):
+                pass
+            sock.close()
+            latencies.append(time() - start)
+
+    def run(address):
+        latencies = []
+        workers = [threading.Thread(target=client, args=(address, connections // clients, latencies)) for _ in range(clients)]
+        start = time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        cost = time() - start
+        latencies.sort()
+        return len(latencies) / cost, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+    class UpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            #上游明确保持连接时处理器才会保持客户端连接
+            self.send_header('Connection', 'keep-alive')
+            self.end_headers()
+            self.wfile.write(b'ok')
+        def log_message(self, *args):
+            pass
+
+    class UpstreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    def keep_alive(address, upstream):
+        #每个连接完成一个经过处理器的请求后保持空闲
+        request = ('GET http://%s:%d/ HTTP/1.1\r\nHost: %s:%d\r\n\r\n' % (upstream * 2)).encode()
+        sock = socket.create_connection(address)
+        sock.settimeout(10)
+        sock.sendall(request)
+        data = b''
+        while not data.endswith(b'ok'):
+            data += sock.recv(65536)
+        return sock
+
+    try:
+        servers = (('threaded', LocalProxyServer(('127.0.0.1', 0), AutoProxyHandler)),
+                   ('asyncio', AsyncProxyServer(('127.0.0.1', 0), AutoProxyHandler)))
+        for name, server in servers:
+            thread.start_new_thread(server.serve_forever, ())
+            logging.setLevel(logging.ERROR)
+            rate, p50, p99 = run(server.server_address)
+            logging.setLevel(level)
+            logging.info(u'%-8s 并发 %d，%d 个连接：%.0f 连接/秒，p50 %.2fms，p99 %.2fms', name, clients, connections, rate, p50 * 1e3, p99 * 1e3)
+            if name == 'threaded':
+                server.shutdown()
+
+        upstream = UpstreamServer(('127.0.0.2', 0), UpstreamHandler)
+        thread.start_new_thread(upstream.serve_forever, ())
+        logging.setLevel(logging.ERROR)
+        idle = [keep_alive(server.server_address, upstream.server_address) for _ in range(GC.LISTEN_ASYNCIO_WORKERS + 8)]
+        start = time()
+        keep_alive(server.server_address, upstream.server_address).close()
+        logging.setLevel(level)
+        logging.info(u'asyncio  %d 个空闲保持连接后的新请求：%.2fms', len(idle), (time() - start) * 1e3)
+        for sock in idle:
+            sock.close()
+        #交还事件循环的空闲连接到时关闭
+        server.idle_timeout = 0.5
+        sock = keep_alive(server.server_address, upstream.server_address)
+        start = time()
+        closed = not sock.recv(65536)
+        sock.close()
+        logging.info(u'asyncio  空闲保持连接 %.2fs 后关闭：%s', time() - start, closed)
+        upstream.shutdown()
+        server.shutdown()
+    finally:
+        logging.setLevel(level)
+        if localhosts is None:
+            del AutoProxyHandler.localhosts
+        else:
+            AutoProxyHandler.localhosts = localhosts
+
+if __name__ == '__main__':
+    test()
@@ -3,6 +3,7 @@
 
 import os
 import sys
+import ssl
 import threading
 import glob
 import base64
@@ -11,7 +12,9 @@ import random
 import OpenSSL
 from . import clogging as logging
 from time import time
-from .common import cert_dir
+from .compat import Queue, thread
+from .common import cert_dir, LRUCache
+from .GlobalConfig import GC
 crypto = OpenSSL.crypto
 
 ca_vendor = 'GotoX'
@@ -24,7 +27,6 @@ ca_subject = None
 ca_digest = 'sha256'
 sub_keyfile = os.path.join(cert_dir, 'subkey.pem')
 sub_key = None
-sub_lock = threading.Lock()
 sub_serial = 3600*24*365*46
 sub_time = 3600*24*(365*10+10//4-1)
 
@@ -62,17 +64,26 @@ def dump_ca():
         fp.write(crypto.dump_certificate(crypto.FILETYPE_PEM, ca))
         fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, pkey))
 
+def create_key(keytype='rsa'):
+    if keytype == 'ecc':
+        # pyOpenSSL 不能直接生成 EC 密钥
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.asymmetric import ec
+        return crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1(), default_backend()))
+    pkey = crypto.PKey()
+    pkey.generate_key(crypto.TYPE_RSA, 2048)
+    return pkey
+
 def dump_subkey():
     global sub_key
-    sub_key = crypto.PKey()
-    sub_key.generate_key(crypto.TYPE_RSA, 2048)
+    sub_key = create_key(GC.LINK_LOCALCERTKEY)
     with open(sub_keyfile, 'wb') as fp:
         fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, sub_key))
         sub_keystr = crypto.dump_publickey(crypto.FILETYPE_PEM, sub_key)
         fp.write(sub_keystr)
     return sub_keystr
 
-def create_subcert(certfile, commonname, ip=False, sans=[]):
+def create_subcert(certfile, commonname, ip=False, sans=[], pubkey=None, issuer=None, issuer_key=None):
     cert = crypto.X509()
     cert.set_version(2)
     cert.set_serial_number(int((int(time()-sub_serial)+random.random())*100)) #setting the only number
@@ -93,28 +104,128 @@ def create_subcert(certfile, commonname, ip=False, sans=[]):
     #某些认证机制会检查签署时间与当前时间之差
     cert.gmtime_adj_notBefore(-3600)
     cert.gmtime_adj_notAfter(sub_time)
-    cert.set_issuer(ca_subject)
-    cert.set_pubkey(sub_key)
+    cert.set_issuer(issuer or ca_subject)
+    cert.set_pubkey(pubkey or sub_key)
     cert.add_extensions([crypto.X509Extension(b'subjectAltName', True, sans)])
-    cert.sign(ca_key, ca_digest)
+    cert.sign(issuer_key or ca_key, ca_digest)
 
-    with open(certfile, 'wb') as fp:
+    #先写入临时文件，其它线程不会读到不完整的证书
+    tmpfile = '%s.%d.tmp' % (certfile, thread.get_ident())
+    with open(tmpfile, 'wb') as fp:
         fp.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    try:
+        os.rename(tmpfile, certfile)
+    except OSError:
+        # Windows 下其它线程已经写入
+        os.remove(tmpfile)
 
-def get_cert(commonname, ip=False, sans=[]):
-    #if commonname.count('.') >= 2 and [len(x) for x in reversed(commonname.split('.'))] > [2, 4]:
-    #    commonname = '.'+commonname.partition('.')[-1]
+def get_certfile(commonname, ip=False):
     if ip:
-        certfile = os.path.join(ca_certdir, commonname + '.crt')
+        return os.path.join(ca_certdir, commonname + '.crt')
     else:
         rcommonname = '.'.join(reversed(commonname.split('.')))
-        certfile = os.path.join(ca_certdir, rcommonname + '.crt')
-    with sub_lock:
-        if os.path.exists(certfile):
-            return certfile, sub_keyfile
-    create_subcert(certfile, commonname, ip, sans)
+        return os.path.join(ca_certdir, rcommonname + '.crt')
+
+def get_cert(commonname, ip=False, sans=[]):
+    #if commonname.count('.') >= 2 and [len(x) for x in reversed(commonname.split('.'))] > [2, 4]:
+    #    commonname = '.'+commonname.partition('.')[-1]
+    certfile = get_certfile(commonname, ip)
+    if not os.path.exists(certfile):
+        create_subcert(certfile, commonname, ip, sans)
     return certfile, sub_keyfile
 
+class CertFactory(object):
+    '''Mint leaf certificates and their SSLContexts off the request path'''
+
+    workers = 4
+    #启动时预先加载最近使用的证书数量
+    warm_size = 64
+
+    def __init__(self, cache_size=512):
+        self.contexts = LRUCache(cache_size)
+        self.lock = threading.Lock()
+        #正在签发的证书，host -> Event
+        self.minting = {}
+        self.queue = Queue.Queue()
+        self.running = False
+        self.minted = self.loaded = self.hits = self.waits = 0
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        for _ in range(self.workers):
+            thread.start_new_thread(self.worker, ())
+
+    def worker(self):
+        while True:
+            host, ip = self.queue.get()
+            try:
+                self.mint(host, ip)
+            except Exception as e:
+                logging.exception(u'签发证书 %r 失败：%r', host, e)
+            finally:
+                with self.lock:
+                    event = self.minting.pop(host, None)
+                if event:
+                    event.set()
+
+    def mint(self, host, ip):
+        certfile = get_certfile(host, ip)
+        if os.path.exists(certfile):
+            self.loaded += 1
+        else:
+            create_subcert(certfile, host, ip)
+            self.minted += 1
+        ssl_context = ssl.SSLContext(GC.LINK_LOCALSSL)
+        ssl_context.verify_mode = ssl.CERT_NONE
+        ssl_context.load_cert_chain(certfile, sub_keyfile)
+        self.contexts[host] = ssl_context
+
+    def prepare(self, host, ip=False):
+        """Start minting in background, return an Event or None if ready"""
+        if host in self.contexts:
+            return
+        with self.lock:
+            event = self.minting.get(host)
+            if event is None:
+                self.minting[host] = event = threading.Event()
+                self.queue.put((host, ip))
+        self.start()
+        return event
+
+    def get_context(self, host, ip=False):
+        ssl_context = self.contexts.get(host)
+        if ssl_context:
+            self.hits += 1
+            return ssl_context
+        self.waits += 1
+        event = self.prepare(host, ip)
+        if event:
+            event.wait(30)
+        ssl_context = self.contexts.get(host)
+        if ssl_context is None:
+            #后台签发失败时直接签发，抛出错误
+            self.mint(host, ip)
+            ssl_context = self.contexts[host]
+        return ssl_context
+
+    def warm(self):
+        #加载最近使用过的证书，不用等待首次连接
+        certfiles = glob.glob('%s/*.crt' % ca_certdir)
+        certfiles.sort(key=os.path.getmtime, reverse=True)
+        for certfile in certfiles[:self.warm_size]:
+            name = os.path.basename(certfile)[:-4]
+            ip = name.replace('.', '').replace(':', '').isdigit() or ':' in name
+            self.prepare(name if ip else '.'.join(reversed(name.split('.'))), ip)
+
+    def status(self):
+        return u'伪造证书：缓存 %d，命中 %d，等待 %d，新签发 %d，从文件加载 %d' % (
+               len(self.contexts), self.hits, self.waits, self.minted, self.loaded)
+
+cert_factory = CertFactory()
+
 def import_cert(certfile):
     commonname = os.path.splitext(os.path.basename(certfile))[0]
     isCA = False
@@ -261,6 +372,10 @@ def check_ca():
             content = fp.read()
         sub_key = crypto.load_publickey(crypto.FILETYPE_PEM, content)
         sub_keystr = crypto.dump_publickey(crypto.FILETYPE_PEM, sub_key)
+        #密钥类型改变后重新生成，旧证书会在下面被删除
+        if (sub_key.type() == crypto.TYPE_RSA) != (GC.LINK_LOCALCERTKEY == 'rsa'):
+            logging.warning(u'证书密钥类型改为 %s，重新生成', GC.LINK_LOCALCERTKEY)
+            sub_keystr = dump_subkey()
     else:
         sub_keystr = dump_subkey()
     #Check Certs
@@ -287,6 +402,68 @@ def check_ca():
             os.mkdir(ca_certdir)
     else:
         os.mkdir(ca_certdir)
+    cert_factory.warm()
+
+def benchmark(count=200, handshakes=300):
+    '''Compare RSA-2048 and ECDSA P-256 leaf keys'''
+    import socket
+    import tempfile
+    import shutil
+    logging.setLevel(logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        pkey, ca = create_ca()
+        for keytype in ('rsa', 'ecc'):
+            start = time()
+            leaf_key = create_key(keytype)
+            keygen = (time() - start) * 1000
+            keyfile = os.path.join(tmpdir, keytype + '.key')
+            with open(keyfile, 'wb') as fp:
+                fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, leaf_key))
+            #签发证书，CA 密钥签名
+            start = time()
+            for i in range(count):
+                certfile = os.path.join(tmpdir, '%s%d.crt' % (keytype, i))
+                create_subcert(certfile, 'host%d.example.com' % i, pubkey=leaf_key, issuer=ca.get_subject(), issuer_key=pkey)
+            mint = count / (time() - start)
+            #叶证书密钥签名，每次握手都需要
+            start = time()
+            for i in range(count):
+                crypto.sign(leaf_key, b'%d' % i, ca_digest)
+            sign = count / (time() - start)
+            #本地握手
+            server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            server_context.load_cert_chain(certfile, keyfile)
+            client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            client_context.check_hostname = False
+            client_context.verify_mode = ssl.CERT_NONE
+            start = time()
+            for i in range(handshakes):
+                server_sock, client_sock = socket.socketpair()
+                server = server_context.wrap_socket(server_sock, server_side=True, do_handshake_on_connect=False)
+                client = client_context.wrap_socket(client_sock, do_handshake_on_connect=False)
+                server.setblocking(0)
+                client.setblocking(0)
+                done = set()
+                while len(done) < 2:
+                    for sock in (client, server):
+                        if sock in done:
+                            continue
+                        try:
+                            sock.do_handshake()
+                            done.add(sock)
+                        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                            pass
+                server.close()
+                client.close()
+            handshake = handshakes / (time() - start)
+            logging.warning(u'%s 叶证书：生成密钥 %.1fms，签发 %.0f/s，密钥签名 %.0f/s，本地握手 %.0f/s',
+                            'RSA-2048' if keytype == 'rsa' else 'ECDSA P-256', keygen, mint, sign, handshake)
+    finally:
+        shutil.rmtree(tmpdir)
 
 if __name__ == '__main__':
-    check_ca()
+    if 'benchmark' in sys.argv:
+        benchmark()
+    else:
+        check_ca()
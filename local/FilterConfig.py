@@ -48,6 +48,7 @@ actToNum = {
 }
 
 isfiltername = re.compile(r'(?P<order>\d+)-(?P<action>\w+)').match
+isbackref = re.compile(r'\\\d|\(\?P=').search
 if GC.LINK_PROFILE == 'ipv4':
     pickip = re.compile(r'(?<=\s|\|)(?:\d+\.){3}\d+(?=$|\s|\|)').findall
     ipnotuse = isipv6
@@ -61,6 +62,90 @@ elif GC.LINK_PROFILE == 'ipv6':
 
 class classlist(list): pass
 
+class HostIndex(object):
+    '''Compiled host filters, find matching rules in O(host length)'''
+
+    def __init__(self, action_filters):
+        #按匹配顺序排列的规则 (action, scheme, path, target)
+        self.rules = []
+        #反向域名标签树，节点为 (子节点, 完全匹配规则, 后缀匹配规则)
+        self.trie = {}, [], []
+        #前缀匹配 abc.
+        self.prefixes = {}
+        #任意位置匹配 abc 或 .abc.，按长度分组
+        self.substrings = {}
+        #匹配所有主机
+        self.anywhere = []
+        #正则匹配，每个小节合并为一个表达式用于快速排除
+        self.regexes = []
+        for filters in action_filters:
+            patterns = []
+            searches = []
+            for scheme, host, path, target in filters:
+                n = len(self.rules)
+                self.rules.append((filters.action, scheme, path, target))
+                if not isinstance(host, str):
+                    patterns.append(host.__self__.pattern)
+                    searches.append((n, host))
+                elif not host:
+                    self.anywhere.append(n)
+                elif '.' not in host or host[0] == host[-1] == '.':
+                    self.substrings.setdefault(len(host), {}).setdefault(host, []).append(n)
+                elif host[-1] == '.':
+                    self.prefixes.setdefault(host, []).append(n)
+                elif host[0] == '.':
+                    self._trie_node(host[1:])[2].append(n)
+                else:
+                    self._trie_node(host)[1].append(n)
+            if searches:
+                self.regexes.append((self._combine(patterns), searches))
+        self.substrings = sorted(self.substrings.items())
+
+    def _trie_node(self, host):
+        node = self.trie
+        for label in reversed(host.split('.')):
+            node = node[0].setdefault(label, ({}, [], []))
+        return node
+
+    def _combine(self, patterns):
+        #含有反向引用的表达式不能合并
+        if len(patterns) < 2 or any(isbackref(p) for p in patterns):
+            return
+        try:
+            return re.compile('|'.join('(?:%s)' % p for p in patterns)).search
+        except re.error:
+            return
+
+    def match(self, host):
+        '''Return all rules matching host, in config order'''
+        matched = self.anywhere[:]
+        labels = host.split('.')
+        node = self.trie
+        for i in range(len(labels)-1, -1, -1):
+            node = node[0].get(labels[i])
+            if node is None:
+                break
+            #还有剩余标签时为后缀匹配，否则为完全匹配
+            matched.extend(node[2] if i else node[1])
+        if self.prefixes:
+            pos = host.find('.')
+            while pos != -1:
+                rules = self.prefixes.get(host[:pos+1])
+                if rules:
+                    matched.extend(rules)
+                pos = host.find('.', pos+1)
+        for length, table in self.substrings:
+            for sub in set(host[i:i+length] for i in range(len(host)-length+1)):
+                rules = table.get(sub)
+                if rules:
+                    matched.extend(rules)
+        for search, searches in self.regexes:
+            if search is None or search(host):
+                matched.extend(n for n, host_search in searches if host_search(host))
+        matched.sort()
+        rules = self.rules
+        return [rules[n] for n in matched]
+
 ACTION_FILTERS = classlist()
 ACTION_FILTERS.reset = False
 CONFIG = ConfigParser()
@@ -122,3 +207,6 @@ for s in sections:
         #      v)
         filters.append((scheme.lower(), host, path, v))
     ACTION_FILTERS.append(filters)
+
+#编译主机名匹配索引
+ACTION_FILTERS.index = HostIndex(ACTION_FILTERS)
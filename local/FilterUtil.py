@@ -7,14 +7,20 @@ from .common import config_dir, LRUCache
 from .compat import urlparse
 from .GlobalConfig import GC
 from .FilterConfig import (
+    BLOCK,
+    FORWARD,
+    DIRECT,
+    GAE,
     FAKECERT,
     numToAct,
     numToSSLAct,
+    classlist,
+    HostIndex,
     ACTION_FILTERS
     )
 
-filters_cache = LRUCache(64)
-ssl_filters_cache = LRUCache(32)
+filters_cache = LRUCache(256)
+ssl_filters_cache = LRUCache(256)
 
 def get_redirect(target, url):
     '''Get the redirect target'''
@@ -85,23 +91,20 @@ def get_action(scheme, host, path, url):
         filter = None
         #建立缓存条目
         filters_cache[key] = []
-        for filters in ACTION_FILTERS:
-            if filters.action == FAKECERT:
-                continue
-            for schemefilter, hostfilter, pathfilter, target in filters:
-                if schemefilter in schemes and match_host_filter(hostfilter, host):
-                    action = numToAct[filters.action]
-                    #填充规则到缓存
-                    filters_cache.cache[key].append((schemefilter, pathfilter, action, target))
-                    #匹配第一个，后面忽略
-                    if not filter and match_path_filter(pathfilter, path):
-                        #计算重定向网址
-                        if action in REDIRECTS:
-                            durl = get_redirect(target, url)
-                            if durl and durl != url:
-                                filter = action, durl
-                        else:
-                            filter = action, target
+        for action, schemefilter, pathfilter, target in ACTION_FILTERS.index.match(host):
+            if action != FAKECERT and schemefilter in schemes:
+                action = numToAct[action]
+                #填充规则到缓存
+                filters_cache.cache[key].append((schemefilter, pathfilter, action, target))
+                #匹配第一个，后面忽略
+                if not filter and match_path_filter(pathfilter, path):
+                    #计算重定向网址
+                    if action in REDIRECTS:
+                        durl = get_redirect(target, url)
+                        if durl and durl != url:
+                            filter = action, durl
+                    else:
+                        filter = action, target
         #添加默认规则
         filters_cache.cache[key].append(filter_DEF)
         return filter or filter_DEF[2:]
@@ -111,13 +114,64 @@ def get_connect_action(ssl, host):
     if host in ssl_filters_cache:
         return ssl_filters_cache[host]
     else:
-        for filters in ACTION_FILTERS:
-            for schemefilter, hostfilter, _, target in filters:
-                if schemefilter in schemes and match_host_filter(hostfilter, host):
-                    #填充结果到缓存
-                    ssl_filters_cache[host] = filter = numToSSLAct[filters.action], target
-                    #匹配第一个，后面忽略
-                    return filter
+        for action, schemefilter, _, target in ACTION_FILTERS.index.match(host):
+            if schemefilter in schemes:
+                #填充结果到缓存
+                ssl_filters_cache[host] = filter = numToSSLAct[action], target
+                #匹配第一个，后面忽略
+                return filter
         #添加默认规则
         ssl_filters_cache[host] = ssl_filter_DEF
         return ssl_filter_DEF
+
+def test(nrules=12000, nhosts=2000):
+    '''Compare cold lookups of the compiled index with a linear scan'''
+    import re
+    import random
+    words = ['%s%d' % (random.choice(('ad', 'cdn', 'img', 'api', 'video', 'static')), i) for i in range(nrules // 4)]
+    tlds = ['com', 'net', 'org', 'cn', 'io', 'com.cn']
+    def domain():
+        return '%s.%s' % (random.choice(words), random.choice(tlds))
+    #按配置中常见的比例生成各类规则，分为多个小节
+    action_filters = []
+    for section in range(12):
+        filters = classlist()
+        filters.action = random.choice((BLOCK, FORWARD, DIRECT, GAE, FAKECERT))
+        for i in range(nrules // 12):
+            kind = random.random()
+            if kind < 0.5:
+                host = '.' + domain()
+            elif kind < 0.8:
+                host = domain()
+            elif kind < 0.9:
+                host = random.choice(words) + '.'
+            elif kind < 0.97:
+                host = random.choice(words) + 'x'
+            else:
+                host = re.compile(r'^%s\d*\.%s$' % (random.choice(words), random.choice(tlds))).search
+            filters.append(('', host, '', None))
+        action_filters.append(filters)
+    start = time()
+    index = HostIndex(action_filters)
+    build_time = time() - start
+    hosts = []
+    for i in range(nhosts):
+        host = domain()
+        hosts.append(random.choice(('', 'www.', 'a.b.')) + host if random.random() < 0.7 else host)
+    def linear_match(host):
+        return [(filters.action, scheme, path, target)
+                for filters in action_filters
+                for scheme, hostfilter, path, target in filters
+                if match_host_filter(hostfilter, host)]
+    start = time()
+    linear = [linear_match(host) for host in hosts]
+    linear_time = time() - start
+    start = time()
+    indexed = [index.match(host) for host in hosts]
+    index_time = time() - start
+    assert linear == indexed, 'index result differs from linear scan'
+    logging.info(u'%d 条规则，索引编译 %.3fs；%d 个主机冷查询：线性扫描 %.1fus/次，索引 %.1fus/次',
+                 nrules, build_time, nhosts, linear_time / nhosts * 1e6, index_time / nhosts * 1e6)
+
+if __name__ == '__main__':
+    test()
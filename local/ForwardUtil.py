@@ -0,0 +1,613 @@
+# coding:utf-8
+'''Relay data between two connected sockets'''
+
+import os
+import errno
+import socket
+import threading
+import collections
+import select as select_module
+from select import select
+from time import time, sleep
+from . import clogging as logging
+from .compat import thread, xrange
+
+#Linux 的 splice 可以在内核中经由管道转发数据，python 3.10 以上可用
+HAS_SPLICE = hasattr(os, 'splice')
+if HAS_SPLICE:
+    SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    try:
+        import fcntl
+        #调大管道容量，减少系统调用次数
+        F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+    except ImportError:
+        fcntl = None
+
+#windows 上没有 poll，使用与 epoll 相同的值
+EPOLLIN = getattr(select_module, 'EPOLLIN', 1)
+EPOLLOUT = getattr(select_module, 'EPOLLOUT', 4)
+EPOLLERR = getattr(select_module, 'EPOLLERR', 8)
+EPOLLHUP = getattr(select_module, 'EPOLLHUP', 16)
+
+class TunnelStats(object):
+    '''Byte and throughput counters of a tunnel'''
+
+    def __init__(self, method):
+        self.method = method
+        self.start = time()
+        self.sent = 0
+        self.received = 0
+
+    @property
+    def cost(self):
+        return time() - self.start
+
+    @property
+    def throughput(self):
+        return (self.sent + self.received) / max(self.cost, 1e-6)
+
+    def __str__(self):
+        return u'%s 上行 %d 字节，下行 %d 字节，用时 %.1fs，%.1f KB/s' % (
+                   self.method, self.sent, self.received, self.cost, self.throughput / 1024)
+
+def is_plain(sock):
+    #加密套接字的数据须在用户空间解密
+    return hasattr(sock, 'fileno') and not hasattr(sock, 'do_handshake')
+
+def can_splice(*socks):
+    #只有内核套接字能使用 splice
+    return HAS_SPLICE and all(is_plain(sock) for sock in socks)
+
+def would_block(e):
+    return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def count(stats, sock, local, ndata):
+    if sock is local:
+        stats.sent += ndata
+    else:
+        stats.received += ndata
+
+def buffer_forward(local, remote, timeout=30, tick=4, maxpong=None, bufsize=32768):
+    '''Relay with recv_into and memoryview, no copy for each chunk'''
+    stats = TunnelStats('buffer')
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    maxpong = maxpong or timeout
+    allins = [local, remote]
+    timecount = timeout
+    while allins and timecount > 0:
+        timecount -= tick
+        ins, _, err = select(allins, [], allins, tick)
+        if err:
+            raise socket.error(err)
+        for sock in ins:
+            ndata = sock.recv_into(buf)
+            if ndata:
+                other = local if sock is remote else remote
+                other.sendall(view[:ndata])
+                count(stats, sock, local, ndata)
+                timecount = min(timecount*2, maxpong)
+            else:
+                allins.remove(sock)
+    return stats
+
+class SplicePipe(object):
+    '''One direction of a spliced tunnel'''
+
+    bufsize = 1024 * 1024
+
+    def __init__(self, src, dst, bufsize=None):
+        self.src = src
+        self.dst = dst
+        self.srcfd = src.fileno()
+        self.dstfd = dst.fileno()
+        self.rfd, self.wfd = os.pipe()
+        if bufsize:
+            self.bufsize = bufsize
+        elif fcntl:
+            try:
+                fcntl.fcntl(self.wfd, F_SETPIPE_SZ, self.bufsize)
+            except (IOError, OSError):
+                # 超过 /proc/sys/fs/pipe-max-size 时使用默认容量
+                self.bufsize = 65536
+        else:
+            self.bufsize = 65536
+        self.pending = 0
+        self.eof = False
+
+    def fill(self):
+        '''Move data from source socket into the pipe'''
+        try:
+            ndata = os.splice(self.srcfd, self.wfd, self.bufsize - self.pending, flags=SPLICE_FLAGS)
+        except OSError as e:
+            if would_block(e):
+                return 0
+            raise
+        if ndata == 0:
+            self.eof = True
+        self.pending += ndata
+        return ndata
+
+    def drain(self):
+        '''Move data from the pipe into destination socket'''
+        try:
+            ndata = os.splice(self.rfd, self.dstfd, self.pending, flags=SPLICE_FLAGS)
+        except OSError as e:
+            if would_block(e):
+                return 0
+            raise
+        self.pending -= ndata
+        return ndata
+
+    def abort(self):
+        #管道中的数据随管道一起关闭
+        self.eof = True
+        self.pending = 0
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+def splice_forward(local, remote, timeout=30, tick=4, maxpong=None):
+    '''Relay with splice, data moves through a pipe inside the kernel'''
+    stats = TunnelStats('splice')
+    maxpong = maxpong or timeout
+    upstream = SplicePipe(local, remote)
+    downstream = SplicePipe(remote, local)
+    pipes = upstream, downstream
+    timecount = timeout
+    try:
+        while timecount > 0:
+            #管道中还有数据时不再读取来源，形成背压
+            rlist = [p.src for p in pipes if not p.eof and p.pending < p.bufsize]
+            wlist = [p.dst for p in pipes if p.pending]
+            if not (rlist or wlist):
+                break
+            timecount -= tick
+            ins, outs, err = select(rlist, wlist, rlist, tick)
+            if err:
+                raise socket.error(err)
+            moved = False
+            for pipe in pipes:
+                if pipe.src in ins:
+                    moved = pipe.fill() or moved
+                if pipe.pending:
+                    ndata = pipe.drain()
+                    if ndata:
+                        count(stats, pipe.src, local, ndata)
+                        moved = True
+            if moved:
+                timecount = min(timecount*2, maxpong)
+    finally:
+        upstream.close()
+        downstream.close()
+    return stats
+
+class BufferPipe(object):
+    '''One direction of a tunnel, buffered in user space for non-blocking sockets'''
+
+    bufsize = 32768
+
+    def __init__(self, src, dst, bufsize=None):
+        self.src = src
+        self.dst = dst
+        if bufsize:
+            self.bufsize = bufsize
+        self.buf = bytearray(self.bufsize)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+        self.eof = False
+
+    @property
+    def pending(self):
+        return self.end - self.start
+
+    def fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == self.bufsize:
+            #数据移到开头，腾出读取空间
+            self.buf[:self.pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, self.pending
+        try:
+            ndata = self.src.recv_into(self.view[self.end:])
+        except socket.error as e:
+            if would_block(e):
+                return 0
+            raise
+        if ndata == 0:
+            self.eof = True
+        self.end += ndata
+        return ndata
+
+    def drain(self):
+        try:
+            ndata = self.dst.send(self.view[self.start:self.end])
+        except socket.error as e:
+            if would_block(e):
+                return 0
+            raise
+        self.start += ndata
+        return ndata
+
+    def abort(self):
+        self.eof = True
+        self.start = self.end = 0
+
+    def close(self):
+        pass
+
+class Tunnel(object):
+    '''A pair of sockets relayed by RelayEngine'''
+
+    def __init__(self, local, remote, timeout, tick, maxpong, url):
+        self.local = local
+        self.remote = remote
+        self.tick = tick
+        self.maxpong = maxpong or timeout
+        self.timecount = timeout
+        self.lastcheck = time()
+        self.url = url
+        Pipe = SplicePipe if can_splice(local, remote) else BufferPipe
+        #长时间存在的隧道很多，使用默认的管道容量
+        self.upstream = Pipe(local, remote, 65536)
+        self.downstream = Pipe(remote, local, 65536)
+        self.stats = TunnelStats('engine-' + Pipe.__name__[:-4].lower())
+        #已经半关闭目标的管道
+        self.shut = set()
+        self.error = None
+
+    @property
+    def finished(self):
+        return all(p.eof and not p.pending for p in (self.upstream, self.downstream))
+
+    def events(self, sock):
+        '''Return (readable, writable) interest of sock'''
+        if sock is self.local:
+            rpipe, wpipe = self.upstream, self.downstream
+        else:
+            rpipe, wpipe = self.downstream, self.upstream
+        #管道中的数据没有发完时不再读取来源，形成背压
+        return not rpipe.eof and rpipe.pending < rpipe.bufsize, bool(wpipe.pending)
+
+    def relay(self):
+        moved = False
+        for pipe in (self.upstream, self.downstream):
+            try:
+                if not pipe.eof and pipe.pending < pipe.bufsize:
+                    moved = pipe.fill() or moved
+                if pipe.pending:
+                    ndata = pipe.drain()
+                    if ndata:
+                        count(self.stats, pipe.src, self.local, ndata)
+                        moved = True
+            except (socket.error, OSError) as e:
+                #只放弃出错的方向，另一方向继续转发剩余数据
+                pipe.abort()
+                self.error = self.error or e
+            if pipe.eof and not pipe.pending and pipe not in self.shut:
+                #来源已结束且数据已发完，半关闭目标，把结束传给对端
+                self.shut.add(pipe)
+                try:
+                    pipe.dst.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+        if moved:
+            self.timecount = min(self.timecount*2, self.maxpong)
+
+    def expired(self, now):
+        #与单独转发时相同，每个 tick 减少计数，有数据转发时加倍
+        if now - self.lastcheck >= self.tick:
+            self.timecount -= self.tick
+            self.lastcheck = now
+        return self.timecount <= 0
+
+    def close(self):
+        for sock in (self.local, self.remote):
+            try:
+                sock.close()
+            except Exception:
+                pass
+        self.upstream.close()
+        self.downstream.close()
+
+def wakeup_pair():
+    try:
+        return socket.socketpair()
+    except (AttributeError, OSError):
+        # windows 上的 python 2 没有 socketpair
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = socket.create_connection(listener.getsockname())
+        receiver, _ = listener.accept()
+        listener.close()
+        return receiver, sender
+
+class RelayEngine(object):
+    '''Relay all established tunnels in one thread, with epoll when available'''
+
+    #select 在 windows 上最多只能同时检查 512 个套接字
+    select_size = 500
+    #检查超时的间隔
+    interval = 1
+    #轮询连续出错时的最长等待时间
+    max_backoff = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #fd -> (tunnel, sock)
+        self.socks = {}
+        #已经接管的本地连接，服务器不能再关闭它们
+        self.owned = set()
+        self.tunnels = set()
+        self.adding = collections.deque()
+        self.running = False
+        self.wakeup_receiver, self.wakeup_sender = wakeup_pair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.wakeup_fd = self.wakeup_receiver.fileno()
+        #sock -> fd，关闭后的套接字无法再取得 fd
+        self.fds = {}
+        #fd -> 已注册的事件
+        self.registered = {}
+        # gevent 补丁后 epoll 会被移除，此时使用协程化的 select
+        if hasattr(select_module, 'epoll'):
+            self.epoll = select_module.epoll()
+            self.epoll.register(self.wakeup_fd, EPOLLIN)
+        else:
+            self.epoll = None
+
+    def add(self, local, remote, timeout=30, tick=4, maxpong=None, url=None):
+        '''Take over the tunnel, return False if it can not be relayed here'''
+        if not (is_plain(local) and is_plain(remote)):
+            return False
+        local.setblocking(False)
+        remote.setblocking(False)
+        tunnel = Tunnel(local, remote, timeout, tick, maxpong, url)
+        with self.lock:
+            self.owned.add(local)
+            self.adding.append(tunnel)
+            if not self.running:
+                self.running = True
+                thread.start_new_thread(self.run, ())
+        try:
+            self.wakeup_sender.send(b'x')
+        except socket.error:
+            #已有未处理的唤醒数据
+            pass
+        return True
+
+    def owns(self, sock):
+        return sock in self.owned
+
+    def _update(self, tunnel):
+        for sock in (tunnel.local, tunnel.remote):
+            readable, writable = tunnel.events(sock)
+            mask = (readable and EPOLLIN) | (writable and EPOLLOUT)
+            fd = self.fds[sock]
+            old = self.registered[fd]
+            if old != mask:
+                self.registered[fd] = mask
+                if self.epoll:
+                    #没有关注事件的套接字移出 epoll，否则挂断后 EPOLLHUP 会一直触发
+                    if not mask:
+                        self.epoll.unregister(fd)
+                    elif not old:
+                        self.epoll.register(fd, mask)
+                    else:
+                        self.epoll.modify(fd, mask)
+
+    def _add_tunnels(self):
+        with self.lock:
+            adding = list(self.adding)
+            self.adding.clear()
+        for tunnel in adding:
+            for sock in (tunnel.local, tunnel.remote):
+                fd = sock.fileno()
+                self.fds[sock] = fd
+                self.socks[fd] = tunnel, sock
+                self.registered[fd] = 0
+            self.tunnels.add(tunnel)
+            self._update(tunnel)
+
+    def _close(self, tunnel, error=None):
+        for sock in (tunnel.local, tunnel.remote):
+            fd = self.fds.pop(sock, None)
+            self.socks.pop(fd, None)
+            self.registered.pop(fd, None)
+            if self.epoll:
+                try:
+                    self.epoll.unregister(fd)
+                except (IOError, OSError, ValueError):
+                    pass
+        self.tunnels.discard(tunnel)
+        tunnel.close()
+        with self.lock:
+            self.owned.discard(tunnel.local)
+        if error and error.args and error.args[0] not in (errno.ECONNABORTED, errno.ECONNRESET, errno.EPIPE, 10053, 10054):
+            logging.warning(u'转发 %r 失败：%r', tunnel.url, error)
+        logging.debug(u'转发 %r 结束：%s', tunnel.url, tunnel.stats)
+
+    def _poll(self, timeout):
+        if self.epoll:
+            try:
+                return self.epoll.poll(timeout)
+            except (IOError, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+        rfds = [self.wakeup_fd]
+        wfds = []
+        for fd, mask in self.registered.items():
+            if mask & EPOLLIN:
+                rfds.append(fd)
+            if mask & EPOLLOUT:
+                wfds.append(fd)
+        ready = []
+        for i in xrange(0, max(len(rfds), len(wfds)), self.select_size):
+            rpart = rfds[i:i+self.select_size]
+            wpart = wfds[i:i+self.select_size]
+            try:
+                ins, outs, errs = select(rpart, wpart, rpart, timeout if i == 0 else 0)
+            except (select_module.error, ValueError, OSError):
+                #有套接字已被关闭或无法检查，逐个检查后按出错处理
+                ins = outs = []
+                errs = []
+                for fd in set(rpart + wpart):
+                    try:
+                        select([fd], [], [], 0)
+                    except (select_module.error, ValueError, OSError):
+                        errs.append(fd)
+            ready.extend((fd, EPOLLIN) for fd in ins)
+            ready.extend((fd, EPOLLOUT) for fd in outs)
+            ready.extend((fd, EPOLLERR) for fd in errs)
+        return ready
+
+    def _rebuild(self):
+        '''Recreate epoll, close tunnels whose sockets can not be registered'''
+        try:
+            self.epoll.close()
+        except Exception:
+            pass
+        self.epoll = select_module.epoll()
+        self.epoll.register(self.wakeup_fd, EPOLLIN)
+        for fd, mask in list(self.registered.items()):
+            if mask and fd in self.socks:
+                try:
+                    self.epoll.register(fd, mask)
+                except (IOError, OSError, ValueError) as e:
+                    self._close(self.socks[fd][0], e)
+
+    def run(self):
+        lastcheck = time()
+        backoff = 0
+        while True:
+            try:
+                ready = self._poll(self.interval)
+            except Exception as e:
+                #持续出错时逐渐延长等待并重建 epoll，避免空转和刷屏
+                backoff = min(backoff * 2 or 0.1, self.max_backoff)
+                logging.exception(u'RelayEngine 错误，%.1f 秒后重试：%r', backoff, e)
+                sleep(backoff)
+                if self.epoll:
+                    try:
+                        self._rebuild()
+                    except Exception as e:
+                        logging.warning(u'RelayEngine 重建 epoll 失败：%r', e)
+                continue
+            backoff = 0
+            touched = set()
+            for fd, event in ready:
+                if fd == self.wakeup_fd:
+                    try:
+                        self.wakeup_receiver.recv(4096)
+                    except socket.error:
+                        pass
+                    self._add_tunnels()
+                    continue
+                if fd in self.socks:
+                    touched.add(self.socks[fd][0])
+            for tunnel in touched:
+                try:
+                    tunnel.relay()
+                except Exception as e:
+                    self._close(tunnel, e)
+                    continue
+                #出错或已挂断时由 relay 读到结束或错误，两个方向都转发完才关闭
+                if tunnel.finished:
+                    self._close(tunnel, tunnel.error)
+                else:
+                    self._update(tunnel)
+            now = time()
+            if now - lastcheck >= self.interval:
+                lastcheck = now
+                for tunnel in list(self.tunnels):
+                    if tunnel.expired(now):
+                        self._close(tunnel)
+
+    def status(self):
+        return u'转发引擎：%d 个隧道' % len(self.tunnels)
+
+relay_engine = RelayEngine()
+
+def forward(local, remote, timeout=30, tick=4, maxpong=None):
+    '''Relay local and remote sockets until both closed or timeout'''
+    if can_splice(local, remote):
+        return splice_forward(local, remote, timeout, tick, maxpong)
+    return buffer_forward(local, remote, timeout, tick, maxpong)
+
+def test(size=256*1024*1024):
+    '''Relay through loopback, compare with the old slicing loop'''
+    import threading
+
+    def slice_forward(local, remote, timeout=30, tick=4, maxpong=None):
+        #原来的实现，每次 sendall(buf[:ndata]) 都会复制数据
+        stats = TunnelStats('slice')
+        buf = bytearray(32768)
+        maxpong = maxpong or timeout
+        allins = [local, remote]
+        timecount = timeout
+        while allins and timecount > 0:
+            timecount -= tick
+            ins, _, err = select(allins, [], allins, tick)
+            for sock in ins:
+                ndata = sock.recv_into(buf)
+                if ndata:
+                    other = local if sock is remote else remote
+                    other.sendall(buf[:ndata])
+                    count(stats, sock, local, ndata)
+                    timecount = min(timecount*2, maxpong)
+                else:
+                    allins.remove(sock)
+        return stats
+
+    def socketpair(listener):
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+        return client, server
+
+    def send(sock):
+        data = memoryview(os.urandom(1024 * 1024))
+        sent = 0
+        while sent < size:
+            sock.sendall(data)
+            sent += len(data)
+        sock.shutdown(socket.SHUT_WR)
+
+    def recv(sock, result):
+        buf = bytearray(1024 * 1024)
+        received = 0
+        while received < size:
+            ndata = sock.recv_into(buf)
+            if not ndata:
+                break
+            received += ndata
+        result.append(received)
+        sock.close()
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(4)
+    relays = [slice_forward, buffer_forward]
+    if HAS_SPLICE:
+        relays.append(splice_forward)
+    for relay in relays:
+        client, local = socketpair(listener)
+        remote, server = socketpair(listener)
+        result = []
+        threads = [threading.Thread(target=send, args=(client,)),
+                   threading.Thread(target=recv, args=(server, result))]
+        for t in threads:
+            t.start()
+        stats = relay(local, remote)
+        for t in threads:
+            t.join()
+        for sock in (client, local, remote):
+            sock.close()
+        logging.info(u'%-13s 转发 %d MB：%.2fs，%.1f MB/s',
+                     relay.__name__, result[0] // 1048576, stats.cost, stats.sent / max(stats.cost, 1e-6) / 1048576)
+    listener.close()
+
+if __name__ == '__main__':
+    test()
@@ -3,14 +3,212 @@
 import zlib
 import io
 import struct
+import threading
+from . import clogging as logging
 from .compat import PY3, httplib, Queue, xrange
 from .GlobalConfig import GC
-from .HTTPUtil import http_gws
+from .HTTPUtil import http_gws, reaper
+from .HTTP2Util import http2_gws
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 qGAE = Queue.LifoQueue()
 for i in xrange(GC.GAE_MAXREQUESTS * len(GC.GAE_APPIDS)):
     qGAE.put(True)
 
+#已经压缩过的内容类型，不再压缩
+compressed_types = (
+    'image/',
+    'video/',
+    'audio/',
+    'font/woff',
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/vnd.rar',
+    'application/x-protobuf',
+    )
+#本地可以解码的响应编码
+decodable_encodings = ['gzip', 'deflate']
+#解码时要限制每次的输出大小，brotli 1.1.0 以上才支持
+if brotli and hasattr(brotli.Decompressor, 'can_accept_more_data'):
+    decodable_encodings.append('br')
+if zstandard:
+    decodable_encodings.append('zstd')
+accept_encoding = ', '.join(decodable_encodings)
+#没有安装对应模块时使用 deflate
+payload_encoding = GC.GAE_COMPRESS if GC.GAE_COMPRESS in decodable_encodings else 'deflate'
+#请求主体只压缩 10M 以内的数据
+compress_max = 10485760
+
+def is_compressed_type(content_type):
+    content_type = content_type.lower()
+    return content_type.startswith(compressed_types) and not content_type.startswith('image/svg')
+
+def compress_payload(payload, encoding):
+    if encoding == 'br' and brotli:
+        return brotli.compress(payload, quality=5)
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return zlib.compress(payload)[2:-4]
+
+def accepted_encodings(value):
+    encodings = set()
+    for coding in value.lower().split(','):
+        coding, _, q = coding.partition(';')
+        q = q.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                pass
+        encodings.add(coding.strip())
+    return encodings
+
+class CompressStatistics(object):
+    '''Count bytes kept off the GAE link by compression'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.upload_saved = 0
+        self.download_saved = 0
+        reaper.reporters.append(self)
+
+    def add(self, upload=0, download=0):
+        with self.lock:
+            if upload:
+                self.requests += 1
+            self.upload_saved += upload
+            self.download_saved += download
+
+    def status(self):
+        with self.lock:
+            return u'GAE 压缩：上传压缩 %d 次，节省上传 %.1fKB，本地解码节省下载 %.1fKB' % (
+                   self.requests, self.upload_saved / 1024.0, self.download_saved / 1024.0)
+
+compress_stat = CompressStatistics()
+
+class WireReader(object):
+    '''Read the raw response body and count its bytes'''
+
+    def __init__(self, read):
+        self.raw_read = read
+        self.wire = 0
+
+    def read(self, size=8192):
+        data = self.raw_read(min(size, 8192) if size > 0 else 8192)
+        self.wire += len(data)
+        return data
+
+class DecodedReader(object):
+    '''Decode a compressed response body while it is read
+
+    Like the zlib path, br and zstd return about amt bytes at most per
+    read, so a small compressed chunk can not expand into a huge buffer.
+    '''
+
+    def __init__(self, response, encoding, url):
+        self.source = WireReader(response.read)
+        self.encoding = encoding
+        self.url = url
+        self.decoded = 0
+        self.finished = False
+        self.tail = b''
+        #解码器中还有未输出的数据，以空输入继续
+        self.more = False
+        if encoding == 'br':
+            self.decompressor = brotli.Decompressor()
+            self.decompress = self.decompress_br
+        elif encoding == 'zstd':
+            #流式读取器自己从来源读取，按 amt 限制输出
+            self.decompressor = zstandard.ZstdDecompressor().stream_reader(self.source, read_size=8192)
+            self.decompress = None
+        else:
+            if encoding == 'gzip':
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                # deflate 需要判断是否带有 zlib 头部
+                self.decompressor = None
+            self.decompress = self.decompress_zlib
+
+    @property
+    def wire(self):
+        return self.source.wire
+
+    def decompress_zlib(self, data, amt):
+        if self.decompressor is None:
+            head = bytearray(data[:2])
+            wbits = zlib.MAX_WBITS
+            if len(head) < 2 or head[0] & 0x0f != 8 or (head[0] << 8 | head[1]) % 31:
+                wbits = -wbits
+            self.decompressor = zlib.decompressobj(wbits)
+        data = self.decompressor.decompress(data, amt or 0)
+        self.tail = self.decompressor.unconsumed_tail
+        return data
+
+    def decompress_br(self, data, amt):
+        if not amt:
+            return self.decompressor.process(data)
+        data = self.decompressor.process(data, output_buffer_limit=amt)
+        #输出受限时可能还有数据，直到空输入也没有输出为止
+        self.more = bool(data) or not self.decompressor.can_accept_more_data()
+        return data
+
+    def read_zstd(self, amt):
+        if amt:
+            return self.decompressor.read(amt)
+        return self.decompressor.read1()
+
+    def finish(self):
+        self.finished = True
+        compress_stat.add(download=self.decoded - self.wire)
+        logging.debug(u'%r 解码 %s 内容：%d -> %d', self.url, self.encoding, self.wire, self.decoded)
+
+    def read(self, amt=None):
+        while not self.finished:
+            if self.decompress is None:
+                data = self.read_zstd(amt)
+                if not data:
+                    self.finish()
+                    break
+            else:
+                if self.tail:
+                    data, self.tail = self.tail, b''
+                elif self.more:
+                    data = b''
+                else:
+                    data = self.source.read()
+                    if not data:
+                        self.finish()
+                        break
+                data = self.decompress(data, amt)
+            if data:
+                self.decoded += len(data)
+                return data
+        return b''
+
+def decode_response(response, url):
+    encoding = response.getheader('Content-Encoding', '').strip().lower()
+    if encoding not in decodable_encodings:
+        return
+    response.read = DecodedReader(response, encoding, url).read
+    del response.msg['Content-Encoding']
+    if 'Content-Length' in response.msg:
+        del response.msg['Content-Length']
+
 def make_errinfo(htmltxt):
     if not isinstance(htmltxt, bytes):
         htmltxt = htmltxt.encode()
@@ -41,15 +239,29 @@ def gae_urlfetch(method, url, headers, payload, appid, timeout=None, rangefetch=
     # GAE 代理请求不允许设置 Host 头域
     if 'Host' in headers:
         del headers['Host']
-    #if payload:
-        #if not isinstance(payload, bytes):
-        #    payload = payload.encode()
-        #if len(payload) < 10 * 1024 * 1024 and 'Content-Encoding' not in headers:
-        #    zpayload = zlib.compress(payload)[2:-4]
-        #    if len(zpayload) < len(payload):
-        #        payload = zpayload
-        #        headers['Content-Encoding'] = 'deflate'
-        #headers['Content-Length'] = str(len(payload))
+    if payload and not isinstance(payload, bytes):
+        payload = payload.encode()
+    #客户端不接受的编码在本地解码
+    decode = False
+    if GC.GAE_COMPRESS:
+        if (payload and len(payload) >= GC.GAE_COMPRESSMIN and len(payload) < compress_max and
+                'Content-Encoding' not in headers and
+                not is_compressed_type(headers.get('Content-Type', ''))):
+            zpayload = compress_payload(payload, payload_encoding)
+            if len(zpayload) < len(payload):
+                #不修改原头部，重试时需要原始数据
+                headers = headers.copy()
+                headers['Content-Encoding'] = payload_encoding
+                headers['Content-Length'] = str(len(zpayload))
+                compress_stat.add(upload=len(payload) - len(zpayload))
+                logging.debug(u'%r 压缩 %s 请求主体：%d -> %d', url, payload_encoding, len(payload), len(zpayload))
+                payload = zpayload
+        if method != 'HEAD' and 'Range' not in headers:
+            accepted = accepted_encodings(headers.get('Accept-Encoding', ''))
+            if not accepted.issuperset(decodable_encodings):
+                headers = headers.copy()
+                headers['Accept-Encoding'] = accept_encoding
+                decode = accepted
     if GC.GAE_PATH == '/2':
         metadata = 'G-Method:%s\nG-Url:%s\n%s' % (method, url, ''.join('G-%s:%s\n' % (k, v) for k, v in kwargs.items() if v))
         metadata += ''.join('%s:%s\n' % (k.title(), v) for k, v in headers.items())
@@ -60,19 +272,19 @@ def gae_urlfetch(method, url, headers, payload, appid, timeout=None, rangefetch=
     if not isinstance(metadata, bytes):
         metadata = metadata.encode()
     metadata = zlib.compress(metadata)[2:-4]
+    #分段发送，不拼接可能很大的请求主体
+    buffers = [struct.pack('!h', len(metadata)) + metadata]
     if payload:
-        if not isinstance(payload, bytes):
-            payload = payload.encode()
-        payload = struct.pack('!h', len(metadata)) + metadata + payload
-    else:
-        payload = struct.pack('!h', len(metadata)) + metadata
-    request_headers = {'User-Agent': 'a', 'Content-Length': str(len(payload))}
+        buffers.append(payload)
+    payload = buffers
+    request_headers = {'User-Agent': 'a', 'Content-Length': str(sum(len(buf) for buf in payload))}
     # post data
     request_params = gae_params(appid)
     connection_cache_key = 'google_gws:443'
     realurl = 'GAE-' + url
     qGAE.get() # get start from Queue
-    response = http_gws.request(request_params, payload, request_headers, connection_cache_key=connection_cache_key, timeout=timeout, rangefetch=rangefetch, realurl=realurl)
+    http_util = http2_gws or http_gws
+    response = http_util.request(request_params, payload, request_headers, connection_cache_key=connection_cache_key, timeout=timeout, rangefetch=rangefetch, realurl=realurl)
     if response is None:
         return None
     response.app_status = response.status
@@ -115,4 +327,6 @@ def gae_urlfetch(method, url, headers, payload, appid, timeout=None, rangefetch=
         response.headers = response.msg = httplib.parse_headers(io.BytesIO(headers_data))
     else:
         response.msg = httplib.HTTPMessage(io.BytesIO(headers_data))
+    if decode is not False and response.getheader('Content-Encoding', '').strip().lower() not in decode:
+        decode_response(response, url)
     return response
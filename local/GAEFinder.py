@@ -33,8 +33,10 @@ import select
 import random
 import OpenSSL
 from . import clogging as logging
-from time import time, localtime, strftime
+from time import time, strftime
 from .common import cert_dir, data_dir, NetWorkIOError, isip, isipv4, isipv6
+from .common.ipset import IPSet, IPSampler
+from .common.reputation import ReputationStore
 from .compat import PY3, xrange
 from .GlobalConfig import GC
 
@@ -45,6 +47,8 @@ g_maxhandletimeout = GC.FINDER_MAXTIMEOUT or 1000
 g_maxgaeipcnt = GC.FINDER_MINIPCNT or 12
 #扫描 IP 的线程数量
 g_maxthreads = GC.FINDER_THREADS or 10
+#非阻塞探测时各阶段同时检测的 IP 数量，0 表示使用多线程检测
+g_probes = GC.FINDER_PROBES if all(GC.FINDER_PROBES) else None
 #容忍 badip 的次数
 g_timesblock = GC.FINDER_TIMESBLOCK
 #屏蔽 badip 的时限，单位：小时
@@ -60,13 +64,16 @@ g_handshaketimeout = 1.5
 g_useOpenSSL = GC.LINK_OPENSSL or 1
 #屏蔽列表（通过测试、但无法使用 GAE）
 g_block = GC.FINDER_BLOCK #('74.125.', '173.194.', '203.208.', '113.171.')
+g_blockset = IPSet.from_prefixes(g_block)
 
 g_cacertfile = os.path.join(cert_dir, "cacert.pem")
 g_ipfile = os.path.join(data_dir, "ip.txt")
 g_ipexfile = os.path.join(data_dir, "ipex.txt")
+g_ipcachefile = os.path.join(data_dir, "ip.bin")
+g_ipexcachefile = os.path.join(data_dir, "ipex.bin")
 g_badfile = os.path.join(data_dir, "ip_bad.txt")
 g_badfilebak = os.path.join(data_dir, "ip_badbak.txt")
-g_statisticsfilebak = os.path.join(data_dir, "statisticsbak")
+g_reputationfile = os.path.join(data_dir, "reputation.db")
 
 #加各时段 IP 延时，单位：毫秒
 timeToDelay = {    0 :   0,
@@ -95,80 +102,36 @@ elif GC.LINK_PROFILE == 'ipv6':
 elif GC.LINK_PROFILE == 'ipv46':
     ipnotuse = lambda x: not isip(x)
 
-def readstatistics():
-    def getnames():
-        now = time()
-        names = []
-        #生成统计文件名
-        for i in xrange(GC.FINDER_STATDAYS):
-            n = strftime('%y%j', localtime(now-3600*24*i))
-            name = os.path.join(data_dir, 'statistics'+n)
-            names.append(name)
-        #新建当日统计文件
-        if not os.path.exists(names[0]):
-            with open(names[0], 'w'): pass
-        #删除过期的统计文件
-        sfiles = [g_statisticsfilebak,]
-        sfiles.extend(names)
-        for file in os.listdir(data_dir):
-            if file.startswith('statistics'):
-                isdel = True
-                for sfile in sfiles:
-                    if sfile.endswith(file):
-                        isdel = False
-                        break
-                if isdel:
-                    os.remove(os.path.join(data_dir, file))
-        return tuple(names)
+#按时间衰减的 IP 成功、失败次数与延时，半衰期为统计天数的一半
+reputation = ReputationStore(g_reputationfile, GC.FINDER_STATDAYS * 3600 * 12)
 
-    ipdict = {}
-    ipdicttoday = None
-    deledipset = set()
-    g.statisticsfiles = statisticsfiles = getnames()
-    for file in statisticsfiles:
-        if os.path.exists(file):
-            with open(file, 'r') as fd:
+def importstatistics():
+    #导入旧版按日保存的统计文件，然后删除
+    files = [file for file in os.listdir(data_dir) if file.startswith('statistics')]
+    if not files:
+        return
+    now = time()
+    for file in files:
+        name = os.path.join(data_dir, file)
+        try:
+            #备份文件是当日统计的副本
+            if file == 'statisticsbak':
+                os.remove(name)
+                continue
+            updated = os.path.getmtime(name)
+            with open(name, 'r') as fd:
                 for line in fd:
                     ips = [x.strip('\r\n ') for x in line.split('*')]
                     if len(ips) == 3:
-                        ip = ips[0]
-                        if ip.startswith(g_block):
-                            continue
                         good = int(ips[1])
                         bad = int(ips[2])
                         # 小于 0 表示已删除
                         if good < 0:
-                            deledipset.add(ip)
-                        if ip in ipdict:
-                            if ip in deledipset:
-                                continue
-                            cgood, cbad = ipdict[ip]
-                            good += cgood
-                            bad += cbad
-                        ipdict[ip] = good, bad
-        #复制当日统计数据
-        if ipdicttoday is None:
-            ipdicttoday = ipdict.copy()
-    return ipdict, ipdicttoday
-
-def savestatistics(statistics=None):
-    statisticsfile = g.statisticsfiles[0]
-    if os.path.exists(statisticsfile):
-        if os.path.exists(g_statisticsfilebak):
-            os.remove(g_statisticsfilebak)
-        os.rename(statisticsfile, g_statisticsfilebak)
-    statistics = statistics or g.statistics[1]
-    statistics = [(ip, stats[0], stats[1]) for ip, stats in statistics.items()]
-    statistics.sort(key=lambda x: -(x[1]+1.0)/(x[2]**2+0.1))
-    op = 'w' if PY3 else 'wb'
-    with open(statisticsfile, op) as f:
-        for ip in statistics:
-            f.write(str(ip[0]).rjust(15))
-            f.write(' * ')
-            f.write(str(ip[1]).rjust(3))
-            f.write(' * ')
-            f.write(str(ip[2]).rjust(3))
-            f.write('\n')
+                            good, bad = 0, reputation.max_failure_ratio + 1
+                        reputation.update(ips[0], good, bad, now=min(updated, now))
+            os.remove(name)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning(u'导入统计文件 %r 失败：%r', name, e)
 
 #读取 checkgoogleip 输出 ip.txt
 def readiplist(nowgaeset):
@@ -188,29 +151,27 @@ def readiplist(nowgaeset):
                 continue
         if not ip.startswith(g_block):
             weakset.add(ip)
-    #读取待捡 IP
-    ipexset = set()
-    ipset = set()
-    if os.path.exists(g_ipexfile):
-        with open(g_ipexfile, "r") as fd:
-            for line in fd:
-                if not line.startswith(g_block):
-                    ipexset.add(line.strip('\r\n'))
-    if os.path.exists(g_ipfile):
-        with open(g_ipfile, 'r') as fd:
-            for line in fd:
-                if not line.startswith(g_block):
-                    ipset.add(line.strip('\r\n'))
-    #自动屏蔽列表、正在使用的 IP
-    ipexset = ipexset - blockset - nowgaeset - goodset
-    ipset = ipset - blockset - nowgaeset - goodset - ipexset
+    #读取待捡 IP，文本列表解析后缓存为二进制文件，再次读取时直接映射
+    ipexset = IPSet.from_file(g_ipexfile, g_ipexcachefile) if os.path.exists(g_ipexfile) else IPSet()
+    ipset = IPSet.from_file(g_ipfile, g_ipcachefile) if os.path.exists(g_ipfile) else IPSet()
+    if GC.LINK_PROFILE == 'ipv4':
+        ipexset = IPSet(v4=ipexset.v4)
+        ipset = IPSet(v4=ipset.v4)
+    elif GC.LINK_PROFILE == 'ipv6':
+        ipexset = IPSet(v6=ipexset.v6)
+        ipset = IPSet(v6=ipset.v6)
+    #屏蔽列表、自动屏蔽列表、正在使用的 IP
+    excludeset = g_blockset.union(IPSet.parse(blockset | nowgaeset | goodset))
+    ipexset = ipexset.difference(excludeset)
+    ipset = ipset.difference(excludeset).difference(ipexset)
     #排除非当前配置的遗留 IP
-    weakset = weakset & (ipset | ipexset)
-    ipexset = ipexset - weakset
-    ipset = ipset - weakset
+    weakset = [ip for ip in weakset if ip in ipset or ip in ipexset]
+    weakipset = IPSet.parse(weakset)
+    ipexset = ipexset.difference(weakipset)
+    ipset = ipset.difference(weakipset)
     g.halfweak = len(weakset)/2
     g.readtime = now
-    return list(ipexset), list(ipset), list(weakset)
+    return IPSampler(ipexset), IPSampler(ipset), weakset
 
 def readbadlist():
     ipdict = {}
@@ -251,6 +212,7 @@ def getservernamefromheader(header, headerend):
     return ''
 
 from .HTTPUtil import BaseHTTPUtil, gws_ciphers
+from .ProbeUtil import ProbeEngine
 class GAE_Finder(BaseHTTPUtil):
 
     httpreq = b'HEAD / HTTP/1.1\r\nAccept: */*\r\nHost: www.google.com\r\nConnection: Close\r\n\r\n'
@@ -326,9 +288,19 @@ class GAE_Finder(BaseHTTPUtil):
 
 gae_finder = GAE_Finder(g_useOpenSSL, g_cacertfile)
 
+#非阻塞批量探测，一个线程同时检测多个 IP
+probe_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+probe_context.verify_mode = ssl.CERT_REQUIRED
+probe_context.load_verify_locations(g_cacertfile)
+probe_context.set_ciphers(gws_ciphers)
+
+probe_engine = ProbeEngine(probe_context, 'www.google.com', GAE_Finder.httpreq,
+                           g_probes, (g_conntimeout, g_handshaketimeout, g_timeout)) if g_probes else None
+
 def runfinder(ip):
-    ssldomains, costtime, servername = gae_finder.getipinfo(ip)
-    statistics = g.statistics
+    return finderresult(ip, *gae_finder.getipinfo(ip))
+
+def finderresult(ip, ssldomains, costtime, servername):
     baddict = g.baddict
     with gLock:
         g.pingcnt -= 1
@@ -351,6 +323,8 @@ def runfinder(ip):
                 gs = 1
             if com == yt == gs == 1:
                 break
+        #只更新已有统计的 IP，较慢的 IP 由延时降低排名
+        reputation.update(ip, latency=costtime, create=False)
         #判断是否够快
         if costtime < g.maxhandletimeout:
             g.gaelist.append((ip, costtime, com, yt, gs))
@@ -362,19 +336,9 @@ def runfinder(ip):
         else:
             #备用
             g.gaelistbak.append((ip, costtime, com, yt, gs))
-            for ipdict in statistics:
-                if ip in ipdict:
-                    ipdict[ip] = max(ipdict[ip][0]-1, 0), ipdict[ip][1]
     else:
-        for ipdict in statistics:
-            if ip in ipdict:
-                 good, bad = ipdict[ip]
-                 if good < 0: break
-                 #失败次数超出预期，设置 -1 表示删除
-                 if bad/max(good, 1) > 10:
-                     ipdict[ip] = -1, 0
-                 else:
-                     ipdict[ip] = max(good-1, 0), bad+1
+        #失败次数超出预期的 IP 不再作为候选
+        reputation.update(ip, failure=1, create=False)
         if ip in baddict: # badip 容忍次数 +1
             baddict[ip] = baddict[ip][0]+1, int(time())
         else: #记录检测到 badip 的时间
@@ -393,6 +357,9 @@ class Finder(threading.Thread):
             ip = randomip()
 
 def _randomip(iplist):
+    if isinstance(iplist, IPSampler):
+        g.pingcnt += 1
+        return iplist.pop()
     cnt = len(iplist)
     #a = random.randint(0, cnt - 1)
     #b = int(random.random() * (cnt - 0.1))
@@ -422,11 +389,19 @@ def randomip():
             return _randomip(g.weaklist)
     return
 
+def probeip():
+    #跳过不符合当前 IP 类型设置的 IP
+    ip = randomip()
+    while ip and ipnotuse(ip):
+        finderresult(ip, None, 0, '')
+        ip = randomip()
+    return ip
+
 g.running = False
 #g.reloadlist = False
 g.ipmtime = 0
 g.ipexmtime = 0
-g.statistics = readstatistics()
+importstatistics()
 g.baddict = readbadlist()
 def getgaeip(nowgaelist=[], needcomcnt=0, threads=None):
     if g.running:
@@ -440,18 +415,13 @@ def getgaeip(nowgaelist=[], needcomcnt=0, threads=None):
         g.running = False
         return
     threads = int(threads) or g_maxthreads
-    #日期变更、重新加载统计文件
-    if not g.statisticsfiles[0].endswith(strftime('%y%j')):
-        savestatistics()
-        g.statistics = readstatistics()
+    g.testok = max(needgwscnt * 8, g.needcomcnt * 16)
     # goodlist 根据统计来排序已经足够，不依据 baddict 来排除 IP
     #不然干扰严重时可能过多丢弃可用 IP
     # baddict 只用来排除没有进入统计的IP 以减少尝试次数
-    statistics = g.statistics[0]
-    statistics = [(ip, stats[0], stats[1]) for ip, stats in statistics.items() if ip not in nowgaeset and stats[0] >= 0]
-    #根据统计数据排序（bad 降序、good 升序）供 pop 使用
-    statistics.sort(key=lambda x: (x[1]+1.0)/(x[2]**2+0.1))
-    g.goodlist = [ip[0] for ip in statistics]
+    #从索引取出排名靠前的 IP，倒序供 pop 使用
+    g.goodlist = [ip for ip in reputation.top(g.testok * 3, nowgaeset) if not ip.startswith(g_block)]
+    g.goodlist.reverse()
     #检查 IP 数据修改时间
     ipmtime = ipexmtime = 0
     if os.path.exists(g_ipfile):
@@ -468,29 +438,32 @@ def getgaeip(nowgaelist=[], needcomcnt=0, threads=None):
              #g.reloadlist or
              len(g.ipexlist) == len(g.iplist) == len(g.weaklist) == 0):
         g.ipexlist, g.iplist, g.weaklist = readiplist(nowgaeset)
-    del nowgaelist, nowgaeset, statistics
+    del nowgaelist, nowgaeset
     g.getgood = 0
     g.gaelist = []
     g.gaelistbak = gaelistbak = []
     g.pingcnt = 0
     g.testedok = 0
-    g.testok = max(needgwscnt * 8, g.needcomcnt * 16)
     g.maxhandletimeout = g_maxhandletimeout + timeToDelay[int(strftime('%H'))]
     PRINT(u'==================== 开始查找 GAE IP ====================')
     PRINT(u'需要查找 IP 数：%d/%d，待检测 IP 数：%d', needcomcnt, max(needgwscnt, needcomcnt), len(g.goodlist)+len(g.ipexlist)+len(g.iplist)+len(g.weaklist))
-    #多线程搜索
-    threadiplist = []
-    for i in xrange(threads):
-        ping_thread = Finder()
-        ping_thread.setDaemon(True)
-        ping_thread.setName('Ping-%s' % str(i+1).rjust(2, '0'))
-        ping_thread.start()
-        threadiplist.append(ping_thread)
-    for p in threadiplist:
-        p.join()
+    if g_probes:
+        #单线程非阻塞搜索
+        probe_engine.run(probeip, finderresult)
+        PRINT(u'各阶段探测统计：\n%s', probe_engine.status())
+    else:
+        #多线程搜索
+        threadiplist = []
+        for i in xrange(threads):
+            ping_thread = Finder()
+            ping_thread.setDaemon(True)
+            ping_thread.setName('Ping-%s' % str(i+1).rjust(2, '0'))
+            ping_thread.start()
+            threadiplist.append(ping_thread)
+        for p in threadiplist:
+            p.join()
     #结果
     savebadlist()
-    savestatistics()
     m = int(g.needcomcnt)
     if m > 0 and gaelistbak:
         #补齐个数，以 google_com 为准
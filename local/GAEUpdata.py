@@ -18,7 +18,7 @@ from .GAEFinder import (
     g as finder,
     timeToDelay,
     getgaeip,
-    savestatistics,
+    reputation,
     #savebadlist
     )
 
@@ -156,7 +156,6 @@ def testonegaeip(again=False):
     ip = GC.IPLIST_MAP['google_gws'][-1]
     timeout = gettimeout()
     badip = False
-    statistics = finder.statistics
     network_test()
     testip.queobj.queue.clear()
     http_gws.create_ssl_connection((ip, 443), 'google_gws:443', timeout/1000.0, testip.queobj)
@@ -165,22 +164,13 @@ def testonegaeip(again=False):
         logging.warning(u'测试失败（超时：%d 毫秒）%s：%s，Bad IP 已删除' % (timeout,  '.'.join(x.rjust(3) for x in ip.split('.')), result.args[0]))
         removeip(ip)
         badip = True
-        for ipdict in statistics:
-            if ip in ipdict:
-                ipdict[ip] = ipdict[ip][0], ipdict[ip][1]+1
-            else:
-                ipdict[ip] = 0, 1
+        reputation.update(ip, failure=1)
     else:
         logging.test(u'测试连接（超时：%d 毫秒）%s: %d' %(timeout,  '.'.join(x.rjust(3) for x in result[0].split('.')), int(result[1]*1000)))
         GC.IPLIST_MAP['google_gws'].insert(0, GC.IPLIST_MAP['google_gws'].pop())
         #调高 com 权重
         addn = 2 if ip in GC.IPLIST_MAP['google_com'] else 1
-        for ipdict in statistics:
-            if ip in ipdict:
-                ipdict[ip] = ipdict[ip][0]+addn, ipdict[ip][1]
-            else:
-                ipdict[ip] = addn, 0
-    savestatistics()
+        reputation.update(ip, success=addn, latency=result[1]*1000)
     testip.lasttest = time()
     #刷新开始
     needgws = max(GC.FINDER_MINIPCNT - len(GC.IPLIST_MAP['google_gws']), 0)
@@ -42,6 +42,8 @@ class GC():
     LISTEN_AUTO_PORT = CONFIG.getint('listen', 'auto_port')
     LISTEN_VISIBLE = CONFIG.getint('listen', 'visible')
     LISTEN_DEBUGINFO = CONFIG.getint('listen', 'debuginfo')
+    LISTEN_ASYNCIO = CONFIG.getboolean('listen', 'asyncio')
+    LISTEN_ASYNCIO_WORKERS = max(CONFIG.getint('listen', 'asyncio_workers'), 8)
 
     GAE_APPIDS = re.findall(r'[\w\-\.]+', CONFIG.get('gae', 'appid').replace('.appspot.com', ''))
     GAE_PASSWORD = CONFIG.get('gae', 'password').strip()
@@ -52,6 +54,16 @@ class GC():
     GAE_SSLVERIFY = CONFIG.get('gae', 'sslverify')
     GAE_FETCHMAX = CONFIG.get('gae', 'fetchmax') or 2
     GAE_MAXSIZE = CONFIG.get('gae', 'maxsize')
+    GAE_HTTP2 = CONFIG.getboolean('gae', 'http2')
+    GAE_HTTP2MAXCONN = max(CONFIG.getint('gae', 'http2_maxconn'), 1)
+    GAE_CACHE = CONFIG.getboolean('gae', 'cache')
+    GAE_CACHESIZE = max(CONFIG.getint('gae', 'cache_size'), 16)
+    GAE_COMPRESS = CONFIG.get('gae', 'compress').strip().lower()
+    if GAE_COMPRESS in ('', '0', 'false', 'off'):
+        GAE_COMPRESS = None
+    elif GAE_COMPRESS not in ('deflate', 'br', 'zstd'):
+        GAE_COMPRESS = 'deflate'
+    GAE_COMPRESSMIN = max(CONFIG.getint('gae', 'compress_min'), 256)
 
     LINK_PROFILE = CONFIG.get('link', 'profile')
     if LINK_PROFILE not in ('ipv4', 'ipv6', 'ipv46'):
@@ -64,10 +76,15 @@ class GC():
     LINK_LOCALSSLTXT = LINK_LOCALSSLTXT or 'SSLv23'
     LINK_REMOTESSLTXT = LINK_REMOTESSLTXT or 'TLSv1.2'
     LINK_LOCALSSL = SSLv[LINK_LOCALSSLTXT]
+    LINK_LOCALCERTKEY = CONFIG.get('link', 'localcertkey').strip().lower()
+    if LINK_LOCALCERTKEY != 'ecc':
+        LINK_LOCALCERTKEY = 'rsa'
     LINK_REMOTESSL = max(SSLv[LINK_REMOTESSLTXT]+1, 4) if LINK_OPENSSL else max(SSLv[LINK_REMOTESSLTXT], 3)
     LINK_TIMEOUT = max(CONFIG.getint('link', 'timeout'), 3)
     LINK_FWDTIMEOUT = max(CONFIG.getint('link', 'fwd_timeout'), 2)
     LINK_KEEPTIME = CONFIG.getint('link', 'keeptime')
+    LINK_POOLMAXHOST = max(CONFIG.getint('link', 'pool_maxhost'), 1)
+    LINK_POOLMAXSIZE = max(CONFIG.getint('link', 'pool_maxsize'), LINK_POOLMAXHOST)
 
     hosts_section, http_section = '%s/hosts' % LINK_PROFILE, '%s/http' % LINK_PROFILE
     #HOSTS_MAP = collections.OrderedDict((k, v or k) for k, v in CONFIG.items(hosts_section) if '\\' not in k and ':' not in k and not k.startswith('.'))
@@ -98,6 +115,9 @@ class GC():
     FINDER_MINIPCNT = CONFIG.getint('finder', 'minipcnt')
     FINDER_MAXTIMEOUT = CONFIG.getint('finder', 'maxtimeout') or 1000
     FINDER_THREADS = CONFIG.getint('finder', 'threads')
+    FINDER_PROBES = CONFIG.get('finder', 'probes')
+    FINDER_PROBES = tuple(max(int(x), 0) for x in FINDER_PROBES.split('|')) if FINDER_PROBES else (0,)
+    FINDER_PROBES = (FINDER_PROBES + FINDER_PROBES[-1:] * 2)[:3]
     FINDER_BLOCKTIME = CONFIG.getint('finder', 'blocktime')
     FINDER_TIMESBLOCK = CONFIG.getint('finder', 'timesblock')
     FINDER_STATDAYS = max(min(CONFIG.getint('finder', 'statdays'), 5), 2)
@@ -154,6 +174,8 @@ class GC():
     DNS_LISTEN = CONFIG.get('dns', 'listen')
     DNS_SERVERS = CONFIG.get('dns', 'servers').split('|')
     DNS_BLACKLIST = set(CONFIG.get('dns', 'blacklist').split('|'))
+    DNS_TLS_SERVERS = [x.strip() for x in CONFIG.get('dns', 'tls_servers').split('|') if x.strip()]
+    DNS_TCP_SERVERS = [x.strip() for x in CONFIG.get('dns', 'tcp_servers').split('|') if x.strip()]
 
     #USERAGENT_ENABLE = CONFIG.getint('useragent', 'enable')
     #USERAGENT_STRING = CONFIG.get('useragent', 'string')
@@ -0,0 +1,519 @@
+# coding:utf-8
+'''HTTP/2 transport, multiplex GAE requests over a few long-lived connections'''
+
+import io
+import socket
+import threading
+from select import select
+from time import time
+from . import clogging as logging
+from .GlobalConfig import GC
+from .compat import PY3, thread, httplib, xrange
+from .common import NetWorkIOError
+from .HTTPUtil import (
+    HTTPUtil,
+    gws_ciphers,
+    http_gws,
+    reaper,
+    ssl_selector
+    )
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+#不能在 HTTP/2 中使用的头域
+skip_headers = frozenset(['Host', 'Connection', 'Proxy-Connection', 'Keep-Alive', 'Transfer-Encoding', 'Upgrade'])
+
+def parse_headers(headers):
+    headers_data = b''.join(b'%s: %s\r\n' % (k, v) for k, v in headers if not k.startswith(b':')) + b'\r\n'
+    if PY3:
+        return httplib.parse_headers(io.BytesIO(headers_data))
+    else:
+        return httplib.HTTPMessage(io.BytesIO(headers_data))
+
+class HTTP2Response(object):
+    '''A stream's response, compatible with the used parts of httplib.HTTPResponse'''
+
+    #HTTP/2 的连接由连接池管理，没有可放入套接字缓存的 sock
+    sock = None
+    reason = ''
+
+    def __init__(self, connection, stream_id, timeout):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.timeout = timeout
+        self.xip = connection.xip
+        self.status = None
+        self.msg = None
+        self.buffer = []
+        self.ended = False
+        self.error = None
+
+    def read(self, amt=None):
+        connection = self.connection
+        data = []
+        size = 0
+        with connection.cond:
+            while amt is None or size < amt:
+                if not self.buffer:
+                    # 已经读到数据就先返回
+                    if self.ended or self.error or (size and amt):
+                        break
+                    connection.wait(self.timeout, u'读取响应内容')
+                    continue
+                chunk, flow_length = self.buffer[0]
+                if amt is not None and size + len(chunk) > amt:
+                    n = amt - size
+                    self.buffer[0] = chunk[n:], 0
+                    chunk = chunk[:n]
+                else:
+                    del self.buffer[0]
+                data.append(chunk)
+                size += len(chunk)
+                # 数据被取走后才扩充接收窗口，读取慢的流不会占满缓冲
+                if flow_length:
+                    connection.acknowledge(self.stream_id, flow_length)
+            if self.error and not data:
+                raise self.error
+            if self.ended and not self.buffer:
+                connection.release(self)
+        return b''.join(data)
+
+    def getheader(self, name, default=None):
+        if PY3:
+            headers = self.msg.get_all(name)
+            return ', '.join(headers) if headers else default
+        else:
+            return self.msg.getheader(name, default)
+
+    def getheaders(self):
+        return list(self.msg.items())
+
+    def close(self):
+        with self.connection.cond:
+            if not self.ended:
+                # 未读完的流直接取消，不影响同一连接中的其它流
+                self.connection.reset(self.stream_id)
+                self.ended = True
+            self.buffer = []
+            self.connection.release(self)
+
+class HTTP2Connection(object):
+    '''A HTTP/2 client connection, streams are multiplexed and flow-controlled'''
+
+    #每个流的接收窗口
+    window_size = 1024 * 1024
+    #连接的接收窗口
+    connection_window_size = 8 * 1024 * 1024
+    bufsize = 65536
+    #读取线程检查连接状态的间隔
+    interval = 1
+
+    def __init__(self, sock, xip, timeout=8):
+        self.sock = sock
+        self.xip = xip
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.streams = {}
+        self.closed = False
+        self.goaway = False
+        self.error = None
+        self.requests = 0
+        self.last_active = time()
+        config = h2.config.H2Configuration(client_side=True, header_encoding=None)
+        self.conn = h2.connection.H2Connection(config=config)
+        self.conn.local_settings = h2.settings.Settings(
+            client=True,
+            initial_values={
+                h2.settings.SettingCodes.ENABLE_PUSH: 0,
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: self.window_size,
+                })
+        self.conn.initiate_connection()
+        self.conn.increment_flow_control_window(self.connection_window_size - 65535)
+        self.flush()
+        thread.start_new_thread(self.read_loop, ())
+
+    @property
+    def load(self):
+        return len(self.streams)
+
+    @property
+    def available(self):
+        return not (self.closed or self.goaway)
+
+    @property
+    def max_streams(self):
+        return self.conn.remote_settings.max_concurrent_streams
+
+    def flush(self):
+        #调用前须持有 cond
+        data = self.conn.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def wait(self, timeout, action):
+        #调用前须持有 cond
+        if self.error:
+            raise self.error
+        start = time()
+        self.cond.wait(timeout)
+        if time() - start >= timeout:
+            raise socket.timeout(u'HTTP/2 %s超时' % action)
+
+    def check(self, response):
+        if response.error:
+            raise response.error
+        if self.error:
+            raise self.error
+
+    def request(self, method, host, path, headers, payload=None, timeout=None, weight=16):
+        timeout = timeout or self.timeout
+        h2headers = [(':method', method), (':scheme', 'https'), (':authority', host), (':path', path)]
+        h2headers.extend((k.lower(), str(v)) for k, v in headers.items() if k.title() not in skip_headers)
+        with self.cond:
+            # 遵守服务器限制的并发流数量
+            while self.conn.open_outbound_streams >= self.max_streams:
+                if not self.available:
+                    raise socket.error(u'HTTP/2 连接已关闭')
+                self.wait(timeout, u'等待空闲流')
+            if not self.available:
+                raise socket.error(u'HTTP/2 连接已关闭')
+            stream_id = self.conn.get_next_available_stream_id()
+            response = HTTP2Response(self, stream_id, timeout)
+            self.streams[stream_id] = response
+            self.requests += 1
+            self.last_active = time()
+            try:
+                self.conn.send_headers(stream_id, h2headers, end_stream=not payload, priority_weight=weight)
+                self.flush()
+                if payload:
+                    self.send_body(response, payload, timeout)
+                while response.status is None:
+                    self.check(response)
+                    self.wait(timeout, u'等待响应头')
+            except Exception:
+                self.release(response)
+                raise
+        return response
+
+    def send_body(self, response, payload, timeout):
+        #调用前须持有 cond
+        stream_id = response.stream_id
+        #可以是多段缓冲，逐段发送不做合并
+        buffers = payload if isinstance(payload, list) else (payload,)
+        for payload in buffers:
+            payload = memoryview(payload)
+            length = len(payload)
+            offset = 0
+            while offset < length:
+                self.check(response)
+                window = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+                if window <= 0:
+                    # 发送窗口用完，等待服务器扩充
+                    self.wait(timeout, u'等待发送窗口')
+                    continue
+                self.conn.send_data(stream_id, payload[offset:offset+window].tobytes())
+                offset += window
+                self.flush()
+        self.conn.end_stream(stream_id)
+        self.flush()
+
+    def acknowledge(self, stream_id, size):
+        #调用前须持有 cond
+        if not self.closed:
+            self.conn.acknowledge_received_data(size, stream_id)
+            self.flush()
+
+    def reset(self, stream_id):
+        #调用前须持有 cond
+        if not self.closed:
+            try:
+                self.conn.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+                self.flush()
+            except h2.exceptions.StreamClosedError:
+                pass
+            except NetWorkIOError as e:
+                self.close(e)
+
+    def release(self, response):
+        #调用前须持有 cond
+        if self.streams.pop(response.stream_id, None):
+            self.last_active = time()
+            self.cond.notify_all()
+
+    def handle_event(self, event):
+        #调用前须持有 cond
+        response = self.streams.get(getattr(event, 'stream_id', None))
+        if isinstance(event, h2.events.ResponseReceived):
+            if response:
+                for k, v in event.headers:
+                    if k == b':status':
+                        response.status = int(v)
+                response.msg = parse_headers(event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            if response:
+                response.buffer.append((event.data, event.flow_controlled_length))
+            else:
+                # 已取消的流，直接归还接收窗口
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            if response:
+                response.ended = True
+        elif isinstance(event, h2.events.StreamReset):
+            if response:
+                response.error = socket.error(u'HTTP/2 流被重置：%s' % event.error_code)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.goaway = True
+            error = socket.error(u'HTTP/2 连接被终止：%s' % event.error_code)
+            for stream_id, response in self.streams.items():
+                if event.last_stream_id is None or stream_id > event.last_stream_id:
+                    response.error = error
+
+    def read_loop(self):
+        sock = self.sock
+        # 普通套接字没有 pending 方法
+        pending = getattr(sock, 'pending', lambda: 0)
+        while not self.closed:
+            try:
+                if not pending():
+                    ins, _, _ = select([sock], [], [], self.interval)
+                    if not ins:
+                        continue
+                with self.cond:
+                    try:
+                        data = sock.recv(self.bufsize)
+                    except socket.timeout:
+                        continue
+                    if not data:
+                        raise socket.error(u'HTTP/2 连接被远程关闭')
+                    for event in self.conn.receive_data(data):
+                        self.handle_event(event)
+                    self.flush()
+                    self.cond.notify_all()
+            except Exception as e:
+                self.close(e)
+
+    def close(self, error=None):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = error or socket.error(u'HTTP/2 连接已关闭')
+            for response in self.streams.values():
+                if not response.ended:
+                    response.error = self.error
+            if error is None:
+                try:
+                    self.conn.close_connection()
+                    self.flush()
+                except Exception:
+                    pass
+            self.cond.notify_all()
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+class HTTP2Util(object):
+    '''Send GAE requests over shared HTTP/2 connections, fallback to HTTP/1.1'''
+
+    cache_key = 'google_gws_h2:443'
+    #新建连接前，单个连接上希望承载的最多流数量
+    soft_streams = 16
+    #交互请求优先于 RangeFetch 分块
+    fetch_weight = 128
+    range_weight = 16
+    #服务器不支持 HTTP/2 时回退的时间
+    fallback_time = 10 * 60
+
+    def __init__(self, max_connections, keeptime, max_timeout=8, max_retry=2):
+        self.max_connections = max_connections
+        self.keeptime = keeptime
+        self.max_timeout = max_timeout
+        self.max_retry = max_retry
+        self.http_util = HTTPUtil(GC.LINK_WINDOW, max_timeout, GC.proxy, gws_ciphers, alpn=['h2', 'http/1.1'])
+        self.connections = []
+        self.lock = threading.Condition()
+        #正在建立的连接，与已有连接一起计入上限
+        self.connecting = 0
+        self.fallback_until = 0
+        self.created = 0
+        reaper.reporters.append(self)
+
+    @property
+    def enabled(self):
+        return time() > self.fallback_until
+
+    def _prune(self):
+        #调用前须持有 lock
+        now = time()
+        for connection in self.connections[:]:
+            if connection.load == 0 and (not connection.available or now - connection.last_active > self.keeptime):
+                self.connections.remove(connection)
+                connection.close()
+
+    def get_connection(self, host, timeout):
+        deadline = time() + timeout
+        with self.lock:
+            while True:
+                self._prune()
+                connections = [c for c in self.connections if c.available]
+                total = len(connections) + self.connecting
+                if connections:
+                    connection = min(connections, key=lambda c: c.load)
+                    if connection.load < self.soft_streams or total >= self.max_connections:
+                        return connection
+                if total < self.max_connections:
+                    break
+                #连接数已满且都在建立中，等待其中一个完成
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return
+                self.lock.wait(remaining)
+            #在锁内预留名额，并发的调用不会超过上限
+            self.connecting += 1
+        connection = None
+        try:
+            ssl_sock = self.http_util.create_ssl_connection((host, 443), self.cache_key, timeout)
+            if ssl_sock is None:
+                return
+            if self.http_util.get_alpn_protocol(ssl_sock) != 'h2':
+                ssl_sock.sock.close()
+                self.fallback_until = time() + self.fallback_time
+                logging.warning(u'%s 未协商到 HTTP/2，%d 秒内回退到 HTTP/1.1', ssl_sock.xip[0], self.fallback_time)
+                return
+            connection = HTTP2Connection(ssl_sock, ssl_sock.xip, timeout)
+            return connection
+        finally:
+            with self.lock:
+                self.connecting -= 1
+                if connection:
+                    self.connections.append(connection)
+                    self.created += 1
+                self.lock.notify_all()
+
+    def request(self, request_params, payload=None, headers={}, bufsize=8192, crlf=None, connection_cache_key=None, timeout=None, rangefetch=None, realurl=None):
+        if not self.enabled:
+            return http_gws.request(request_params, payload, headers, bufsize, crlf, connection_cache_key, timeout, rangefetch, realurl)
+        host = request_params.host
+        method = request_params.command
+        url = request_params.url
+        timeout = timeout or self.max_timeout
+        if payload and not isinstance(payload, (bytes, list)):
+            payload = payload.encode()
+        weight = self.range_weight if rangefetch else self.fetch_weight
+        for i in xrange(self.max_retry):
+            connection = None
+            try:
+                connection = self.get_connection(host, timeout)
+                if connection is None:
+                    if not self.enabled:
+                        return http_gws.request(request_params, payload, headers, bufsize, crlf, connection_cache_key, timeout, rangefetch, realurl)
+                    continue
+                return connection.request(method, host, request_params.path, headers, payload, timeout, weight)
+            except Exception as e:
+                if connection:
+                    ip = connection.xip
+                    # 连接出错时关闭，超时只放弃当前流
+                    if not isinstance(e, socket.timeout):
+                        connection.close(e)
+                    if realurl:
+                        ssl_selector.failure(ip)
+                    logging.warning(u'%s HTTP/2 request "%s %s" 失败：%r', ip[0], method, realurl or url, e)
+                else:
+                    logging.warning(u'HTTP/2 create_ssl connection %r 失败：%r', realurl or url, e)
+
+    def status(self):
+        with self.lock:
+            connections = self.connections[:]
+        requests = sum(c.requests for c in connections)
+        return u'HTTP/2 连接：%d 个（累计新建 %d），活动流：%d，请求：%d' % (
+                   len(connections), self.created, sum(c.load for c in connections), requests)
+
+if GC.GAE_HTTP2 and h2 is None:
+    logging.warning(u'没有找到 h2 模块，无法使用 HTTP/2 连接 GAE')
+http2_gws = HTTP2Util(GC.GAE_HTTP2MAXCONN, GC.GAE_KEEPTIME, GC.LINK_TIMEOUT) if GC.GAE_HTTP2 and h2 else None
+
+def test(concurrency=20, size=300*1024):
+    '''Run concurrent requests against a local h2c stand-in server'''
+    import os
+    import hashlib
+
+    def serve(sock):
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, True)
+        config = h2.config.H2Configuration(client_side=False, header_encoding=None)
+        conn = h2.connection.H2Connection(config=config)
+        conn.initiate_connection()
+        sock.sendall(conn.data_to_send())
+        bodies = {}
+        pending = {}
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    bodies[event.stream_id] = []
+                elif isinstance(event, h2.events.DataReceived):
+                    bodies[event.stream_id].append(event.data)
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    # 返回请求内容的摘要和请求内容本身
+                    body = b''.join(bodies.pop(event.stream_id))
+                    conn.send_headers(event.stream_id, [(b':status', b'200'), (b'content-length', str(len(body)).encode()), (b'x-sha1', hashlib.sha1(body).hexdigest().encode())])
+                    pending[event.stream_id] = memoryview(body)
+                elif isinstance(event, h2.events.StreamReset):
+                    pending.pop(event.stream_id, None)
+            for stream_id, body in list(pending.items()):
+                window = min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+                while window > 0 and body:
+                    conn.send_data(stream_id, body[:window].tobytes())
+                    body = body[window:]
+                    window = min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+                pending[stream_id] = body
+                if not body:
+                    conn.end_stream(stream_id)
+                    del pending[stream_id]
+            sock.sendall(conn.data_to_send())
+        sock.close()
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    address = listener.getsockname()
+    def accept():
+        while True:
+            sock, _ = listener.accept()
+            thread.start_new_thread(serve, (sock,))
+    thread.start_new_thread(accept, ())
+
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, True)
+    connection = HTTP2Connection(sock, address)
+    results = []
+    def fetch(i):
+        payload = os.urandom(size + i)
+        response = connection.request('POST', 'localhost', '/', {'Content-Length': len(payload)}, payload, weight=16+i)
+        data = response.read()
+        ok = response.status == 200 and data == payload and response.getheader('X-Sha1') == hashlib.sha1(payload).hexdigest()
+        results.append(ok)
+    start = time()
+    threads = [threading.Thread(target=fetch, args=(i,)) for i in xrange(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cost = time() - start
+    logging.info('%d/%d streams ok over 1 connection, %d bytes each way in %.2fs', results.count(True), concurrency, size * concurrency, cost)
+    connection.close()
+    return results.count(True) == concurrency
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,479 @@
+# coding:utf-8
+'''RFC 7234 disk cache for responses fetched through GAE'''
+
+import os
+import re
+import mmap
+import struct
+import hashlib
+import threading
+import collections
+from time import time
+from email.utils import parsedate_tz, mktime_tz
+from . import clogging as logging
+from .common import data_dir
+from .GlobalConfig import GC
+from .HTTPUtil import reaper
+
+#可以缓存的状态码
+cacheable_status = (200, 203, 300, 301, 404, 410)
+#不保存的头域，长度按实际缓存内容重新生成，Age 保存为收到时的年龄
+skip_headers = ('Connection', 'Keep-Alive', 'Proxy-Connection', 'Transfer-Encoding',
+                'Content-Length', 'Set-Cookie', 'Upgrade', 'Te', 'Trailer')
+#启发式有效期上限
+heuristic_max = 86400
+getdirectives = re.compile(r'([\w-]+)\s*(?:=\s*("[^"]*"|[^,\s]*))?').findall
+
+def parse_cache_control(value):
+    return dict((k.lower(), v.strip('"')) for k, v in getdirectives(value or ''))
+
+def parse_date(value):
+    try:
+        return mktime_tz(parsedate_tz(value))
+    except Exception:
+        pass
+
+def freshness_lifetime(status, headers, now):
+    '''Return how long a response is fresh, 0 means it must be revalidated'''
+    cc = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-cache' in cc:
+        return 0
+    if 'max-age' in cc:
+        try:
+            return max(int(cc['max-age']), 0)
+        except ValueError:
+            return 0
+    date = parse_date(headers.get('Date')) or now
+    if 'Expires' in headers:
+        expires = parse_date(headers['Expires'])
+        return max(expires - date, 0) if expires else 0
+    last_modified = parse_date(headers.get('Last-Modified'))
+    if last_modified and status in cacheable_status:
+        return min(max(date - last_modified, 0) / 10, heuristic_max)
+    return 0
+
+def initial_age(headers, now):
+    '''Age of a response when received, from Age and Date (RFC 7234 4.2.3)'''
+    try:
+        age = max(int(headers.get('Age', 0)), 0)
+    except ValueError:
+        age = 0
+    date = parse_date(headers.get('Date'))
+    if date:
+        age = max(age, now - date)
+    return int(age)
+
+def set_age(headers, age):
+    if age:
+        headers['Age'] = str(age)
+    else:
+        headers.pop('Age', None)
+
+class CacheEntry(object):
+    '''A cached response found in the index'''
+    __slots__ = 'key', 'slot', 'body', 'size', 'stored', 'expires', 'status', 'headers', 'validated'
+
+    def __init__(self, key, slot, body, size, stored, expires, status, headers):
+        self.key = key
+        self.slot = slot
+        self.body = body
+        self.size = size
+        self.stored = stored
+        self.expires = expires
+        self.status = status
+        self.headers = headers
+        #已经为本次请求加上了验证头域
+        self.validated = False
+
+    def age(self, now):
+        try:
+            age = int(self.headers.get('Age', 0))
+        except ValueError:
+            age = 0
+        return age + int(now - self.stored)
+
+    def fresh(self, request_headers, now):
+        cc = parse_cache_control(request_headers.get('Cache-Control'))
+        if 'no-cache' in cc or request_headers.get('Pragma', '').lower() == 'no-cache':
+            return False
+        if 'max-age' in cc:
+            try:
+                if self.age(now) > int(cc['max-age']):
+                    return False
+            except ValueError:
+                return False
+        return now < self.expires
+
+    def add_validators(self, request_headers):
+        '''Make the request conditional, unless the client already did'''
+        if 'If-None-Match' in request_headers or 'If-Modified-Since' in request_headers:
+            return False
+        if 'Etag' in self.headers:
+            request_headers['If-None-Match'] = self.headers['Etag']
+            self.validated = True
+        if 'Last-Modified' in self.headers:
+            request_headers['If-Modified-Since'] = self.headers['Last-Modified']
+            self.validated = True
+        return self.validated
+
+    def not_modified(self, request_headers):
+        '''Whether the client's own conditional request matches this entry'''
+        etag = self.headers.get('Etag')
+        if_none_match = request_headers.get('If-None-Match')
+        if if_none_match:
+            return bool(etag) and (if_none_match.strip() == '*' or etag in [x.strip() for x in if_none_match.split(',')])
+        if_modified_since = parse_date(request_headers.get('If-Modified-Since'))
+        last_modified = parse_date(self.headers.get('Last-Modified'))
+        return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+class CacheWriter(object):
+    '''Write a response body to a temporary file while it is relayed'''
+
+    def __init__(self, cache, key, status, headers, stored, expires):
+        self.cache = cache
+        self.key = key
+        self.status = status
+        self.headers = headers
+        self.stored = stored
+        self.expires = expires
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.filename = os.path.join(cache.tmp_dir, '%s.%d' % (key.hex() if hasattr(key, 'hex') else key.encode('hex'), id(self)))
+        self.fp = open(self.filename, 'wb')
+
+    def tee(self, read):
+        '''Wrap response.read, copy what the client receives into the cache'''
+        def tee_read(amt=None):
+            data = read(amt)
+            if data and self.fp:
+                try:
+                    self.fp.write(data)
+                    self.sha1.update(data)
+                    self.size += len(data)
+                    if self.size > self.cache.max_item_size:
+                        self.abort()
+                except Exception as e:
+                    logging.warning(u'写入缓存失败：%r', e)
+                    self.abort()
+            return data
+        return tee_read
+
+    def commit(self):
+        if not self.fp:
+            return
+        self.fp.close()
+        self.fp = None
+        length = self.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) != self.size:
+            #内容不完整
+            os.remove(self.filename)
+            return
+        self.cache.add(self)
+
+    def abort(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+            os.remove(self.filename)
+
+class HTTPCache(object):
+    '''Cache with a memory-mapped index and content-addressed body files'''
+
+    #索引记录：键、内容 sha1、大小、保存时间、过期时间、最后使用时间、状态码、头域长度，之后是头域
+    record = struct.Struct('!20s20sQdddHH')
+    record_size = 1024
+    header_max = record_size - record.size
+    used_offset = struct.calcsize('!20s20sQdd')
+
+    def __init__(self, path, max_size, slots=None):
+        self.path = path
+        self.max_size = max_size
+        self.max_item_size = max_size // 8
+        self.slots = slots or min(max(max_size // 16384, 1024), 65536)
+        self.body_dir = os.path.join(path, 'bodies')
+        self.tmp_dir = os.path.join(path, 'tmp')
+        for dir in (self.body_dir, self.tmp_dir):
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name))
+        self.lock = threading.Lock()
+        #按最后使用时间排列，最近使用的在末尾
+        self.entries = collections.OrderedDict()
+        self.refs = collections.defaultdict(int)
+        self.free = []
+        self.total = 0
+        self.requests = self.hits = self.not_modified = self.revalidated = 0
+        self.bytes_saved = self.fetches_avoided = 0
+        self.open_index()
+        reaper.reporters.append(self)
+
+    def open_index(self):
+        filename = os.path.join(self.path, 'index')
+        length = self.slots * self.record_size
+        if not os.path.isfile(filename) or os.path.getsize(filename) != length:
+            #大小改变后重建
+            with open(filename, 'wb') as fp:
+                fp.truncate(length)
+        self.index_file = open(filename, 'r+b')
+        self.index = mmap.mmap(self.index_file.fileno(), length)
+        records = []
+        empty = b'\x00' * 20
+        for slot in range(self.slots):
+            offset = slot * self.record_size
+            key, body, size, stored, expires, used, status, hlen = self.record.unpack_from(self.index, offset)
+            if key == empty:
+                self.free.append(slot)
+            elif not os.path.isfile(self.body_path(body)):
+                self.clear_slot(slot)
+            else:
+                records.append((used, key, slot, body, size))
+        records.sort()
+        for used, key, slot, body, size in records:
+            self.entries[key] = slot
+            self.refs[body] += 1
+            self.total += size
+        #删除没有被索引引用的内容文件
+        for dirname in os.listdir(self.body_dir):
+            for name in os.listdir(os.path.join(self.body_dir, dirname)):
+                try:
+                    if bytes(bytearray.fromhex(name)) not in self.refs:
+                        os.remove(os.path.join(self.body_dir, dirname, name))
+                except ValueError:
+                    pass
+        self.free.reverse()
+        with self.lock:
+            self.evict()
+
+    def body_path(self, body):
+        name = ''.join('%02x' % c for c in bytearray(body))
+        return os.path.join(self.body_dir, name[:2], name)
+
+    def cache_key(self, url, request_headers):
+        #按 Accept-Encoding 区分，不用处理 Vary: Accept-Encoding
+        key = '%s\n%s' % (url, request_headers.get('Accept-Encoding', ''))
+        return hashlib.sha1(key.encode('utf-8')).digest()
+
+    def clear_slot(self, slot):
+        offset = slot * self.record_size
+        self.index[offset:offset+20] = b'\x00' * 20
+        self.free.append(slot)
+
+    def read_slot(self, key, slot):
+        offset = slot * self.record_size
+        _, body, size, stored, expires, used, status, hlen = self.record.unpack_from(self.index, offset)
+        start = offset + self.record.size
+        headers = {}
+        for line in self.index[start:start+hlen].decode('utf-8').split('\r\n'):
+            k, _, v = line.partition(': ')
+            headers[k] = v
+        return CacheEntry(key, slot, body, size, stored, expires, status, headers)
+
+    def write_slot(self, slot, key, body, size, stored, expires, status, header_data):
+        offset = slot * self.record_size
+        self.record.pack_into(self.index, offset, key, body, size, stored, expires, time(), status, len(header_data))
+        start = offset + self.record.size
+        self.index[start:start+len(header_data)] = header_data
+
+    def lookup(self, url, request_headers):
+        key = self.cache_key(url, request_headers)
+        with self.lock:
+            self.requests += 1
+            slot = self.entries.get(key)
+            if slot is None:
+                return
+            entry = self.read_slot(key, slot)
+            self.entries[key] = self.entries.pop(key)
+            struct.pack_into('!d', self.index, slot * self.record_size + self.used_offset, time())
+        return entry
+
+    def open_body(self, entry):
+        return open(self.body_path(entry.body), 'rb')
+
+    def record_hit(self, entry, not_modified=False, revalidated=False):
+        with self.lock:
+            if revalidated:
+                #仍然请求了 GAE，只节省了内容
+                self.revalidated += 1
+            else:
+                self.fetches_avoided += 1
+                if not_modified:
+                    self.not_modified += 1
+                else:
+                    self.hits += 1
+            self.bytes_saved += entry.size
+
+    def pack_headers(self, headers):
+        header_data = '\r\n'.join('%s: %s' % (k, v) for k, v in headers.items()).encode('utf-8')
+        if len(header_data) <= self.header_max:
+            return header_data
+
+    def store(self, url, request_headers, response):
+        '''Return a CacheWriter if the response may be stored'''
+        if response.status not in cacheable_status or hasattr(response, 'data'):
+            return
+        request_cc = parse_cache_control(request_headers.get('Cache-Control'))
+        cc = parse_cache_control(response.getheader('Cache-Control'))
+        if 'no-store' in request_cc or 'no-store' in cc:
+            return
+        if response.getheader('Set-Cookie'):
+            return
+        vary = response.getheader('Vary')
+        if vary and any(x.strip().lower() not in ('accept-encoding', '') for x in vary.split(',')):
+            return
+        headers = dict((k.title(), v) for k, v in response.getheaders() if k.title() not in skip_headers)
+        if 'Content-Length' in response.msg:
+            headers['Content-Length'] = response.getheader('Content-Length')
+        now = time()
+        age = initial_age(headers, now)
+        set_age(headers, age)
+        #上游已经缓存过的时间要从有效期中扣除
+        lifetime = max(freshness_lifetime(response.status, headers, now) - age, 0)
+        if not lifetime and 'Etag' not in headers and 'Last-Modified' not in headers:
+            #不能保持新鲜也无法验证
+            return
+        length = headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > self.max_item_size:
+            return
+        if self.pack_headers(headers) is None:
+            return
+        key = self.cache_key(url, request_headers)
+        try:
+            return CacheWriter(self, key, response.status, headers, now, now + lifetime)
+        except Exception as e:
+            logging.warning(u'创建缓存文件失败：%r', e)
+
+    def add(self, writer):
+        body = writer.sha1.digest()
+        filename = self.body_path(body)
+        headers = writer.headers.copy()
+        headers.pop('Content-Length', None)
+        header_data = self.pack_headers(headers)
+        with self.lock:
+            if os.path.isfile(filename):
+                #相同内容只保存一份
+                os.remove(writer.filename)
+            else:
+                dirname = os.path.dirname(filename)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                os.rename(writer.filename, filename)
+            #先增加引用，释放旧条目时不会删除共用的内容文件
+            self.refs[body] += 1
+            old_slot = self.entries.pop(writer.key, None)
+            if old_slot is not None:
+                self.release(old_slot)
+            elif not self.free:
+                self.evict_one()
+            slot = self.free.pop()
+            self.write_slot(slot, writer.key, body, writer.size, writer.stored, writer.expires, writer.status, header_data)
+            self.entries[writer.key] = slot
+            self.total += writer.size
+            self.evict()
+
+    def refresh(self, entry, response):
+        '''Update a stored response with the headers of a 304'''
+        headers = dict((k.title(), v) for k, v in response.getheaders())
+        for k, v in headers.items():
+            if k not in skip_headers:
+                entry.headers[k] = v
+        now = time()
+        #年龄只按 304 自己的头域计算
+        age = initial_age(headers, now)
+        set_age(entry.headers, age)
+        entry.stored = now
+        entry.expires = now + max(freshness_lifetime(entry.status, entry.headers, now) - age, 0)
+        header_data = self.pack_headers(entry.headers)
+        if header_data is None:
+            return
+        with self.lock:
+            if self.entries.get(entry.key) == entry.slot:
+                self.write_slot(entry.slot, entry.key, entry.body, entry.size, entry.stored, entry.expires, entry.status, header_data)
+
+    def release(self, slot):
+        #调用前须持有 lock
+        _, body, size = self.record.unpack_from(self.index, slot * self.record_size)[:3]
+        self.clear_slot(slot)
+        self.total -= size
+        self.refs[body] -= 1
+        if self.refs[body] <= 0:
+            del self.refs[body]
+            try:
+                os.remove(self.body_path(body))
+            except OSError:
+                pass
+
+    def evict_one(self):
+        #调用前须持有 lock
+        key, slot = self.entries.popitem(last=False)
+        self.release(slot)
+
+    def evict(self):
+        #调用前须持有 lock
+        while self.total > self.max_size and self.entries:
+            self.evict_one()
+
+    def hitrate(self):
+        return self.fetches_avoided / float(self.requests or 1)
+
+    def status(self):
+        with self.lock:
+            return u'GAE 缓存：%d 项 %.1fMB，命中 %d，本地 304 %d，验证 %d，请求 %d（%.1f%%），节省 %.1fMB' % (
+                   len(self.entries), self.total / 1048576.0, self.hits, self.not_modified,
+                   self.revalidated, self.requests, self.hitrate() * 100, self.bytes_saved / 1048576.0)
+
+http_cache = HTTPCache(os.path.join(data_dir, 'cache'), GC.GAE_CACHESIZE * 1048576) if GC.GAE_CACHE else None
+
+def test():
+    '''Store the same response twice, the entry must still be served'''
+    import shutil
+    import tempfile
+
+    class Response(object):
+        status = 200
+        def __init__(self, data, *headers):
+            self.data_ = data
+            self.msg = {'Content-Length': str(len(data))}
+            self.headers = [('Content-Length', str(len(data))), ('Cache-Control', 'max-age=600')] + list(headers)
+        def getheader(self, name, default=None):
+            return dict(self.headers).get(name, default)
+        def getheaders(self):
+            return self.headers
+        def read(self, amt=None):
+            data, self.data_ = self.data_, b''
+            return data
+
+    tmpdir = tempfile.mkdtemp()
+    cache = HTTPCache(tmpdir, 1048576)
+    try:
+        url = 'http://www.example.com/same'
+        data = os.urandom(4096)
+        for i in range(2):
+            writer = cache.store(url, {}, Response(data))
+            writer.tee(Response(data).read)()
+            writer.commit()
+            entry = cache.lookup(url, {})
+            assert entry and entry.fresh({}, time()), u'第 %d 次保存后没有命中' % (i + 1)
+            with cache.open_body(entry) as fp:
+                assert fp.read() == data, u'第 %d 次保存后内容不一致' % (i + 1)
+        assert len(cache.entries) + len(cache.free) == cache.slots, u'索引槽位重复'
+        logging.info(u'重复保存同一响应后仍可命中：%s', cache.status())
+
+        #上游已缓存 590 秒，只剩 10 秒有效期
+        url = 'http://www.example.com/aged'
+        writer = cache.store(url, {}, Response(data, ('Age', '590')))
+        writer.tee(Response(data).read)()
+        writer.commit()
+        entry = cache.lookup(url, {})
+        now = time()
+        assert entry.fresh({}, now) and not entry.fresh({}, now + 20), u'没有扣除上游的 Age'
+        assert 590 <= entry.age(now) < 600, u'缓存年龄错误：%d' % entry.age(now)
+        logging.info(u'带 Age 的响应按剩余有效期缓存：%ds', entry.expires - now)
+    finally:
+        reaper.reporters.remove(cache)
+        cache.index.close()
+        cache.index_file.close()
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
@@ -9,6 +9,11 @@ import socket
 import ssl
 import struct
 import random
+import heapq
+import itertools
+import threading
+import collections
+import select as select_module
 import OpenSSL
 from . import clogging as logging
 from select import select
@@ -31,6 +36,119 @@ from .common import (
     spawn_later
     )
 
+#合并发送的小数据上限
+join_limit = 65536
+#一次 sendmsg 的最大缓冲数量
+iov_max = 1024
+
+def sendall_buffers(sock, buffers):
+    '''Send buffers in order without joining the large ones'''
+    if isinstance(sock, socket.socket) and hasattr(sock, 'sendmsg') and not isinstance(sock, ssl.SSLSocket):
+        #明文套接字使用 scatter-gather 发送
+        buffers = [memoryview(buf) for buf in buffers if buf]
+        while buffers:
+            sent = sock.sendmsg(buffers[:iov_max])
+            while sent:
+                n = len(buffers[0])
+                if sent >= n:
+                    sent -= n
+                    del buffers[0]
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+        return
+    #加密套接字只合并小块数据，大块数据直接发送
+    data = b''
+    for buf in buffers:
+        if len(data) + len(buf) <= join_limit:
+            data += buf
+        else:
+            if data:
+                sock.sendall(data)
+            data = buf
+    if data:
+        sock.sendall(data)
+
+class RequestBody(object):
+    '''Read a request body from the client in pieces'''
+
+    bufsize = 65536
+
+    def __init__(self, rfile, length=0, chunked=False):
+        self.rfile = rfile
+        self.length = length
+        self.chunked = chunked
+        #剩余的长度或当前块的剩余长度
+        self.left = length
+        #已经开始读取，不能重放
+        self.started = False
+        self.finished = not (length or chunked)
+        self.data = None
+
+    def __bool__(self):
+        return bool(self.length or self.chunked)
+
+    __nonzero__ = __bool__
+
+    def read(self, size=None):
+        '''Return the next raw piece, chunked framing is passed through'''
+        if self.finished:
+            return b''
+        self.started = True
+        size = size or self.bufsize
+        if not self.chunked:
+            data = self.rfile.read(min(size, self.left))
+            if not data:
+                raise NetWorkIOError(errno.ECONNABORTED, u'请求主体读取不完整')
+            self.left -= len(data)
+            self.finished = self.left == 0
+            return data
+        if self.left == 0:
+            line = self.rfile.readline(65537)
+            if not line.endswith(b'\n'):
+                raise NetWorkIOError(errno.ECONNABORTED, u'无效的请求分块')
+            self.left = int(line.split(b';', 1)[0], 16)
+            if self.left == 0:
+                #最后一块和可能存在的尾部头域
+                while line not in (b'\r\n', b'\n', b''):
+                    line = self.rfile.readline(65537)
+                self.finished = True
+                return b'0\r\n\r\n'
+            #块数据后面的换行一起读取
+            self.left += 2
+            return line + self.read(size)
+        data = self.rfile.read(min(size, self.left))
+        if not data:
+            raise NetWorkIOError(errno.ECONNABORTED, u'请求分块读取不完整')
+        self.left -= len(data)
+        return data
+
+    def readall(self):
+        '''Return the whole decoded body'''
+        if self.data is not None:
+            return self.data
+        if self.started:
+            raise NetWorkIOError(errno.ECONNABORTED, u'请求主体已经部分发送，不能重新读取')
+        self.started = True
+        if not self.chunked:
+            self.data = self.rfile.read(self.length)
+        else:
+            chunks = []
+            while True:
+                line = self.rfile.readline(65537)
+                if not line.endswith(b'\n'):
+                    raise NetWorkIOError(errno.ECONNABORTED, u'无效的请求分块')
+                size = int(line.split(b';', 1)[0], 16)
+                if size == 0:
+                    while line not in (b'\r\n', b'\n', b''):
+                        line = self.rfile.readline(65537)
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline(3)
+            self.data = b''.join(chunks)
+        self.finished = True
+        return self.data
+
 class BaseHTTPUtil(object):
     """Basic HTTP Request Class"""
 
@@ -72,10 +190,11 @@ class BaseHTTPUtil(object):
                             #'DES-CBC3-SHA',
                             'TLS_EMPTY_RENEGOTIATION_INFO_SCSV'])
 
-    def __init__(self, use_openssl=None, cacert=None, ssl_ciphers=None):
+    def __init__(self, use_openssl=None, cacert=None, ssl_ciphers=None, alpn=None):
         # http://docs.python.org/dev/library/ssl.html
         # http://www.openssl.org/docs/apps/ciphers.html
         self.cacert = cacert
+        self.alpn = alpn
         if ssl_ciphers:
             self.ssl_ciphers = ssl_ciphers
         if use_openssl:
@@ -83,6 +202,10 @@ class BaseHTTPUtil(object):
             self.set_ssl_option = self.set_openssl_option
             self.get_ssl_socket = self.get_openssl_socket
             self.get_peercert = self.get_openssl_peercert
+            self.get_ssl_session = self.get_openssl_session
+            self.set_ssl_session = self.set_openssl_session
+            self.ssl_session_reused = self.openssl_session_reused
+            self.get_alpn_protocol = self.get_openssl_alpn_protocol
         self.set_ssl_option()
 
     def set_ssl_option(self):
@@ -93,6 +216,9 @@ class BaseHTTPUtil(object):
             self.ssl_context.load_verify_locations(self.cacert)
         #obfuscate
         self.ssl_context.set_ciphers(self.ssl_ciphers)
+        #protocol negotiation
+        if self.alpn:
+            self.ssl_context.set_alpn_protocols(self.alpn)
 
     def set_openssl_option(self):
         self.ssl_context = OpenSSL.SSL.Context(GC.LINK_REMOTESSL)
@@ -106,6 +232,9 @@ class BaseHTTPUtil(object):
             self.ssl_context.set_verify(OpenSSL.SSL.VERIFY_PEER, lambda c, x, e, d, ok: ok)
         #obfuscate
         self.ssl_context.set_cipher_list(self.ssl_ciphers)
+        #protocol negotiation
+        if self.alpn:
+            self.ssl_context.set_alpn_protos([p.encode() for p in self.alpn])
 
     def get_ssl_socket(self, sock, server_hostname=None):
         return self.ssl_context.wrap_socket(sock, do_handshake_on_connect=False, server_hostname=server_hostname)
@@ -122,93 +251,343 @@ class BaseHTTPUtil(object):
     def get_openssl_peercert(self, sock):
         return sock.get_peer_certificate()
 
+    def get_alpn_protocol(self, sock):
+        return sock.selected_alpn_protocol()
+
+    def get_openssl_alpn_protocol(self, sock):
+        protocol = sock.get_alpn_proto_negotiated()
+        return protocol.decode() if protocol else None
+
+    def get_ssl_session(self, sock):
+        # python 3.6 以下不支持会话复用
+        return getattr(sock, 'session', None)
+
+    def get_openssl_session(self, sock):
+        return sock.get_session()
+
+    def set_ssl_session(self, sock, session):
+        try:
+            sock.session = session
+        except (AttributeError, ValueError):
+            pass
+
+    def set_openssl_session(self, sock, session):
+        sock.set_session(session)
+
+    def ssl_session_reused(self, sock):
+        return getattr(sock, 'session_reused', False)
+
+    def openssl_session_reused(self, sock):
+        # pyOpenSSL 没有提供相应的接口
+        try:
+            return bool(OpenSSL.SSL._lib.SSL_session_reused(sock._connection._ssl))
+        except AttributeError:
+            return False
+
 linkkeeptime = GC.LINK_KEEPTIME
 gaekeeptime = GC.GAE_KEEPTIME
-cachetimeout = GC.FINDER_MAXTIMEOUT * 1.2 / 1000
-import collections
-from .common import LRUCache
-tcp_connection_time = LRUCache(256)
-ssl_connection_time = LRUCache(256)
-tcp_connection_cache = collections.defaultdict(collections.deque)
-ssl_connection_cache = collections.defaultdict(collections.deque)
-
-def check_tcp_connection_cache():
-    '''check and close unavailable connection continued forever'''
-    while True:
-        sleep(10)
-        #将键名放入元组
-        keys = None
-        while keys is None:
-            try:
-                keys = tuple(key for key in tcp_connection_cache)
-            except:
-                sleep(0.01)
-        for cache_key in keys:
-            keeptime = gaekeeptime if cache_key.startswith('google') else linkkeeptime
-            cache = tcp_connection_cache[cache_key]
+from .common import LRUCache, StripedLRUCache
+from .common.selector import IPSelector
+#所有连接尝试都会读写，分段加锁
+tcp_connection_time = StripedLRUCache(256)
+#按实际链接结果逐次更新，一次失败的代价约为链接和握手超时之和
+ssl_selector = IPSelector(2.5)
+#加密会话复用统计，ipaddr -> (复用次数, 握手次数)
+ssl_session_stats = LRUCache(256)
+
+EPOLL_EVENTS = sum(getattr(select_module, x, 0) for x in ('EPOLLIN', 'EPOLLPRI', 'EPOLLERR', 'EPOLLHUP'))
+
+class IdleConnectionReaper(object):
+    '''Watch all idle pooled sockets in one poller, close them as soon as they
+    become readable (peer closed or sent junk) or error, and expire them from a
+    heap ordered by their cache time.'''
+
+    #select 在 windows 上最多只能同时检查 512 个套接字
+    select_size = 500
+    #没有到期的链接时的最长等待时间
+    interval = 1
+    #统计信息输出间隔
+    report_interval = 600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #fd -> (pool, cache_key, item, sock)
+        self.watching = {}
+        self.expire_heap = []
+        self.counter = itertools.count()
+        #定时输出统计信息的对象，需有 status 方法
+        self.reporters = []
+        self.lastreport = time()
+        # gevent 补丁后 epoll 会被移除，此时使用协程化的 select
+        if hasattr(select_module, 'epoll'):
+            self.epoll = select_module.epoll()
+        else:
+            self.epoll = None
+        thread.start_new_thread(self.run, ())
+
+    def register(self, pool, cache_key, item, sock, keeptime):
+        try:
+            fd = sock.fileno()
+        except NetWorkIOError:
+            return
+        if fd < 0:
+            return
+        with self.lock:
+            self.watching[fd] = pool, cache_key, item, sock
+            heapq.heappush(self.expire_heap, (item[0] + keeptime, next(self.counter), fd, item))
+            if self.epoll:
+                try:
+                    self.epoll.register(fd, EPOLL_EVENTS)
+                except (IOError, OSError) as e:
+                    if e.args[0] == errno.EEXIST:
+                        self.epoll.modify(fd, EPOLL_EVENTS)
+                    else:
+                        del self.watching[fd]
+
+    def unregister(self, sock, item):
+        try:
+            fd = sock.fileno()
+        except NetWorkIOError:
+            return
+        with self.lock:
+            watched = self.watching.get(fd)
+            if watched and watched[2] is item:
+                self._forget(fd)
+
+    def _forget(self, fd):
+        del self.watching[fd]
+        if self.epoll:
             try:
-                while cache:
-                    ctime, sock = cache.popleft()
-                    if time()-ctime > keeptime:
-                        sock.close()
-                        continue
-                    rd, _, ed = select([sock], [], [sock], 0.01)
-                    if rd or ed:
-                        sock.close()
-                        continue
-                    _, wd, ed = select([], [sock], [sock], cachetimeout)
-                    if not wd or ed:
-                        sock.close()
-                        continue
-                    cache.appendleft((ctime, sock))
-                    break
-            except IndexError:
+                self.epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
                 pass
-            except Exception as e:
-                if e.args[0] == 9:
-                    pass
-                else:
-                    logging.error(u'链接池守护线程错误：%r', e)
-
-def check_ssl_connection_cache():
-    '''check and close unavailable connection continued forever'''
-    while True:
-        sleep(5)
-        keys = None
-        while keys is None:
+
+    def _reap(self, fd, item=None):
+        with self.lock:
+            watched = self.watching.get(fd)
+            if watched is None or item and watched[2] is not item:
+                return
+            self._forget(fd)
+        pool, cache_key, item, sock = watched
+        #只关闭仍在链接池中的链接
+        if pool.discard(cache_key, item):
+            sock.close()
+
+    def _expire(self):
+        now = time()
+        expired = []
+        with self.lock:
+            expire_heap = self.expire_heap
+            while expire_heap and expire_heap[0][0] <= now:
+                _, _, fd, item = heapq.heappop(expire_heap)
+                expired.append((fd, item))
+            timeout = expire_heap[0][0] - now if expire_heap else self.interval
+        for fd, item in expired:
+            self._reap(fd, item)
+        return min(timeout, self.interval)
+
+    def _poll(self, timeout):
+        if self.epoll:
             try:
-                keys = tuple(key for key in ssl_connection_cache)
-            except:
-                sleep(0.01)
-        for cache_key in keys:
-            keeptime = gaekeeptime if cache_key.startswith('google') else linkkeeptime
-            cache = ssl_connection_cache[cache_key]
+                return [fd for fd, _ in self.epoll.poll(timeout)]
+            except (IOError, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+        with self.lock:
+            fds = list(self.watching)
+        if not fds:
+            sleep(timeout)
+            return []
+        ready = []
+        for i in xrange(0, len(fds), self.select_size):
+            part = fds[i:i+self.select_size]
             try:
-                while cache:
-                    ctime, ssl_sock = cache.popleft()
-                    sock = ssl_sock.sock
-                    if time()-ctime > keeptime:
-                        sock.close()
-                        continue
-                    rd, _, ed = select([sock], [], [sock], 0.01)
-                    if rd or ed:
-                        sock.close()
-                        continue
-                    _, wd, ed = select([], [sock], [sock], cachetimeout)
-                    if not wd or ed:
-                        sock.close()
-                        continue
-                    cache.appendleft((ctime, ssl_sock))
-                    break
-            except IndexError:
-                pass
+                ins, _, errs = select(part, [], part, timeout if i == 0 else 0)
+            except (select_module.error, ValueError, OSError):
+                #有套接字已被关闭，逐个检查
+                ins = []
+                errs = []
+                for fd in part:
+                    try:
+                        select([fd], [], [], 0)
+                    except (select_module.error, ValueError, OSError):
+                        errs.append(fd)
+            ready.extend(ins)
+            ready.extend(errs)
+        return ready
+
+    def _report(self):
+        now = time()
+        if now - self.lastreport > self.report_interval:
+            self.lastreport = now
+            for reporter in self.reporters:
+                logging.test(reporter.status())
+
+    def run(self):
+        '''close unavailable idle connections continued forever'''
+        while True:
+            try:
+                for fd in self._poll(self._expire()):
+                    self._reap(fd)
+                self._report()
             except Exception as e:
-                if e.args[0] == 9:
-                    pass
-                else:
-                    logging.error(u'链接池守护线程错误：%r', e)
-thread.start_new_thread(check_tcp_connection_cache, ())
-thread.start_new_thread(check_ssl_connection_cache, ())
+                logging.error(u'链接池守护线程错误：%r', e)
+                sleep(1)
+
+class ConnectionPool(object):
+    '''Own the checkout and checkin of idle keep-alive connections.
+
+    Connections are reused LIFO per cache_key, checked for liveness on
+    checkout, and bounded both per cache_key and in total, the oldest idle
+    connection is evicted when a bound is reached.'''
+
+    def __init__(self, name, getsock, maxperkey, maxsize):
+        self.name = name
+        self.getsock = getsock
+        self.maxperkey = maxperkey
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        #cache_key -> deque([(ctime, sock), ...])
+        self.caches = {}
+        #id(item) -> (cache_key, item)，按放入顺序排列
+        self.idle = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stales = 0
+        reaper.reporters.append(self)
+
+    def __len__(self):
+        return len(self.idle)
+
+    def keeptime(self, cache_key):
+        return gaekeeptime if cache_key.startswith('google') else linkkeeptime
+
+    def isalive(self, sock):
+        try:
+            rd, _, ed = select([sock], [], [sock], 0)
+        except Exception:
+            return False
+        return not (rd or ed)
+
+    def _popleft(self, cache_key):
+        cache = self.caches[cache_key]
+        item = cache.popleft()
+        if not cache:
+            del self.caches[cache_key]
+        del self.idle[id(item)]
+        return item
+
+    def get(self, cache_key):
+        '''Checkout the newest live connection of cache_key, or None'''
+        keeptime = self.keeptime(cache_key)
+        while True:
+            with self.lock:
+                cache = self.caches.get(cache_key)
+                if not cache:
+                    self.misses += 1
+                    return
+                item = cache.pop()
+                if not cache:
+                    del self.caches[cache_key]
+                del self.idle[id(item)]
+            ctime, sock = item
+            rawsock = self.getsock(sock)
+            reaper.unregister(rawsock, item)
+            if time() - ctime < keeptime and self.isalive(rawsock):
+                with self.lock:
+                    self.hits += 1
+                return sock
+            rawsock.close()
+            with self.lock:
+                self.stales += 1
+
+    def put(self, cache_key, sock):
+        '''Checkin an idle connection'''
+        item = time(), sock
+        evicted = []
+        with self.lock:
+            cache = self.caches.get(cache_key)
+            if cache is None:
+                cache = self.caches[cache_key] = collections.deque()
+            cache.append(item)
+            self.idle[id(item)] = cache_key, item
+            if len(cache) > self.maxperkey:
+                evicted.append(self._popleft(cache_key))
+            while len(self.idle) > self.maxsize:
+                #链接总数超出时移除最早放入的链接
+                key, _ = next(iter(self.idle.values()))
+                evicted.append(self._popleft(key))
+            self.evictions += len(evicted)
+        reaper.register(self, cache_key, item, self.getsock(sock), self.keeptime(cache_key))
+        for old in evicted:
+            rawsock = self.getsock(old[1])
+            reaper.unregister(rawsock, old)
+            rawsock.close()
+
+    def discard(self, cache_key, item):
+        '''Remove an idle item found unavailable by the reaper'''
+        with self.lock:
+            if id(item) not in self.idle:
+                return False
+            cache = self.caches[cache_key]
+            cache.remove(item)
+            if not cache:
+                del self.caches[cache_key]
+            del self.idle[id(item)]
+            self.stales += 1
+            return True
+
+    def status(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return u'%s 链接池：闲置 %d，主机 %d，命中 %d/%d（%.1f%%），淘汰 %d，失效 %d' % (
+                   self.name, len(self.idle), len(self.caches), self.hits, total,
+                   self.hits * 100.0 / (total or 1), self.evictions, self.stales)
+
+class SSLSessionCache(object):
+    '''Keep TLS sessions per (ip, server_hostname) to resume handshakes'''
+
+    def __init__(self, max_items, expire):
+        self.sessions = LRUCache(max_items, expire)
+        self.lock = threading.Lock()
+        self.resumed = 0
+        self.handshakes = 0
+        reaper.reporters.append(self)
+
+    def get(self, ssl_context, ipaddr, server_hostname):
+        return self.sessions.get((id(ssl_context), ipaddr[0], server_hostname))
+
+    def set(self, ssl_context, ipaddr, server_hostname, session):
+        self.sessions[(id(ssl_context), ipaddr[0], server_hostname)] = session
+
+    def discard(self, ssl_context, ipaddr, server_hostname):
+        self.sessions.pop((id(ssl_context), ipaddr[0], server_hostname))
+
+    def record(self, ipaddr, resumed):
+        with self.lock:
+            self.handshakes += 1
+            self.resumed += resumed
+            nresumed, nhandshakes = ssl_session_stats.get(ipaddr, (0, 0))
+            ssl_session_stats[ipaddr] = nresumed + resumed, nhandshakes + 1
+
+    def hitrate(self, ipaddr=None):
+        if ipaddr:
+            resumed, handshakes = ssl_session_stats.get(ipaddr, (0, 0))
+        else:
+            resumed, handshakes = self.resumed, self.handshakes
+        return resumed * 1.0 / (handshakes or 1)
+
+    def status(self):
+        with self.lock:
+            return u'加密会话复用：%d/%d（%.1f%%）' % (self.resumed, self.handshakes, self.hitrate() * 100)
+
+reaper = IdleConnectionReaper()
+tcp_connection_pool = ConnectionPool('tcp', lambda sock: sock, GC.LINK_POOLMAXHOST, GC.LINK_POOLMAXSIZE)
+ssl_connection_pool = ConnectionPool('ssl', lambda ssl_sock: ssl_sock.sock, GC.LINK_POOLMAXHOST, GC.LINK_POOLMAXSIZE)
+ssl_session_cache = SSLSessionCache(1024, 30*60)
+reaper.reporters.append(ssl_selector)
 
 connect_limiter = LRUCache(512)
 def set_connect_start(ip):
@@ -220,12 +599,139 @@ def set_connect_start(ip):
 def set_connect_finish(ip):
     connect_limiter[ip].get()
 
+def record_cancelled(connection_time, ipaddr, cost):
+    '''A cancelled attempt costs at least the time it has already run'''
+    if connection_time.get(ipaddr, 0) < cost:
+        connection_time[ipaddr] = cost
+
+class ConnectionRace(object):
+    '''One round of connection attempts, the first connection wins'''
+
+    def __init__(self, loser=None):
+        self.lock = threading.Lock()
+        self.queobj = Queue.Queue()
+        self.done = False
+        self.cancelled = False
+        self.winner = None
+        self.inflight = {}
+        self.loser = loser
+
+    def track(self, ipaddr, sock):
+        '''Register a started attempt, return False if the race is over'''
+        with self.lock:
+            if self.done:
+                return False
+            self.inflight[ipaddr] = sock
+            return True
+
+    def report(self, ipaddr, result):
+        with self.lock:
+            self.inflight.pop(ipaddr, None)
+            late = self.done
+            if not late and not isinstance(result, Exception):
+                self.done = True
+                self.winner = result
+        if not late:
+            self.queobj.put(result)
+        elif not isinstance(result, Exception):
+            if self.loser:
+                self.loser(result, self)
+            else:
+                result.close()
+
+    def cancel(self):
+        '''Abort all attempts in flight, they will fail and be dropped'''
+        with self.lock:
+            self.done = self.cancelled = True
+            inflight = list(self.inflight.values())
+        for sock in inflight:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+
+class ConnectionRacer(object):
+    '''Happy eyeballs (RFC 8305) style connection racer on a bounded worker pool
+
+    Attempts are started one by one, the next one starts when the previous
+    fails or its attempt delay has passed, all others are cancelled as soon
+    as one wins.'''
+
+    max_workers = 64
+    #未知链接时间时使用 RFC 8305 推荐的延时
+    default_delay = 0.25
+    min_delay = 0.1
+    max_delay = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = Queue.Queue()
+        self.workers = 0
+        self.idle = 0
+
+    def submit(self, attempt, addr, race):
+        with self.lock:
+            if self.idle <= self.tasks.qsize() and self.workers < self.max_workers:
+                self.workers += 1
+                thread.start_new_thread(self.worker, ())
+        self.tasks.put((attempt, addr, race))
+
+    def worker(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            attempt, addr, race = self.tasks.get()
+            with self.lock:
+                self.idle -= 1
+            try:
+                attempt(addr, race)
+            except Exception as e:
+                logging.exception(u'%s 链接尝试发生错误：%r', addr[0], e)
+                e.xip = addr
+                race.report(addr, e)
+
+    def attempt_delay(self, connection_time):
+        if not connection_time:
+            return self.default_delay
+        return max(self.min_delay, min(connection_time * 1.25, self.max_delay))
+
+    def race(self, addrs, attempt, get_connection_time, loser=None, stagger=True):
+        '''Race attempt(addr, race) over addrs, return (winner, errors)'''
+        race = ConnectionRace(loser)
+        pending = list(addrs)
+        running = 0
+        errors = []
+        while pending or running:
+            timeout = None
+            if pending:
+                addr = pending.pop(0)
+                self.submit(attempt, addr, race)
+                running += 1
+                if pending:
+                    if not stagger:
+                        continue
+                    timeout = self.attempt_delay(get_connection_time(addr))
+            try:
+                result = race.queobj.get(timeout=timeout)
+            except Queue.Empty:
+                continue
+            running -= 1
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                if stagger:
+                    race.cancel()
+                return result, errors
+        return None, errors
+
+connection_racer = ConnectionRacer()
+
 class HTTPUtil(BaseHTTPUtil):
     """HTTP Request Class"""
 
     protocol_version = 'HTTP/1.1'
 
-    def __init__(self, max_window=4, max_timeout=8, proxy='', ssl_ciphers=None, max_retry=2):
+    def __init__(self, max_window=4, max_timeout=8, proxy='', ssl_ciphers=None, max_retry=2, alpn=None):
         # http://docs.python.org/dev/library/ssl.html
         # http://blog.ivanristic.com/2009/07/examples-of-the-information-collected-from-ssl-handshakes.html
         # http://src.chromium.org/svn/trunk/src/net/third_party/nss/ssl/sslenum.c
@@ -240,12 +746,15 @@ class HTTPUtil(BaseHTTPUtil):
         #    dns_resolve = self.__dns_resolve_withproxy
         #    self.create_connection = self.__create_connection_withproxy
         #    self.create_ssl_connection = self.__create_ssl_connection_withproxy
-        BaseHTTPUtil.__init__(self, GC.LINK_OPENSSL, os.path.join(cert_dir, 'cacert.pem'), ssl_ciphers)
+        BaseHTTPUtil.__init__(self, GC.LINK_OPENSSL, os.path.join(cert_dir, 'cacert.pem'), ssl_ciphers, alpn)
 
     def create_connection(self, address, cache_key, timeout=None, source_address=None, **kwargs):
-        def _create_connection(ipaddr, timeout, queobj):
+        def _create_connection(ipaddr, timeout, race):
+            if race.done:
+                return
             sock = None
             ip = ipaddr[0]
+            start_time = time()
             try:
                 # create a ipv4/ipv6 socket object
                 sock = socket.socket(socket.AF_INET if ':' not in ipaddr[0] else socket.AF_INET6)
@@ -262,54 +771,41 @@ class HTTPUtil(BaseHTTPUtil):
                 set_connect_start(ip)
                 # start connection time record
                 start_time = time()
+                # register to race, so it can be cancelled
+                if not race.track(ipaddr, sock):
+                    raise socket.error(u'已取消')
                 # TCP connect
                 sock.connect(ipaddr)
                 # set a normal timeout
                 sock.settimeout(timeout)
                 # record TCP connection time
                 tcp_connection_time[ipaddr] = sock.tcp_time = time() - start_time
-                # put socket object to output queobj
+                # report socket object to race
                 sock.xip = ipaddr
-                queobj.put(sock)
+                race.report(ipaddr, sock)
             except (socket.error, OSError) as e:
-                # any socket.error, put Excpetions to output queobj.
-                e.xip = ipaddr
-                queobj.put(e)
-                # reset a large and random timeout to the ipaddr
-                tcp_connection_time[ipaddr] = self.max_timeout+random.random()
+                if race.cancelled:
+                    # a faster connection won, only record the time already cost
+                    record_cancelled(tcp_connection_time, ipaddr, time() - start_time)
+                else:
+                    # reset a large and random timeout to the ipaddr
+                    tcp_connection_time[ipaddr] = self.max_timeout+random.random()
                 # close tcp socket
                 sock.close()
+                # any socket.error, report Excpetions to race.
+                e.xip = ipaddr
+                race.report(ipaddr, e)
             finally:
                 set_connect_finish(ip)
-        def _close_connection(count, queobj, first_tcp_time):
-            now = time()
-            tcp_time_threshold = max(min(1.5, 1.5 * first_tcp_time), 0.5)
-            cache = tcp_connection_cache[cache_key]
-            for i in xrange(count):
-                sock = queobj.get()
-                if isinstance(sock, socket.socket):
-                    if False and sock.tcp_time < tcp_time_threshold:
-                        cache.append((now, sock))
-                    else:
-                        sock.close()
 
-        try:
-            keeptime = gaekeeptime if cache_key.startswith('google') else linkkeeptime
-            cache = tcp_connection_cache[cache_key]
-            while cache:
-                ctime, sock = cache.pop()
-                rd, _, ed = select([sock], [], [sock], 0.01)
-                if rd or ed or time()-ctime > keeptime:
-                    sock.close()
-                else:
-                    return sock
-        except IndexError:
-            pass
+        sock = tcp_connection_pool.get(cache_key)
+        if sock:
+            return sock
         result = None
         host, port = address
         addresses = [(x, port) for x in dns_resolve(host)]
         if port == 443:
-            get_connection_time = lambda addr: tcp_connection_time.get(addr, False) or ssl_connection_time.get(addr, False)
+            get_connection_time = lambda addr: tcp_connection_time.get(addr, False) or ssl_selector.latency(addr)
         else:
             get_connection_time = lambda addr: tcp_connection_time.get(addr, False)
         for i in xrange(self.max_retry):
@@ -320,34 +816,32 @@ class HTTPUtil(BaseHTTPUtil):
                 addrs = addresses[:window] + random.sample(addresses[window:], self.max_window-window)
             else:
                 addrs = addresses
-            queobj = Queue.Queue()
-            for addr in addrs:
-                thread.start_new_thread(_create_connection, (addr, timeout, queobj))
-            addrslen = len(addrs)
-            for i in xrange(addrslen):
-                result = queobj.get()
-                if isinstance(result, Exception):
-                    addr = result.xip
-                    #临时移除 badip
-                    try:
-                        addresses.remove(addr)
-                    except ValueError:
-                        pass
-                    if i == 0:
-                        #only output first error
-                        logging.warning(u'%s create_connection %r 返回 %r，重试', addr[0], host, result)
-                else:
-                    thread.start_new_thread(_close_connection, (addrslen-i-1, queobj, result.tcp_time))
-                    return result
-            if i == self.max_retry - 1:
-                if result:
-                    raise result
+            result, errors = connection_racer.race(addrs, lambda addr, race: _create_connection(addr, timeout, race), get_connection_time)
+            for n, error in enumerate(errors):
+                addr = error.xip
+                #临时移除 badip
+                try:
+                    addresses.remove(addr)
+                except ValueError:
+                    pass
+                if n == 0:
+                    #only output first error
+                    logging.warning(u'%s create_connection %r 返回 %r，重试', addr[0], host, error)
+            if result:
+                return result
+            if i == self.max_retry - 1 and errors:
+                raise errors[-1]
 
     def create_ssl_connection(self, address, cache_key, timeout=None, test=None, source_address=None, rangefetch=None, **kwargs):
-        def _create_ssl_connection(ipaddr, timeout, queobj, retry=None):
+        def _create_ssl_connection(ipaddr, timeout, race, retry=None):
+            if race and race.done:
+                return
             sock = None
             ssl_sock = None
+            session = None
+            server_hostname = None
             ip = ipaddr[0]
+            start_time = time()
             try:
                 # create a ipv4/ipv6 socket object
                 sock = socket.socket(socket.AF_INET if ':' not in ipaddr[0] else socket.AF_INET6)
@@ -363,11 +857,18 @@ class HTTPUtil(BaseHTTPUtil):
                 # pick up the sock socket
                 server_hostname = b'www.google.com' if address[0].endswith('.appspot.com') else None
                 ssl_sock = self.get_ssl_socket(sock, server_hostname)
+                # try to resume a recent session with the same ip and sni
+                session = None if test else ssl_session_cache.get(self.ssl_context, ipaddr, server_hostname)
+                if session:
+                    self.set_ssl_session(ssl_sock, session)
                 # set a short timeout to trigger timeout retry more quickly.
                 ssl_sock.settimeout(1)
                 set_connect_start(ip)
                 # start connection time record
                 start_time = time()
+                # register to race, so it can be cancelled
+                if race and not race.track(ipaddr, sock):
+                    raise socket.error(u'已取消')
                 # TCP connect
                 ssl_sock.connect(ipaddr)
                 #connected_time = time()
@@ -381,7 +882,11 @@ class HTTPUtil(BaseHTTPUtil):
                 # record TCP connection time
                 #tcp_connection_time[ipaddr] = ssl_sock.tcp_time = connected_time - start_time
                 # record SSL connection time
-                ssl_connection_time[ipaddr] = ssl_sock.ssl_time = handshaked_time - start_time
+                ssl_sock.ssl_time = handshaked_time - start_time
+                ssl_selector.success(ipaddr, ssl_sock.ssl_time)
+                # record SSL session resumption
+                ssl_sock.ssl_resumed = resumed = bool(session) and self.ssl_session_reused(ssl_sock)
+                ssl_session_cache.record(ipaddr, resumed)
                 if test:
                     if ssl_sock.ssl_time > timeout:
                         raise socket.timeout(u'%d 超时' % int(ssl_sock.ssl_time*1000))
@@ -393,94 +898,78 @@ class HTTPUtil(BaseHTTPUtil):
                     subject = cert.get_subject()
                     if subject.O != 'Google Inc':
                         raise ssl.SSLError(u'%s 证书的公司名称（%s）不是 "Google Inc"' % (address[0], subject.O))
+                # keep SSL session for next connection
+                if not resumed:
+                    new_session = self.get_ssl_session(ssl_sock)
+                    if new_session:
+                        ssl_session_cache.set(self.ssl_context, ipaddr, server_hostname, new_session)
                 # sometimes, we want to use raw tcp socket directly(select/epoll), so setattr it to ssl socket.
                 ssl_sock.sock = sock
                 ssl_sock.xip = ipaddr
                 if test:
-                    ssl_connection_cache[cache_key].append((time(), ssl_sock))
+                    ssl_connection_pool.put(cache_key, ssl_sock)
                     return test.put((ipaddr[0], ssl_sock.ssl_time))
-                # put ssl socket object to output queobj
-                queobj.put(ssl_sock)
+                # report ssl socket object to race
+                race.report(ipaddr, ssl_sock)
             except NetWorkIOError as e:
-                # reset a large and random timeout to the ipaddr
-                ssl_connection_time[ipaddr] = self.max_timeout + random.random()
+                if race and race.cancelled:
+                    # a faster connection won, only record the time already cost
+                    ssl_selector.cancelled(ipaddr, time() - start_time)
+                else:
+                    # lower the success estimate of the ipaddr
+                    ssl_selector.failure(ipaddr)
+                    # the session may be refused, do not offer it again
+                    if session:
+                        ssl_session_cache.discard(self.ssl_context, ipaddr, server_hostname)
                 # close tcp socket
                 sock.close()
-                # any socket.error, put Excpetions to output queobj.
+                # any socket.error, report Excpetions to race.
                 e.xip = ipaddr
                 if test:
                     if not retry and e.args == (-1, 'Unexpected EOF'):
-                        return _create_ssl_connection(ipaddr, timeout, test, True)
+                        return _create_ssl_connection(ipaddr, timeout, None, True)
                     return test.put(e)
-                queobj.put(e)
+                race.report(ipaddr, e)
             finally:
                 set_connect_finish(ip)
 
-        def _close_ssl_connection(count, queobj, first_ssl_time):
-            now = time()
-            ssl_time_threshold = max(min(1.5, 1.5 * first_ssl_time), 1.0)
-            cache = ssl_connection_cache[cache_key]
-            for i in xrange(count):
-                ssl_sock = queobj.get()
-                if isinstance(ssl_sock, (SSLConnection, ssl.SSLSocket)):
-                    if ssl_sock.ssl_time < ssl_time_threshold:
-                        cache.append((now, ssl_sock))
-                    else:
-                        ssl_sock.sock.close()
+        def _close_ssl_connection(ssl_sock, race):
+            #未能及时取消而完成握手的链接，足够快时放入链接池
+            ssl_time_threshold = max(min(1.5, 1.5 * race.winner.ssl_time), 1.0)
+            if ssl_sock.ssl_time < ssl_time_threshold:
+                ssl_connection_pool.put(cache_key, ssl_sock)
+            else:
+                ssl_sock.sock.close()
 
         if test:
-            return _create_ssl_connection(address, timeout, test)
-        try:
-            keeptime = gaekeeptime if cache_key.startswith('google') else linkkeeptime
-            cache = ssl_connection_cache[cache_key]
-            while cache:
-                ctime, ssl_sock = cache.pop()
-                rd, _, ed = select([ssl_sock.sock], [], [ssl_sock.sock], 0.01)
-                if rd or ed or time()-ctime > keeptime:
-                    ssl_sock.sock.close()
-                else:
-                    ssl_sock.settimeout(timeout)
-                    return ssl_sock
-        except IndexError:
-            pass
+            return _create_ssl_connection(address, timeout, None)
+        ssl_sock = ssl_connection_pool.get(cache_key)
+        if ssl_sock:
+            ssl_sock.settimeout(timeout)
+            return ssl_sock
         host, port = address
         result = None
         addresses = [(x, port) for x in dns_resolve(host)]
+        #按线程数量选择 IP
+        window = GC.AUTORANGE_THREADS+1 if rangefetch else self.max_window
         for i in xrange(self.max_retry):
-            addresseslen = len(addresses)
-            addresses.sort(key=lambda addr: ssl_connection_time.get(addr, False))
-            if rangefetch:
-                #按线程数量获取排序靠前的 IP
-                addrs = addresses[:GC.AUTORANGE_THREADS+1]
-            else:
-                max_window = self.max_window
-                if addresseslen > max_window:
-                    window = min((max_window+1)//2 + min(i, 1), addresseslen)
-                    addrs = addresses[:window] + random.sample(addresses[window:], max_window-window)
-                else:
-                    addrs = addresses
-            queobj = Queue.Queue()
-            for addr in addrs:
-                thread.start_new_thread(_create_ssl_connection, (addr, timeout, queobj))
-            addrslen = len(addrs)
-            for i in xrange(addrslen):
-                result = queobj.get()
-                if isinstance(result, Exception):
-                    addr = result.xip
-                    #临时移除 badip
-                    try:
-                        addresses.remove(addr)
-                    except ValueError:
-                        pass
-                    if i == 0:
-                        #only output first error
-                        logging.warning(u'%s create_ssl_connection %r 返回 %r，重试', addr[0], host, result)
-                else:
-                    thread.start_new_thread(_close_ssl_connection, (addrslen-i-1, queobj, result.ssl_time))
-                    return result
-            if i == self.max_retry - 1:
-                if result:
-                    raise result
+            addrs = ssl_selector.select(addresses, window)
+            #自动多线程同时发起全部链接，多出的链接留给后续的线程使用
+            result, errors = connection_racer.race(addrs, lambda addr, race: _create_ssl_connection(addr, timeout, race), ssl_selector.latency, _close_ssl_connection, not rangefetch)
+            for n, error in enumerate(errors):
+                addr = error.xip
+                #临时移除 badip
+                try:
+                    addresses.remove(addr)
+                except ValueError:
+                    pass
+                if n == 0:
+                    #only output first error
+                    logging.warning(u'%s create_ssl_connection %r 返回 %r，重试', addr[0], host, error)
+            if result:
+                return result
+            if i == self.max_retry - 1 and errors:
+                raise errors[-1]
 
     def __create_connection_withproxy(self, address, timeout=None, source_address=None, **kwargs):
         host, port = address
@@ -544,14 +1033,17 @@ class HTTPUtil(BaseHTTPUtil):
         if not isinstance(request_data, bytes):
             request_data = request_data.encode()
 
-        sock.sendall(request_data + payload)
-        #if isinstance(payload, bytes):
-        #    sock.sendall(request_data.encode() + payload)
-        #elif hasattr(payload, 'read'):
-        #    sock.sendall(request_data)
-        #    sock.sendall(payload.read())
-        #else:
-        #    raise TypeError('request(payload) must be a string or buffer, not %r' % type(payload))
+        if hasattr(payload, 'read'):
+            #先发送头部，再边读边发送请求主体
+            sock.sendall(request_data)
+            data = payload.read()
+            while data:
+                sock.sendall(data)
+                data = payload.read()
+        elif isinstance(payload, list):
+            sendall_buffers(sock, [request_data] + payload)
+        else:
+            sendall_buffers(sock, (request_data, payload))
 
         #if need_crlf:
         #    try:
@@ -588,10 +1080,17 @@ class HTTPUtil(BaseHTTPUtil):
         if 'Host' not in headers:
             headers['Host'] = host
         if payload:
-            if not isinstance(payload, bytes):
-                payload = payload.encode()
-            if 'Content-Length' not in headers:
-                headers['Content-Length'] = str(len(payload))
+            if hasattr(payload, 'read'):
+                #流式主体使用客户端的 Content-Length 或 Transfer-Encoding
+                pass
+            elif isinstance(payload, list):
+                if 'Content-Length' not in headers:
+                    headers['Content-Length'] = str(sum(len(buf) for buf in payload))
+            else:
+                if not isinstance(payload, bytes):
+                    payload = payload.encode()
+                if 'Content-Length' not in headers:
+                    headers['Content-Length'] = str(len(payload))
 
         for i in xrange(self.max_retry):
             sock = None
@@ -619,9 +1118,12 @@ class HTTPUtil(BaseHTTPUtil):
                 else:
                     logging.warning(u'%s _request "%s %s" 失败：%r', ip[0], method, realurl or url, e)
                     if realurl:
-                        ssl_connection_time[ip] = self.max_timeout + random.random()
+                        ssl_selector.failure(ip)
                 if not realurl and e.args[0] == errno.ECONNRESET:
                     raise e
+                if getattr(payload, 'started', False):
+                    #请求主体已经部分发送，不能重试
+                    raise e
             #if i == self.max_retry - 1:
             #    logging.warning(u'%s request "%s %s" 失败', ip[0], method, realurl or url)
 
@@ -0,0 +1,481 @@
+# coding:utf-8
+'''Probe many IPs at once with non-blocking sockets in one thread'''
+
+import ssl
+import errno
+import socket
+import struct
+import select as select_module
+from select import select
+from time import time
+from bisect import bisect
+from collections import deque
+from . import clogging as logging
+from .compat import xrange
+
+EPOLLIN = getattr(select_module, 'EPOLLIN', 1)
+EPOLLOUT = getattr(select_module, 'EPOLLOUT', 4)
+EPOLLERR = getattr(select_module, 'EPOLLERR', 8)
+EPOLLHUP = getattr(select_module, 'EPOLLHUP', 16)
+
+#流水线阶段：TCP 连接扫描、TLS 握手及证书检查、HTTP 响应检查
+SWEEP, TLS, HTTP = range(3)
+stage_names = 'tcp', 'tls', 'http'
+inf = float('inf')
+
+def get_domains(cert):
+    domains = tuple(v for k, v in cert.get('subjectAltName', ()) if k == 'DNS')
+    if domains:
+        return domains
+    for rdn in cert.get('subject', ()):
+        for k, v in rdn:
+            if k == 'commonName':
+                return (v,)
+    return ()
+
+def get_servername(data):
+    for line in data.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'server':
+            return value.strip(b' \t').decode('latin-1')
+    return ''
+
+class LatencyHistogram(object):
+    '''Count the latencies of one stage in exponential buckets'''
+    #桶上限，单位：毫秒
+    bounds = 25, 50, 100, 200, 400, 800, 1600, 3200
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.failed = 0
+        self.timeouts = 0
+
+    def add(self, ms):
+        self.counts[bisect(self.bounds, ms)] += 1
+
+    def percentile(self, p):
+        total = sum(self.counts)
+        if not total:
+            return 0
+        n = total * p
+        for i, count in enumerate(self.counts):
+            n -= count
+            if n <= 0:
+                break
+        return self.bounds[i] if i < len(self.bounds) else inf
+
+    def status(self):
+        return u'成功 %d，失败 %d，超时 %d，p50 <%sms，p90 <%sms，p99 <%sms' % (
+               sum(self.counts), self.failed, self.timeouts, self.percentile(0.5),
+               self.percentile(0.9), self.percentile(0.99))
+
+class Probe(object):
+    '''The state of one IP passing through the pipeline'''
+    __slots__ = ('ip', 'sock', 'fd', 'stage', 'start', 'deadline', 'events',
+                 'costtime', 'domains', 'servername', 'sending', 'data', 'error')
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.sock = None
+        self.fd = None
+        self.stage = SWEEP
+        self.start = time()
+        self.deadline = inf
+        self.events = 0
+        #各阶段用时之和，不包括排队时间
+        self.costtime = 0
+        self.domains = None
+        self.servername = ''
+        self.sending = False
+        self.data = b''
+        self.error = None
+
+class ProbeEngine(object):
+    '''Pass many IPs through TCP sweep, TLS/cert and HTTP stages at once
+
+    Each stage has its own concurrency limit, timeout and latency
+    histogram. Only IPs that answer the cheap TCP connect enter the TLS
+    stage, and the sweep waits while the TLS queue is full.
+    '''
+
+    #select 在 windows 上最多只能同时检查 512 个套接字
+    select_size = 500
+
+    def __init__(self, ssl_context, server_hostname, request,
+                 limits=(1024, 256, 128), timeouts=(1, 1.5, 4), port=443):
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname
+        self.request = request
+        self.limits = limits
+        self.timeouts = timeouts
+        self.port = port
+        self.probes = {}
+        self.active = [0, 0, 0]
+        #已完成上一阶段，等待进入 TLS、HTTP 阶段的探测
+        self.queues = [None, deque(), deque()]
+        self.finished = []
+        self.histograms = [LatencyHistogram() for _ in stage_names]
+        self.epoll = None
+
+    def open(self, ip):
+        probe = Probe(ip)
+        try:
+            sock = socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            sock.setblocking(0)
+            err = sock.connect_ex((ip, self.port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035):
+                sock.close()
+                raise socket.error(err, 'connect failed')
+        except (socket.error, OSError) as e:
+            probe.error = e
+            self.histograms[SWEEP].failed += 1
+            self.finished.append(probe)
+            return
+        probe.sock = sock
+        probe.fd = sock.fileno()
+        probe.deadline = probe.start + self.timeouts[SWEEP]
+        self.probes[probe.fd] = probe
+        self.active[SWEEP] += 1
+        self.wait(probe, EPOLLOUT)
+
+    def wait(self, probe, events):
+        if probe.events == events:
+            return
+        if self.epoll:
+            if probe.events:
+                self.epoll.modify(probe.fd, events)
+            else:
+                self.epoll.register(probe.fd, events)
+        probe.events = events
+
+    def park(self, probe):
+        #排队时不检查事件，也没有时限
+        if self.epoll and probe.events:
+            self.epoll.unregister(probe.fd)
+        probe.events = 0
+        probe.deadline = inf
+
+    def close(self, probe):
+        if probe.fd in self.probes:
+            del self.probes[probe.fd]
+            if self.epoll and probe.events:
+                try:
+                    self.epoll.unregister(probe.fd)
+                except (IOError, OSError, ValueError):
+                    pass
+            probe.events = 0
+        if probe.sock:
+            try:
+                probe.sock.close()
+            except Exception:
+                pass
+            probe.sock = None
+
+    def fail(self, probe, error, timeout=False):
+        stage = probe.stage
+        self.active[stage] -= 1
+        histogram = self.histograms[stage]
+        if timeout:
+            histogram.timeouts += 1
+        else:
+            histogram.failed += 1
+        probe.costtime += int((time() - probe.start) * 1000)
+        probe.error = error
+        self.close(probe)
+        self.finished.append(probe)
+
+    def complete(self, probe):
+        stage = probe.stage
+        self.active[stage] -= 1
+        costtime = int((time() - probe.start) * 1000)
+        self.histograms[stage].add(costtime)
+        probe.costtime += costtime
+        if stage == HTTP:
+            self.close(probe)
+            self.finished.append(probe)
+            return
+        stage += 1
+        if self.active[stage] < self.limits[stage]:
+            self.begin(probe, stage)
+        else:
+            self.park(probe)
+            self.queues[stage].append(probe)
+
+    def begin(self, probe, stage):
+        probe.stage = stage
+        probe.start = time()
+        probe.deadline = probe.start + self.timeouts[stage]
+        self.active[stage] += 1
+        try:
+            if stage == TLS:
+                probe.sock = self.ssl_context.wrap_socket(probe.sock, do_handshake_on_connect=False,
+                                                          server_hostname=self.server_hostname)
+            else:
+                probe.sending = True
+                probe.data = self.request
+        except Exception as e:
+            self.fail(probe, e)
+        else:
+            self.step(probe)
+
+    def step(self, probe):
+        stage = probe.stage
+        try:
+            if stage == SWEEP:
+                err = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise socket.error(err, 'connect failed')
+                done = True
+            elif stage == TLS:
+                done = self.handshake(probe)
+            else:
+                done = self.check(probe)
+        except Exception as e:
+            self.fail(probe, e)
+        else:
+            if done:
+                self.complete(probe)
+
+    def handshake(self, probe):
+        try:
+            probe.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.wait(probe, EPOLLIN)
+            return
+        except ssl.SSLWantWriteError:
+            self.wait(probe, EPOLLOUT)
+            return
+        #证书 SAN 检查
+        probe.domains = get_domains(probe.sock.getpeercert())
+        if not probe.domains:
+            raise ssl.SSLError(u'%s 无法获取 commonName' % probe.ip)
+        return True
+
+    def check(self, probe):
+        if probe.sending:
+            try:
+                sent = probe.sock.send(probe.data)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                self.wait(probe, EPOLLOUT)
+                return
+            probe.data = probe.data[sent:]
+            if probe.data:
+                self.wait(probe, EPOLLOUT)
+                return
+            probe.sending = False
+        while True:
+            try:
+                data = probe.sock.recv(4096)
+            except ssl.SSLWantReadError:
+                self.wait(probe, EPOLLIN)
+                return
+            if not data:
+                break
+            probe.data += data
+            if b'\r\n\r\n' in probe.data or len(probe.data) > 8192:
+                break
+        probe.servername = get_servername(probe.data.partition(b'\r\n\r\n')[0])
+        return True
+
+    def fill(self, next_ip):
+        '''Move queued probes into free stages, then start new connects'''
+        for stage in (HTTP, TLS):
+            queue = self.queues[stage]
+            while queue and self.active[stage] < self.limits[stage]:
+                self.begin(queue.popleft(), stage)
+        if next_ip is None:
+            return True
+        #TLS 阶段排队过多时暂停扫描
+        while (self.active[SWEEP] < self.limits[SWEEP] and
+               len(self.queues[TLS]) < self.limits[TLS]):
+            ip = next_ip()
+            if ip is None:
+                return True
+            self.open(ip)
+
+    def _poll(self, timeout):
+        if self.epoll:
+            try:
+                return self.epoll.poll(timeout)
+            except (IOError, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+        rfds = [fd for fd, probe in self.probes.items() if probe.events & EPOLLIN]
+        wfds = [fd for fd, probe in self.probes.items() if probe.events & EPOLLOUT]
+        ready = []
+        for i in xrange(0, max(len(rfds), len(wfds)), self.select_size):
+            rpart = rfds[i:i+self.select_size]
+            wpart = wfds[i:i+self.select_size]
+            try:
+                ins, outs, errs = select(rpart, wpart, rpart + wpart, timeout if i == 0 else 0)
+            except (select_module.error, ValueError, OSError):
+                ins = outs = []
+                errs = rpart + wpart
+            ready.extend((fd, EPOLLIN) for fd in ins)
+            ready.extend((fd, EPOLLOUT) for fd in outs)
+            ready.extend((fd, EPOLLERR) for fd in errs)
+        if not ready and not rfds and not wfds:
+            select([], [], [], timeout)
+        return ready
+
+    def run(self, next_ip, on_result):
+        '''Probe IPs from next_ip() until it returns None or on_result returns True
+
+        on_result(ip, domains, costtime, servername) gets the same values
+        as GAE_Finder.getipinfo, costtime leaves out time spent queueing.
+        '''
+        # gevent 补丁后 epoll 会被移除，此时使用协程化的 select
+        self.epoll = select_module.epoll() if hasattr(select_module, 'epoll') else None
+        self.histograms = [LatencyHistogram() for _ in stage_names]
+        try:
+            while True:
+                if self.fill(next_ip):
+                    next_ip = None
+                if not self.probes and not self.finished:
+                    break
+                for fd, event in self._poll(0.01 if self.finished else 0.1):
+                    probe = self.probes.get(fd)
+                    if probe is not None and probe.events:
+                        self.step(probe)
+                now = time()
+                for probe in list(self.probes.values()):
+                    if now > probe.deadline:
+                        self.fail(probe, socket.timeout('%s timed out' % stage_names[probe.stage]), True)
+                finished = self.finished
+                self.finished = []
+                for probe in finished:
+                    if probe.error:
+                        logging.debug(u'探测 %s 失败：%r', probe.ip, probe.error)
+                    domains = None if probe.error else probe.domains
+                    if on_result(probe.ip, domains, probe.costtime, probe.servername):
+                        return
+        finally:
+            for probe in list(self.probes.values()):
+                self.close(probe)
+            for queue in self.queues[1:]:
+                queue.clear()
+            self.active = [0, 0, 0]
+            self.finished = []
+            if self.epoll:
+                self.epoll.close()
+                self.epoll = None
+
+    def status(self):
+        return u'\n'.join(u'%s：%s' % (name.upper().rjust(4), histogram.status())
+                          for name, histogram in zip(stage_names, self.histograms))
+
+def benchmark(live=1000, refused=500, silent=3000, delay=0.1, threads=10):
+    '''Probe a local fake TLS farm, compare with the threaded finder
+
+    The farm runs in a child process on 127.0.0.1:443 and answers after
+    delay seconds to stand in for network latency. 127.0.0.2 refuses
+    connections and 127.0.0.3 never accepts them, like most candidates.
+    '''
+    import os
+    import random
+    import shutil
+    import tempfile
+    import threading
+    import multiprocessing
+    from time import sleep
+    from .compat import SocketServer as socketserver
+    from .CertUtil import crypto, create_ca, create_key, create_subcert
+    from .GAEFinder import GAE_Finder, isgaeserver, g_useOpenSSL
+    from .HTTPUtil import gws_ciphers
+    logging.setLevel(logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ca_key, ca = create_ca()
+        cafile = os.path.join(tmpdir, 'ca.crt')
+        with open(cafile, 'wb') as fp:
+            fp.write(crypto.dump_certificate(crypto.FILETYPE_PEM, ca))
+        leaf_key = create_key('ecc')
+        keyfile = os.path.join(tmpdir, 'leaf.key')
+        with open(keyfile, 'wb') as fp:
+            fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, leaf_key))
+        certfile = os.path.join(tmpdir, 'leaf.crt')
+        create_subcert(certfile, 'www.google.com', sans=['*.google.com', '*.gstatic.com'],
+                       pubkey=leaf_key, issuer=ca.get_subject(), issuer_key=ca_key)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        server_context.load_cert_chain(certfile, keyfile)
+
+        class FarmHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    conn = server_context.wrap_socket(self.request, server_side=True)
+                    conn.recv(1024)
+                    sleep(delay)
+                    conn.sendall(b'HTTP/1.1 200 OK\r\nServer: gws\r\nContent-Length: 0\r\n\r\n')
+                    conn.close()
+                except Exception:
+                    pass
+
+        class Farm(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+            request_queue_size = 1024
+
+        farm = Farm(('127.0.0.1', 443), FarmHandler)
+        farm_process = multiprocessing.Process(target=farm.serve_forever)
+        farm_process.daemon = True
+        farm_process.start()
+        #队列满后丢弃 SYN，连接只能超时
+        blackhole = socket.socket()
+        blackhole.bind(('127.0.0.3', 443))
+        blackhole.listen(0)
+        iplist = ['127.0.0.1'] * live + ['127.0.0.2'] * refused + ['127.0.0.3'] * silent
+        random.shuffle(iplist)
+
+        def report(name, costtime, results):
+            ok = sum(1 for r in results if isgaeserver(r[2]))
+            lat = sorted(r[1] for r in results if isgaeserver(r[2])) or [0]
+            logging.warning(u'%s：探测 %d 个 IP，可用 %d，%.0f 个/s，延时 p50 %dms p99 %dms',
+                            name, len(results), ok, len(results) / costtime,
+                            lat[len(lat)//2], lat[int(len(lat)*0.99)])
+
+        #非阻塞流水线
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(cafile)
+        context.set_ciphers(gws_ciphers)
+        request = GAE_Finder.httpreq
+        for limits in ((256, 256, 256), (2048, 256, 128)):
+            ips = iter(iplist)
+            results = []
+            engine = ProbeEngine(context, 'www.google.com', request, limits)
+            start = time()
+            engine.run(lambda: next(ips, None), lambda ip, d, c, s: results.append((d, c, s)))
+            report(u'流水线 %s' % '|'.join(map(str, limits)), time() - start, results)
+            logging.warning(u'各阶段：\n%s', engine.status())
+        #多线程，无响应 IP 太慢，只测一部分
+        finder = GAE_Finder(g_useOpenSSL, cafile)
+        ips = iter(iplist[:len(iplist)//5])
+        results = []
+        lock = threading.Lock()
+        def worker():
+            while True:
+                with lock:
+                    ip = next(ips, None)
+                if ip is None:
+                    break
+                results.append(finder.getipinfo(ip))
+        start = time()
+        workers = [threading.Thread(target=worker) for i in xrange(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        report(u'多线程 %d' % threads, time() - start, results)
+        blackhole.close()
+        farm_process.terminate()
+        farm.server_close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    import sys
+    if 'benchmark' in sys.argv:
+        benchmark()
@@ -12,7 +12,6 @@ import mimetypes
 import threading
 from . import CertUtil
 from . import clogging as logging
-from select import select
 from time import time, sleep
 from functools import partial
 from .compat import (
@@ -37,19 +36,34 @@ from .GAEUpdata import (
     _refreship as refreship
     )
 from .HTTPUtil import (
-    tcp_connection_cache,
-    ssl_connection_cache,
+    RequestBody,
+    reaper,
+    tcp_connection_pool,
+    ssl_connection_pool,
     http_gws,
     http_nor
     )
 from .RangeFetch import RangeFetch
+from .HTTPCache import http_cache
 from .GAEFetch import qGAE, gae_urlfetch
+from .ForwardUtil import forward, relay_engine
 from .FilterUtil import (
     filters_cache,
     get_action,
     get_connect_action
     )
 
+reaper.reporters.append(relay_engine)
+reaper.reporters.append(CertUtil.cert_factory)
+
+#拦截时返回的空内容
+block_headers = (b'HTTP/1.1 200\r\n'
+                 b'Cache-Control: max-age=86400\r\n'
+                 b'Expires:Oct, 01 Aug 2100 00:00:00 GMT\r\n')
+block_gif = (b'GIF89a\x01\x00\x01\x00\x80\xff\x00\xc0\xc0\xc0'
+             b'\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00'
+             b'\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+
 HAS_PYPY = hasattr(sys, 'pypy_version_info')
 normcookie = partial(re.compile(r',(?= [^ =]+(?:=|$))').sub, r'\r\nSet-Cookie:')
 normattachment = partial(re.compile(r'(?<=filename=)([^"\']+)').sub, r'"\1"')
@@ -85,13 +99,13 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     CAfile = 'http://gotox.go/ca'
 
     #可修改
-    ssl_context_cache = LRUCache(32)
     badhost = LRUCache(8, 120)
 
     #默认值
     ssl = False
     url = None
     url_parts = None
+    request_body = None
 
     if PY3:
         def setup(self):
@@ -116,6 +130,7 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         getattr(self, self.action)()
 
     def _do_CONNECT(self):
+        self.request_body = None
         host = self.headers.get('Host')
         port = None
         if host:
@@ -151,6 +166,7 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.do_action()
 
     def _do_METHOD(self):
+        self.request_body = None
         if HAS_PYPY:
             self.path = pypypath(self.path)
         host = self.headers.get('Host')
@@ -234,18 +250,31 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 self.write(b'0\r\n\r\n')
             return wrote, err
 
-    def handle_request_headers(self):
+    def get_request_body(self):
+        #同一请求转用其它规则时共用
+        if self.request_body is None:
+            length = self.headers.get('Content-Length')
+            chunked = 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+            self.request_body = RequestBody(self.rfile, 0 if chunked or not length else int(length), chunked)
+        return self.request_body
+
+    def handle_request_headers(self, stream=False):
         request_headers = dict((k.title(), v) for k, v in self.headers.items() if k.title() not in skip_request_headers)
         connection = self.headers.get('Connection') or self.headers.get('Proxy-Connection')
         if connection:
             request_headers['Connection'] = connection
-        payload = b''
-        if 'Content-Length' in request_headers:
-            try:
-                payload = self.rfile.read(int(request_headers['Content-Length']))
-            except NetWorkIOError as e:
-                logging.error(u'%s "%s %s" 附加请求内容读取失败：%r', self.address_string(), self.command, self.url, e)
-                raise
+        body = self.get_request_body()
+        if stream:
+            #发送头部后边读边发送
+            return request_headers, body if body else b''
+        try:
+            payload = body.readall()
+        except NetWorkIOError as e:
+            logging.error(u'%s "%s %s" 附加请求内容读取失败：%r', self.address_string(), self.command, self.url, e)
+            raise
+        if body.chunked:
+            del request_headers['Transfer-Encoding']
+            request_headers['Content-Length'] = str(len(payload))
         return request_headers, payload
 
     def handle_response_headers(self, response):
@@ -287,6 +316,34 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             logging.info('%s "%s %s %s HTTP/1.1" %s %s', self.address_string(response), self.action[3:], self.command, self.url, response.status, length or '-')
         return length, data, need_chunked
 
+    def send_cached(self, entry, response=None):
+        #response 为验证时 GAE 返回的 304
+        revalidated = response is not None
+        if entry.not_modified(self.headers):
+            http_cache.record_hit(entry, not_modified=True, revalidated=revalidated)
+            headers = dict((k, v) for k, v in entry.headers.items() if k in ('Etag', 'Last-Modified', 'Cache-Control', 'Expires', 'Date', 'Vary'))
+            self.write('HTTP/1.1 304 Not Modified\r\n%s\r\n' % ''.join('%s: %s\r\n' % x for x in headers.items()))
+            logging.debug('%s "%s %s %s HTTP/1.1" 304 -', self.address_string(response), 'CACHE', self.command, self.url)
+            return
+        try:
+            fp = http_cache.open_body(entry)
+        except IOError as e:
+            logging.warning(u'读取缓存 %r 失败：%r', self.url, e)
+            self.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n')
+            self.close_connection = 2
+            return
+        http_cache.record_hit(entry, revalidated=revalidated)
+        headers = entry.headers.copy()
+        headers['Content-Length'] = entry.size
+        headers['Age'] = entry.age(time())
+        self.write('HTTP/1.1 %s\r\n%s\r\n' % (entry.status, ''.join('%s: %s\r\n' % x for x in headers.items())))
+        logging.info('%s "%s %s %s HTTP/1.1" %s %s', self.address_string(response), 'CACHE', self.command, self.url, entry.status, entry.size)
+        with fp:
+            data = fp.read(65536)
+            while data:
+                self.write(data)
+                data = fp.read(65536)
+
     def do_DIRECT(self):
         """Direct http relay"""
         hostname = self.hostname
@@ -294,7 +351,7 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         path = self.url_parts.path
         response = None
         noerror = True
-        request_headers, payload = self.handle_request_headers()
+        request_headers, payload = self.handle_request_headers(stream=True)
         try:
             need_crlf = hostname.startswith('google_') or self.host.endswith(GC.HTTP_CRLFSITES)
             connection_cache_key = '%s:%d' % (hostname, self.port)
@@ -305,10 +362,15 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     logging.warn(u'request "%s %s" 失败，返回 404', self.command, self.url)
                     self.write('HTTP/1.1 404 %s\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\n%s' % self.responses[404])
                     return
+                elif payload and payload.started:
+                    #请求主体已经部分发送，不能转用 GAE
+                    logging.warn(u'request "%s %s" 上传中途失败，返回 502', self.command, self.url)
+                    self.write('HTTP/1.1 502 %s\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\n%s' % self.responses[502])
+                    return
                 else:
                     logging.warn(u'request "%s %s" 失败，尝试使用 "GAE" 规则。', self.command, self.url)
                     return self.go_GAE()
-            if response.status == 403 and not any(path.endswith(x) for x in GC.AUTORANGE_ENDSWITH): #不符合自动多线程规则
+            if response.status == 403 and not (payload and payload.started) and not any(path.endswith(x) for x in GC.AUTORANGE_ENDSWITH): #不符合自动多线程规则
                 logging.warn(u'request "%s %s" 链接被拒绝，尝试使用 "GAE" 规则。', self.command, self.url)
                 return self.go_GAE()
             _, data, need_chunked = self.handle_response_headers(response)
@@ -317,7 +379,7 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 raise err
         except NetWorkIOError as e:
             noerror = False
-            if e.args[0] == errno.ECONNRESET and not any(path.endswith(x) for x in GC.AUTORANGE_ENDSWITH): #不符合自动多线程规则
+            if e.args[0] == errno.ECONNRESET and not (payload and payload.started) and not any(path.endswith(x) for x in GC.AUTORANGE_ENDSWITH): #不符合自动多线程规则
                 logging.warn(u'request "%s %s" 链接被重置，尝试使用 "GAE" 规则。', self.command, self.url)
                 return self.go_GAE()
             elif e.args[0] in (10063, errno.ENAMETOOLONG):
@@ -332,6 +394,9 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             logging.warn(u'%s do_DIRECT "%s %s" 失败：%r', self.address_string(response), self.command, self.url, e)
             raise
         finally:
+            if payload and not payload.finished:
+                #服务器没有读取全部请求主体，剩余数据无法跳过
+                self.close_connection = 2
             if response:
                 response.close()
                 if noerror:
@@ -343,12 +408,12 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     if self.ssl:
                         if GC.GAE_KEEPALIVE or not connection_cache_key.startswith('google'):
                             #放入套接字缓存
-                            ssl_connection_cache[connection_cache_key].append((time(), response.sock))
+                            ssl_connection_pool.put(connection_cache_key, response.sock)
                         else:
                             #干扰严重时考虑不复用 google 链接
                             response.sock.close()
                     else:
-                        tcp_connection_cache[connection_cache_key].append((time(), response.sock))
+                        tcp_connection_pool.put(connection_cache_key, response.sock)
 
     def do_GAE(self):
         """GAE http urlfetch"""
@@ -381,6 +446,15 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         #为 GAE 代理请求网址加上端口
         n = self.url.find('/', self.url.find('//')+3)
         url = '%s:%s%s' % (self.url[:n], self.port, self.path)
+        cache_entry = cache_writer = None
+        use_cache = http_cache and self.command == 'GET' and not need_autorange and 'Range' not in request_headers
+        if use_cache:
+            cache_entry = http_cache.lookup(url, request_headers)
+            if cache_entry:
+                if cache_entry.fresh(request_headers, time()):
+                    return self.send_cached(cache_entry)
+                #过期后向服务器验证
+                cache_entry.add_validators(request_headers)
         for retry in xrange(GC.GAE_FETCHMAX):
             if payload and headers_sent:
                 logging.warning(u'do_GAE 由于有上传数据 "%s %s" 终止重试', self.command, self.url)
@@ -479,6 +553,14 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     if response.status == 206 and need_autorange:
                         rangefetch = RangeFetch(self, url, request_headers, payload, response)
                         return rangefetch.fetch()
+                    if use_cache:
+                        if response.status == 304 and cache_entry and cache_entry.validated:
+                            #缓存仍然有效
+                            http_cache.refresh(cache_entry, response)
+                            return self.send_cached(cache_entry, response)
+                        cache_writer = http_cache.store(url, request_headers, response)
+                        if cache_writer:
+                            response.read = cache_writer.tee(response.read)
                     length, data, need_chunked = self.handle_response_headers(response)
                     headers_sent = True
                 content_range = response.getheader('Content-Range', '')
@@ -491,6 +573,12 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     start = 0
                 wrote, err = self.write_response_content(data, response, need_chunked)
                 start += wrote
+                if cache_writer:
+                    if err:
+                        cache_writer.abort()
+                    else:
+                        cache_writer.commit()
+                    cache_writer = None
                 if err:
                     raise err
                 return
@@ -516,6 +604,9 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     logging.exception(u'%s do_GAE "%s %s" 失败：%r', self.address_string(response), self.command, self.url, e)
             finally:
                 qGAE.put(True)
+                if cache_writer:
+                    cache_writer.abort()
+                    cache_writer = None
                 if response:
                     response.close()
                     if noerror:
@@ -524,9 +615,12 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                             connection = response.getheader('Connection')
                             if connection and connection.lower() != 'close':
                                 self.close_connection = 0
-                        if GC.GAE_KEEPALIVE:
+                        if response.sock is None:
+                            # HTTP/2 连接由 http2_gws 管理
+                            pass
+                        elif GC.GAE_KEEPALIVE:
                             #放入套接字缓存
-                            ssl_connection_cache['google_gws:443'].append((time(), response.sock))
+                            ssl_connection_pool.put('google_gws:443', response.sock)
                         else:
                             #干扰严重时考虑不复用
                             response.sock.close()
@@ -614,6 +708,8 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def do_FAKECERT(self):
         """Deploy a fake cert to client"""
         #logging.debug('%s "AGENT %s %s:%d HTTP/1.1" - -', self.address_string(), self.command, self.host, self.port)
+        #等待客户端发送握手请求时签发证书
+        CertUtil.cert_factory.prepare(*self.get_cert_host())
         self.write(b'HTTP/1.1 200 OK\r\n\r\n')
         ssl_context = self.get_ssl_context()
         try:
@@ -621,12 +717,16 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         except Exception as e:
             if e.args[0] not in (errno.ECONNABORTED, errno.ECONNRESET):
                 logging.exception(u'伪造加密链接失败：host=%r，%r', self.host, e)
+            self.close_connection = 1
             return
         #停止非加密读写
         self.finish()
         #加载加密套接字
         self.request = ssl_sock
         self.setup()
+        self.handle_ssl(ssl_sock)
+
+    def handle_ssl(self, ssl_sock):
         try:
             #恢复正常处理流程
             self.handle()
@@ -663,15 +763,9 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def do_BLOCK(self):
         """Return a space content with 200"""
-        content = (b'HTTP/1.1 200\r\n'
-                   b'Cache-Control: max-age=86400\r\n'
-                   b'Expires:Oct, 01 Aug 2100 00:00:00 GMT\r\n'
-                   b'Connection: close\r\n')
+        content = block_headers + b'Connection: close\r\n'
         if self.url_parts and self.url_parts.path.endswith(('.jpg', '.gif', '.jpeg', '.png', '.bmp')):
-            content += (b'Content-Type: image/gif\r\n\r\n'
-                        b'GIF89a\x01\x00\x01\x00\x80\xff\x00\xc0\xc0\xc0'
-                        b'\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00'
-                        b'\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+            content += b'Content-Type: image/gif\r\n\r\n' + block_gif
         else:
             content += b'\r\n'
         logging.warning(u'%s "%s %s" 已经被拦截', self.address_string(), self.command, self.url)
@@ -707,26 +801,19 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             if not isinstance(rebuilt_request, bytes):
                 rebuilt_request = rebuilt_request.encode()
             remote.sendall(rebuilt_request)
-        local = self.connection
-        buf = bytearray(32768) # 32K
-        maxpong = maxpong or timeout
-        allins = [local, remote]
-        timecount = timeout
+            #已经读入缓冲的请求主体不在套接字中，需要从 rfile 发送
+            body = self.get_request_body()
+            data = body.read()
+            while data:
+                remote.sendall(data)
+                data = body.read()
+        if relay_engine.add(self.connection, remote, timeout, tick, maxpong, self.url):
+            #隧道交给转发引擎，处理线程可以返回
+            self.close_connection = 1
+            return
+        stats = None
         try:
-            while allins and timecount > 0:
-                timecount -= tick
-                ins, _, err = select(allins, [], allins, tick)
-                if err:
-                    logging.warning(err)
-                    raise socket.error(err)
-                for sock in ins:
-                    ndata = sock.recv_into(buf)
-                    if ndata:
-                        other = local if sock is remote else remote
-                        other.sendall(buf[:ndata])
-                        timecount = min(timecount*2, maxpong)
-                    else:
-                        allins.remove(sock)
+            stats = forward(self.connection, remote, timeout, tick, maxpong)
         except NetWorkIOError as e:
             #if e.args[0] not in (errno.ECONNABORTED, errno.ECONNRESET, errno.ENOTCONN, errno.EPIPE):
             if e.args[0] not in (10053, 10054):
@@ -734,9 +821,10 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         finally:
             remote.close()
             self.close_connection = 1
+            if stats:
+                logging.debug(u'转发 %r 结束：%s', self.url, stats)
 
-    def get_ssl_context(self):
-        """Keep a ssl_context cache"""
+    def get_cert_host(self):
         host = self.host
         ip = isip(host)
         if not ip:
@@ -744,15 +832,11 @@ class AutoProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             nhost = len(hostsp)
             if nhost > 3 or (nhost == 3 and len(hostsp[-2]) > 3):
                 host = '.'.join(hostsp[1:])
-        if host in self.ssl_context_cache:
-            return self.ssl_context_cache[host]
-        else:
-            logging.debug('%s-%s first', host, ip)
-            certfile, keyfile = CertUtil.get_cert(host, ip)
-            self.ssl_context_cache[host] = ssl_context = ssl.SSLContext(GC.LINK_LOCALSSL)
-            ssl_context.verify_mode = ssl.CERT_NONE
-            ssl_context.load_cert_chain(certfile, keyfile)
-            return ssl_context
+        return host, ip
+
+    def get_ssl_context(self):
+        """Get a ssl_context from the cert factory cache"""
+        return CertUtil.cert_factory.get_context(*self.get_cert_host())
 
     def send_CA(self):
         """Return CA cert file"""
@@ -48,14 +48,20 @@ def network_test(first=None):
 
 from .common import NetWorkIOError
 from .GlobalConfig import GC
-from .compat import SocketServer
+from .compat import PY3, SocketServer
 from .ProxyHandler import AutoProxyHandler, GAEProxyHandler
+from .ForwardUtil import relay_engine
 
 class LocalProxyServer(SocketServer.ThreadingTCPServer):
     """Local Proxy Server"""
     allow_reuse_address = True
     request_queue_size = 48
 
+    def shutdown_request(self, request):
+        #已交给转发引擎的连接由引擎关闭
+        if not relay_engine.owns(request):
+            SocketServer.ThreadingTCPServer.shutdown_request(self, request)
+
     def close_request(self, request):
         try:
             request.close()
@@ -79,5 +85,10 @@ class LocalProxyServer(SocketServer.ThreadingTCPServer):
             del exc_info, error
             SocketServer.ThreadingTCPServer.handle_error(self, *args)
 
-AutoProxy = LocalProxyServer((GC.LISTEN_IP, GC.LISTEN_AUTO_PORT), AutoProxyHandler)
-GAEProxy = LocalProxyServer((GC.LISTEN_IP, GC.LISTEN_GAE_PORT), GAEProxyHandler)
+if GC.LISTEN_ASYNCIO and PY3:
+    from .AsyncProxyServer import AsyncProxyServer
+    AutoProxy = AsyncProxyServer((GC.LISTEN_IP, GC.LISTEN_AUTO_PORT), AutoProxyHandler)
+    GAEProxy = AsyncProxyServer((GC.LISTEN_IP, GC.LISTEN_GAE_PORT), GAEProxyHandler, use_filter=False)
+else:
+    AutoProxy = LocalProxyServer((GC.LISTEN_IP, GC.LISTEN_AUTO_PORT), AutoProxyHandler)
+    GAEProxy = LocalProxyServer((GC.LISTEN_IP, GC.LISTEN_GAE_PORT), GAEProxyHandler)
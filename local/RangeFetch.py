@@ -7,15 +7,190 @@ import threading
 import random
 from . import clogging as logging
 from time import time, sleep
-from .compat import Queue, thread, urlparse, xrange
+from .compat import PY3, Queue, thread, urlparse, xrange
 from .common import spawn_later
 from .GAEFetch import qGAE, gae_urlfetch
 from .GlobalConfig import GC
-from .HTTPUtil import ssl_connection_cache
+from .HTTPUtil import ssl_connection_pool
 from .GAEUpdata import testip, testallgaeip
 
 getrange = re.compile(r'bytes (\d+)-(\d+)/(\d+)').search
 
+class Segment(object):
+    '''Contiguous bytes written by one fetchlet'''
+    __slots__ = 'start', 'end', 'reserved', 'limit', 'first', 'opened', 'hedge', 'hedged', 'lost', 'closed'
+
+    def __init__(self, start, limit, hedge=False):
+        self.start = start
+        #已写入位置、已预留位置和允许写入的上限
+        self.end = self.reserved = self.first = start
+        self.limit = limit
+        self.opened = time()
+        #备份请求的片段，先写入的一方胜出
+        self.hedge = hedge
+        self.hedged = False
+        self.lost = False
+        self.closed = False
+
+    def speed(self):
+        cost = time() - self.opened
+        return (self.end - self.first) / cost if cost > 0 else 0
+
+class RangeBuffer(object):
+    '''Sliding window buffer that reassembles ranges in byte order'''
+
+    def __init__(self, begin, window):
+        self.data = bytearray(window)
+        self.view = memoryview(self.data)
+        self.window = window
+        #下一个要输出的位置，窗口为 [begin, begin+window)
+        self.begin = begin
+        #以开始位置为键，输出时跟随 begin 移动
+        self.segments = {}
+        self.cond = threading.Condition()
+        self.stopped = False
+        #因窗口已满而等待的写入者数量
+        self.blocked = 0
+
+    def wait(self, deadline):
+        #调用前须持有 cond
+        timeout = deadline - time()
+        if timeout <= 0:
+            return False
+        self.cond.wait(min(timeout, 1))
+        return True
+
+    def open(self, start, limit, hedge=False):
+        segment = Segment(start, limit, hedge)
+        with self.cond:
+            #不覆盖后面已被备份请求占用的部分
+            for other in self.segments.values():
+                if start < other.start < segment.limit:
+                    segment.limit = other.start
+            if not hedge:
+                self.segments[start] = segment
+        return segment
+
+    def close(self, segment):
+        with self.cond:
+            segment.closed = True
+            #没有数据的片段直接移除
+            if segment.end == segment.start and self.segments.get(segment.start) is segment:
+                del self.segments[segment.start]
+
+    def head(self):
+        with self.cond:
+            return self.segments.get(self.begin)
+
+    def claim(self, segment):
+        #调用前须持有 cond
+        start = segment.start
+        for other in self.segments.values():
+            if other.start <= start < other.limit:
+                if other.reserved > start:
+                    #原请求已经写到这里，备份请求作废
+                    segment.lost = True
+                    return False
+                other.limit = start
+        segment.hedge = False
+        self.segments[start] = segment
+        return True
+
+    def wait_space(self, end, timeout):
+        '''Wait until the window reaches end, return False if stopped or timeout'''
+        deadline = time() + timeout
+        with self.cond:
+            self.blocked += 1
+            while not self.stopped and end > self.begin + self.window:
+                if not self.wait(deadline):
+                    break
+            self.blocked -= 1
+            return not self.stopped and end <= self.begin + self.window
+
+    def write(self, segment, data):
+        '''Copy data into the window, return the accepted length'''
+        with self.cond:
+            if segment.hedge and not self.claim(segment):
+                return 0
+            pos = segment.reserved
+            n = min(len(data), segment.limit - pos)
+            #超出窗口时等待输出，按窗口字节数进行流量控制
+            if n > 0 and not self.stopped and pos + n > self.begin + self.window:
+                self.blocked += 1
+                while not self.stopped and pos + n > self.begin + self.window:
+                    self.cond.wait(1)
+                self.blocked -= 1
+                #等待期间上限可能被备份请求缩小
+                n = min(n, segment.limit - pos)
+            if self.stopped or n <= 0:
+                return 0
+            segment.reserved += n
+        #预留的位置只有这个片段会写入，复制时不用持有锁
+        window = self.window
+        i = pos % window
+        first = min(n, window - i)
+        self.view[i:i+first] = data[:first]
+        if first < n:
+            self.view[:n-first] = data[first:n]
+        with self.cond:
+            segment.end += n
+            if self.segments.get(self.begin) is segment:
+                self.cond.notify_all()
+        return n
+
+    def read(self, size, timeout):
+        '''Return contiguous data at begin without copying, None if timeout or stopped'''
+        deadline = time() + timeout
+        with self.cond:
+            while True:
+                segment = self.segments.get(self.begin)
+                if segment and segment.end > self.begin:
+                    break
+                if self.stopped or not self.wait(deadline):
+                    return
+            begin = self.begin
+            i = begin % self.window
+            n = min(segment.end - begin, self.window - i, size)
+        #输出前数据不会被覆盖
+        return self.view[i:i+n]
+
+    def consume(self, n):
+        with self.cond:
+            segment = self.segments.pop(self.begin)
+            self.begin += n
+            segment.start = self.begin
+            if segment.end > self.begin or not (segment.closed or segment.end >= segment.limit):
+                self.segments[self.begin] = segment
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+class Throughput(object):
+    '''Exponentially weighted throughput by key'''
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.speeds = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, size, cost):
+        if cost <= 0 or size <= 0:
+            return
+        speed = size / cost
+        with self.lock:
+            old = self.speeds.get(key)
+            self.speeds[key] = speed if old is None else old + (speed - old) * self.alpha
+
+    def get(self, key, default=None):
+        return self.speeds.get(key, default)
+
+    def average(self):
+        speeds = list(self.speeds.values())
+        return sum(speeds) / len(speeds) if speeds else None
+
 class RangeFetch(object):
     """Range Fetch Class"""
 
@@ -26,10 +201,25 @@ class RangeFetch(object):
     lowspeed = GC.AUTORANGE_LOWSPEED or 1024*32
     timeout = min(max(GC.LINK_TIMEOUT-2, 1.5), 3)
     sleeptime = GC.FINDER_MAXTIMEOUT/500.0
+    #分段大小按速度调整的范围，目标是每个分段下载 chunktime 秒，不超过单个线程最大下载量
+    minsize = 65536
+    maxchunk = maxsize
+    chunktime = 4
+    #线程数调整范围
+    minthreads = 2
+    maxthreads = threads * 2
+    #重组窗口大小，足够容纳所有线程正在下载的分段
+    window = maxchunk * threads * 2
+    #检查线程数和备份请求的间隔
+    hedgedelay = 1
+    #等待窗口的时间，超时后放回分段，让出 appid 给重试的分段
+    spacewait = 5
+    #所有下载共享的实时速度
+    ip_speed = Throughput()
+    appid_speed = Throughput()
 
     def __init__(self, handler, url, headers, payload, response):
         self.tLock = threading.Lock()
-        self.expect_begin = 0
         self._stopped = False
         self._last_app_status = {}
         self.lastupdata = testip.lastupdata
@@ -66,90 +256,152 @@ class RangeFetch(object):
         #开始多线程时先测试一遍 IP
         sleeptime = self.sleeptime if testallgaeip(True) else 0
 
-        data_queue = Queue.PriorityQueue()
-        range_queue = Queue.PriorityQueue()
-        range_queue.put((start, end))
-        # py2 弃用，xrange 参数太大时会出错，range 不出错但耗时太多
-        #for begin in range(end+1, length, self.maxsize):
-        #    range_queue.put((begin, min(begin+self.maxsize-1, length-1)))
-        a = end + 1
-        b = end
-        n = (length-a)//self.maxsize
-        for i in xrange(n):
-            b += self.maxsize
-            range_queue.put((a, b))
-            a = b + 1
-        if length > a:
-            range_queue.put((a, length-1))
-
+        #剩余内容不多时不必分配整个窗口
+        buffer = RangeBuffer(start, min(self.window, length - start))
+        #失败后需要重试的分段，其余部分按当前速度切分
+        self.range_queue = Queue.PriorityQueue()
+        self.range_queue.put((start, end))
+        self.next_start = end + 1
+        self.length = length
+        self.nthreads = self.want_threads = self.threads
         for i in xrange(self.threads):
-            range_delay_size = int((self.threads-i) * self.maxsize * self.threads * 0.66)
-            spawn_later(sleeptime if i else 0, self.__fetchlet, range_queue, data_queue, range_delay_size, i+1)
-        has_peek = hasattr(data_queue, 'peek')
+            spawn_later(sleeptime if i else 0, self.__fetchlet, buffer, i+1)
+        write = self.handler.wfile.write
         peek_timeout = 120
-        self.expect_begin = start
-        while self.expect_begin < length:
+        last_data = last_adjust = time()
+        adjust_begin = buffer.begin
+        last_rate = 0
+        while buffer.begin < length:
+            data = buffer.read(65536, self.hedgedelay)
+            now = time()
+            if now - last_adjust > self.hedgedelay:
+                #根据输出速度和窗口状态调整线程数，检查输出位置的分段是否过慢
+                rate = (buffer.begin - adjust_begin) / (now - last_adjust)
+                self.adjust_threads(buffer, rate, last_rate)
+                self.hedge(buffer)
+                last_adjust, adjust_begin, last_rate = now, buffer.begin, rate
+            if data is None:
+                if now - last_data > peek_timeout:
+                    logging.error(u'RangeFetch 等待 %d 位置的数据超时，终止', buffer.begin)
+                    break
+                continue
+            last_data = now
             try:
-                if has_peek:
-                    begin, data = data_queue.peek(timeout=peek_timeout)
-                    if self.expect_begin == begin:
-                        data_queue.get()
-                    elif self.expect_begin < begin:
-                        sleep(0.1)
-                        continue
-                    else:
-                        logging.error('RangeFetch Error: begin(%r) < expect_begin(%r), quit.', begin, self.expect_begin)
-                        break
-                else:
-                    begin, data = data_queue.get(timeout=peek_timeout)
-                    if self.expect_begin == begin:
-                        pass
-                    elif self.expect_begin < begin:
-                        data_queue.put((begin, data))
-                        sleep(0.1)
-                        continue
-                    else:
-                        logging.error('RangeFetch Error: begin(%r) < expect_begin(%r), quit.', begin, self.expect_begin)
-                        break
-            except Queue.Empty:
-                logging.error('data_queue peek timeout, break')
-                break
-            try:
-                self.write(data)
-                self.expect_begin += len(data)
+                write(data if PY3 else data.tobytes())
+                buffer.consume(len(data))
             except Exception as e:
                 logging.info(u'RangeFetch %r 本地链接断开：%r', self.host, e)
                 break
         else:
             logging.info(u'RangeFetch %r 成功完成', self.host)
         self._stopped = True
+        buffer.stop()
+
+    def next_range(self):
+        try:
+            return self.range_queue.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.tLock:
+            start = self.next_start
+            if start >= self.length:
+                return
+            speed = self.appid_speed.average() or self.ip_speed.average()
+            size = int(speed * self.chunktime) if speed else self.maxsize
+            size = min(max(size, self.minsize), self.maxchunk)
+            end = min(start + size, self.length) - 1
+            self.next_start = end + 1
+            return start, end
+
+    def adjust_threads(self, buffer, rate, last_rate):
+        with self.tLock:
+            want = self.want_threads
+            if buffer.blocked:
+                #窗口已满，线程过多，但要留足处理重试分段的线程
+                want = max(want - 1, self.minthreads, self.range_queue.qsize())
+            elif self.next_start < self.length and rate >= last_rate * 0.9:
+                #增加线程仍然有效
+                want = min(want + 1, self.maxthreads)
+            self.want_threads = want
+            spawn = want - self.nthreads
+            if spawn > 0:
+                self.nthreads = want
+        for i in xrange(spawn):
+            spawn_later(0, self.__fetchlet, buffer, want - i)
+
+    def hedge(self, buffer):
+        segment = buffer.head()
+        if not segment or segment.hedged or segment.closed:
+            return
+        speed = segment.speed()
+        average = self.ip_speed.average()
+        if not average or speed * 2 > average:
+            return
+        #原请求在备份请求就绪前还能下载的部分不重复请求
+        start = segment.reserved + int(speed * self.timeout)
+        start -= start % self.bufsize
+        end = segment.limit - 1
+        if end - start < self.minsize:
+            return
+        segment.hedged = True
+        logging.warning(u'RangeFetch %r 分段 %d-%d 速度过慢（%d B/s），备份请求 %d-%d', self.host, segment.first, end, speed, start, end)
+        spawn_later(0, self.__fetchlet, buffer, 0, (start, end))
 
     def address_string(self, response=None):
         return self.handler.address_string(response)
 
-    def __fetchlet(self, range_queue, data_queue, range_delay_size, threadorder):
+    def __fetchlet(self, buffer, threadorder, hedge=None):
         headers = dict((k.title(), v) for k, v in self.headers.items())
         headers['Connection'] = 'close'
+        #备份请求只处理一次，写入数据前失败不用重试，原请求仍在继续
+        def retry(start, end):
+            if not hedge:
+                self.range_queue.put((start, end))
+        tried = False
         while True:
+            if hedge:
+                if tried:
+                    return
+                tried = True
             try:
                 with self.tLock:
                     if self.lastupdata != testip.lastupdata:
                         self.lastupdata = testip.lastupdata
                         self.iplist = GC.IPLIST_MAP['google_gws'][:]
+                    #线程多于需要时退出，还有重试的分段时先处理
+                    if not hedge and self.nthreads > self.want_threads and self.range_queue.empty():
+                        self.nthreads -= 1
+                        return
                 noerror = True
                 response = None
                 starttime = None
                 appid = None
+                #本次循环是否占用了 qGAE，提前退出时不能归还
+                token = False
                 if self._stopped: return
                 try:
-                    start, end = range_queue.get(timeout=1)
+                    if hedge:
+                        #备份请求是额外的，不占用 appid 队列
+                        start, end = hedge
+                        appid = random.choice(GC.GAE_APPIDS)
+                    else:
+                        #先取得 appid 再分配分段，避免前面的分段等待 appid
+                        appid = self.appids.get()
+                        task = self.next_range()
+                        if task is None:
+                            #等待失败的分段
+                            task = self.range_queue.get(timeout=1)
+                        start, end = task
                     headers['Range'] = 'bytes=%d-%d' % (start, end)
-                    appid = self.appids.get()
+                    #等待输出进度，整个分段都要能放入窗口
+                    if not buffer.wait_space(end + 1, self.spacewait):
+                        #超时后放回分段，下次优先取回前面的重试分段
+                        retry(start, end)
+                        continue
                     if self._last_app_status.get(appid, 200) >= 500:
                         sleep(2)
-                    while start - self.expect_begin > self.maxsize and data_queue.qsize() * self.bufsize > range_delay_size:
-                        sleep(0.1)
-                    if self.response:
+                    token = True
+                    if self.response and not hedge:
                         qGAE.get()
                         response = self.response
                         self.response = None
@@ -161,38 +413,43 @@ class RangeFetch(object):
                             realstart = start
                             starttime = time()
                         else:
-                            range_queue.put((start, end))
+                            retry(start, end)
                             continue
                 except Queue.Empty:
                     continue
                 except Exception as e:
                     logging.warning("Response %r in __fetchlet", e)
-                    range_queue.put((start, end))
+                    retry(start, end)
                     continue
                 if not response:
                     logging.warning('RangeFetch %s return %r', headers['Range'], response)
-                    range_queue.put((start, end))
+                    retry(start, end)
                 elif response.app_status != 200:
                     logging.warning('%s Range Fetch "%s %s" %s return %s', self.address_string(response), self.command, self.url, headers['Range'], response.app_status)
-                    range_queue.put((start, end))
+                    retry(start, end)
                 elif response.getheader('Location'):
                     self.url = urlparse.urljoin(self.url, response.getheader('Location'))
                     logging.info('%s RangeFetch Redirect(%r)', self.address_string(response), self.url)
-                    range_queue.put((start, end))
+                    retry(start, end)
                 elif 200 <= response.status < 300:
                     content_range = response.getheader('Content-Range')
                     if not content_range:
                         logging.warning('%s RangeFetch "%s %s" return Content-Range=%r: response headers=%r', self.address_string(response), self.command, self.url, content_range, response.getheaders())
-                        range_queue.put((start, end))
+                        retry(start, end)
                         continue
                     content_length = int(response.getheader('Content-Length', 0))
                     logging.info('%s >>>>>>>>>>>>>>> [%s: %s] %s %s', self.address_string(response), self.host, threadorder, content_length, content_range)
+                    segment = buffer.open(start, end + 1, bool(hedge))
                     try:
                         data = response.read(self.bufsize)
                         while data:
                             if self._stopped: return
-                            data_queue.put((start, data))
-                            start += len(data)
+                            n = buffer.write(segment, data)
+                            start += n
+                            if n < len(data):
+                                #被备份请求或原请求抢先，或已经停止，剩余数据不再读取
+                                noerror = False
+                                break
                             data = response.read(self.bufsize)
                     except Exception as e:
                         noerror = False
@@ -201,29 +458,45 @@ class RangeFetch(object):
                                 self.iplist.remove(response.xip[0])
                                 logging.warning(u'RangeFetch 移除故障 ip %s', response.xip[0])
                         logging.warning(u'%s RangeFetch "%s %s" %s 失败：%r', self.address_string(response), self.command, self.url, headers['Range'], e)
+                    finally:
+                        buffer.close(segment)
+                    if segment.lost:
+                        logging.info(u'%s RangeFetch 备份请求 %s 落后于原请求，放弃', self.address_string(response), headers['Range'])
+                        noerror = False
+                        continue
+                    end = min(end, segment.limit - 1)
                     if start < end + 1:
+                        #还没有抢占的备份请求不重试
+                        if self._stopped or segment.hedge: continue
                         logging.warning(u'%s RangeFetch "%s %s" 重试 %s-%s', self.address_string(response), self.command, self.url, start, end)
-                        range_queue.put((start, end))
+                        self.range_queue.put((start, end))
                         continue
                     logging.info(u'%s >>>>>>>>>>>>>>> 成功接收到 %d 字节', self.address_string(response), start - 1)
                 else:
                     logging.error(u'%s RangeFetch %r 返回 %s', self.address_string(response), self.url, response.status)
-                    range_queue.put((start, end))
+                    retry(start, end)
                     appid = None
             except Exception as e:
                 logging.exception(u'RangeFetch._fetchlet 错误：%r', e)
                 raise
             finally:
-                qGAE.put(True)
-                if appid:
+                if token:
+                    qGAE.put(True)
+                if appid and not hedge:
                     self.appids.put(appid)
                 if response:
                     response.close()
+                    if starttime and start > realstart:
+                        #记录实时速度，用于分段大小和备份请求
+                        cost = time() - starttime
+                        self.ip_speed.update(response.xip[0], start - realstart, cost)
+                        self.appid_speed.update(appid, start - realstart, cost)
                     if noerror and not self._stopped:
                         #移除慢速 ip
                         with self.tLock:
                             if response.xip[0] in self.iplist and starttime and len(self.iplist) > self.minip and (start-realstart)/(time()-starttime) < self.lowspeed:
                                 self.iplist.remove(response.xip[0])
                                 logging.warning(u'RangeFetch 移除慢速 ip %s', response.xip[0])
-                        #放入套接字缓存
-                        ssl_connection_cache['google_gws:443'].append((time(), response.sock))
+                        #放入套接字缓存，HTTP/2 连接由 http2_gws 管理
+                        if response.sock:
+                            ssl_connection_pool.put('google_gws:443', response.sock)
@@ -30,75 +30,7 @@ import ssl
 import socket
 NetWorkIOError = (socket.error, ssl.SSLError, OSError) if not OpenSSL else (socket.error, ssl.SSLError, OpenSSL.SSL.Error, OSError)
 
-import threading
-import collections
-class LRUCache(object):
-    """Modified from http://pypi.python.org/pypi/lru/"""
-
-    def __init__(self, max_items, expire=None):
-        self.cache = {}
-        self.max_items = int(max_items)
-        self.expire = expire
-        self.key_expire = {}
-        self.key_order = collections.deque()
-        self.lock = threading.Lock()
-
-    def __setitem__(self, key, value, expire=None):
-        expire = expire or self.expire
-        with self.lock:
-            if expire:
-                self.key_expire[key] = int(time()) + expire
-            self._mark(key)
-            self.cache[key] = value
-
-    def __getitem__(self, key):
-        with self.lock:
-            self._expire_check(key)
-            if key in self.cache:
-                self._mark(key)
-                return self.cache[key]
-            else:
-                raise KeyError(key)
-
-    def __contains__(self, key):
-        with self.lock:
-            self._expire_check(key)
-            return key in self.cache
-
-    def get(self, key, value=None):
-        with self.lock:
-            self._expire_check(key)
-            if key in self.cache:
-                self._mark(key)
-                return self.cache[key]
-            else:
-                return value
-
-    def _expire_check(self, key):
-        if key in self.key_expire and time() > self.key_expire[key]:
-            self.key_order.remove(key)
-            del self.key_expire[key]
-            del self.cache[key]
-
-    def _mark(self, key):
-        key_order = self.key_order
-        if key in self.cache:
-            try:
-                key_order.remove(key)
-            except ValueError:
-                pass
-        key_order.appendleft(key)
-        while len(key_order) > self.max_items:
-            key = key_order.pop()
-            if key in self.key_expire:
-                del self.key_expire[key]
-            del self.cache[key]
-
-    def clear(self):
-        with self.lock:
-            self.cache.clear()
-            self.key_expire.clear()
-            self.key_order.clear()
+from .lru import LRUCache, StripedLRUCache
 
 import string
 def message_html(title, banner, detail=''):
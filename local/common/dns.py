@@ -9,14 +9,38 @@ except ImportError:
     logging.error(u'无法找到 dnslib，请安装 dnslib-0.8.3 以上版本，或将相应 .egg 放到 %r 文件夹！', packages)
     sys.exit(-1)
 
+import ssl
 import socket
+import struct
+import random
+import threading
 from select import select
-from time import time
-from local.compat import xrange, exc_clear
-from . import LRUCache, isip, isipv4, isipv6
+from time import time, sleep
+from local.compat import thread, xrange, exc_clear
+from . import LRUCache, NetWorkIOError, isip, isipv4, isipv6
 from local.GlobalConfig import GC
 
-dns = LRUCache(128, 4*60*60)
+dns = LRUCache(1024, 4*60*60)
+#解析失败的域名，短时间内不再向同样的服务器查询，键为 (域名, 服务器)
+dns_failed = LRUCache(1024)
+#记录的 TTL 限制在这个范围内
+dns_min_ttl = 60
+dns_max_ttl = 4*60*60
+#域名不存在或没有对应记录
+dns_nxdomain_ttl = 60
+#查询超时或网络错误
+dns_error_ttl = 10
+
+A = dnslib.QTYPE.A
+AAAA = dnslib.QTYPE.AAAA
+
+def profile_qtypes():
+    if GC.LINK_PROFILE == 'ipv4':
+        return (A,)
+    elif GC.LINK_PROFILE == 'ipv6':
+        return (AAAA,)
+    else:
+        return (A, AAAA)
 
 def set_DNS(host, iporname):
     iporname = iporname or ()
@@ -49,62 +73,476 @@ def dns_resolve(host, dnsservers=[]):
             #已经在查找 IP 时过滤 IP 版本
             dns[host] = iplist = GC.IPLIST_MAP['google_gws']
             return iplist
-        if not dnsservers:
+        failed_key = host, tuple(dnsservers)
+        if failed_key in dns_failed:
+            return []
+        iplist, ttl = resolver.resolve(host, dnsservers or GC.DNS_SERVERS, GC.DNS_BLACKLIST, timeout=2)
+        if not iplist and dnsservers:
+            iplist, failed_ttl = resolver.resolve(host, GC.DNS_SERVERS, GC.DNS_BLACKLIST, timeout=2)
+            ttl = failed_ttl if iplist else max(ttl or 0, failed_ttl or 0)
+        if not iplist:
+            #最后使用系统解析，没有记录的 TTL，只缓存较短时间
             try:
                 iplist = list(set(socket.gethostbyname_ex(host)[-1]) - GC.DNS_BLACKLIST)
             except:
                 pass
-        else:
-            iplist = dns_remote_resolve(host, dnsservers, GC.DNS_BLACKLIST, timeout=2)
-        if not iplist:
-            iplist = dns_remote_resolve(host, GC.DNS_SERVERS, GC.DNS_BLACKLIST, timeout=2)
+            if iplist:
+                if GC.LINK_PROFILE == 'ipv4':
+                    iplist = [ip for ip in iplist if isipv4(ip)]
+                elif GC.LINK_PROFILE == 'ipv6':
+                    iplist = [ip for ip in iplist if isipv6(ip)]
+            if iplist:
+                ttl = dns_min_ttl
         if iplist:
-            if GC.LINK_PROFILE == 'ipv4':
-                iplist = [ip for ip in iplist if isipv4(ip)]
-            elif GC.LINK_PROFILE == 'ipv6':
-                iplist = [ip for ip in iplist if isipv6(ip)]
-            dns[host] = iplist = list(set(iplist))
+            iplist = list(set(iplist))
+            dns.__setitem__(host, iplist, ttl)
+        else:
+            dns_failed.__setitem__(failed_key, True, ttl or dns_error_ttl)
     return iplist
 
-def dns_remote_resolve(qname, dnsservers, blacklist, timeout):
+def dns_remote_resolve(qname, dnsservers, blacklist, timeout, qtypes=None):
     """
     http://gfwrev.blogspot.com/2009/11/gfwdns.html
     http://zh.wikipedia.org/wiki/域名服务器缓存污染
     http://support.microsoft.com/kb/241352
     """
-    query = dnslib.DNSRecord(q=dnslib.DNSQuestion(qname))
-    query_data = query.pack()
-    dns_v4_servers = [x for x in dnsservers if isipv4(x)]
-    dns_v6_servers = [x for x in dnsservers if isipv6(x)]
-    sock_v4 = sock_v6 = None
-    socks = []
-    if dns_v4_servers:
-        sock_v4 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        socks.append(sock_v4)
-    if dns_v6_servers:
-        sock_v6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-        socks.append(sock_v6)
-    timeout_at = time() + timeout
-    try:
-        for _ in xrange(2):
+    return resolver.resolve(qname, dnsservers, blacklist, timeout, qtypes)[0]
+
+class UpstreamRTT(object):
+    """Smoothed round trip time of every upstream, unknown ones are tried first"""
+
+    alpha = 0.25
+
+    def __init__(self):
+        self.rtts = {}
+
+    def update(self, server, rtt):
+        old = self.rtts.get(server)
+        self.rtts[server] = rtt if old is None else old + self.alpha * (rtt - old)
+
+    def get(self, server):
+        return self.rtts.get(server, 0)
+
+    def sort(self, servers):
+        return sorted(servers, key=self.get)
+
+upstream_rtt = UpstreamRTT()
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error('connection closed')
+        data += chunk
+    return data
+
+class DNSStreamConnection(object):
+    """One TCP or TLS connection, queries are pipelined and matched by ID"""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        sock = socket.create_connection((upstream.server, upstream.port), upstream.timeout)
+        if upstream.tls_hostname:
+            sock = upstream.ssl_context.wrap_socket(sock, server_hostname=upstream.tls_hostname)
+        sock.settimeout(None)
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        #连接上的事务 ID -> (原事务 ID, 回调, 发送时间)
+        self.pending = {}
+        self.closed = False
+        thread.start_new_thread(self.read_loop, ())
+
+    def send(self, data, callback):
+        with self.upstream.lock:
+            txid = random.randint(0, 0xffff)
+            while txid in self.pending:
+                txid = random.randint(0, 0xffff)
+            self.pending[txid] = data[:2], callback, time()
+        data = struct.pack('!HH', len(data), txid) + data[2:]
+        try:
+            with self.send_lock:
+                self.sock.sendall(data)
+        except NetWorkIOError as e:
+            logging.debug('send dns query to %s failed: %r', self.upstream.name, e)
+            self.close()
+            return False
+        return True
+
+    def read_loop(self):
+        try:
+            while True:
+                length, = struct.unpack('!H', recv_exact(self.sock, 2))
+                data = recv_exact(self.sock, length)
+                txid, = struct.unpack('!H', data[:2])
+                with self.upstream.lock:
+                    item = self.pending.pop(txid, None)
+                if item:
+                    request_id, callback, sent = item
+                    upstream_rtt.update(self.upstream.name, time() - sent)
+                    callback(request_id + data[2:], self.upstream.name)
+        except Exception as e:
+            #服务器关闭了空闲连接
+            logging.debug('dns connection to %s closed: %r', self.upstream.name, e)
+            exc_clear()
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.close()
+            except Exception:
+                pass
+
+class DNSStreamUpstream(object):
+    """Pooled DNS-over-TCP or DNS-over-TLS upstream"""
+
+    max_connections = 2
+    #每个连接上同时等待的查询数，超过后开新连接
+    max_pipeline = 64
+    timeout = 4
+    #连接失败后暂停使用的时间，连续失败时加倍
+    min_backoff = 10
+    max_backoff = 300
+
+    def __init__(self, server, port=53, tls_hostname=None):
+        self.server = server
+        self.port = port
+        self.tls_hostname = tls_hostname
+        self.name = '%s://%s' % ('tls' if tls_hostname else 'tcp', server)
+        if tls_hostname:
+            self.ssl_context = ssl.create_default_context()
+        self.lock = threading.Lock()
+        self.connect_lock = threading.Lock()
+        self.connections = []
+        self.connecting = False
+        self.backoff = self.min_backoff
+        self.retry_time = 0
+
+    def pick_connection(self):
+        """Return the least loaded connection and whether another is needed"""
+        with self.lock:
+            self.connections = connections = [x for x in self.connections if not x.closed]
+            connection = min(connections, key=lambda x: len(x.pending)) if connections else None
+            need = connection is None or len(connection.pending) >= self.max_pipeline and len(connections) < self.max_connections
+            return connection, need
+
+    def connect(self):
+        #调用前须持有 connect_lock
+        if time() < self.retry_time:
+            return
+        try:
+            connection = DNSStreamConnection(self)
+        except NetWorkIOError as e:
+            logging.debug('connect to dns server %s failed: %r', self.name, e)
+            exc_clear()
+            #连接失败时降低优先级，并暂停一段时间
+            upstream_rtt.update(self.name, self.timeout)
+            self.retry_time = time() + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            return
+        self.backoff = self.min_backoff
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def connect_background(self):
+        with self.lock:
+            if self.connecting or time() < self.retry_time:
+                return
+            self.connecting = True
+        thread.start_new_thread(self._connect_background, ())
+
+    def _connect_background(self):
+        try:
+            with self.connect_lock:
+                if self.pick_connection()[1]:
+                    self.connect()
+        finally:
+            self.connecting = False
+
+    def get_connection(self, wait=False):
+        """Without wait, never block on connecting, return None if not connected yet"""
+        connection, need = self.pick_connection()
+        if not need:
+            return connection
+        if wait and connection is None:
+            #同时只建立一个连接，等待的查询随后复用它
+            with self.connect_lock:
+                connection, need = self.pick_connection()
+                if need:
+                    connection = self.connect() or connection
+            return connection
+        self.connect_background()
+        return connection
+
+    def query(self, data, callback, wait=False):
+        """Send a query, callback(reply_data, name) is called from the reader thread"""
+        connection = self.get_connection(wait)
+        return bool(connection) and connection.send(data, callback)
+
+def parse_stream_servers():
+    upstreams = []
+    for server in GC.DNS_TLS_SERVERS:
+        ip, _, hostname = server.partition('@')
+        upstreams.append(DNSStreamUpstream(ip, 853, hostname or ip))
+    for server in GC.DNS_TCP_SERVERS:
+        upstreams.append(DNSStreamUpstream(server))
+    return upstreams
+
+#首选的 TCP/TLS 上游，UDP 作为竞速备用
+stream_upstreams = parse_stream_servers()
+#UDP 回复被截断时改用 TCP 向同一服务器查询
+tcp_fallbacks = {}
+
+def get_tcp_fallback(server):
+    upstream = tcp_fallbacks.get(server)
+    if upstream is None:
+        upstream = tcp_fallbacks.setdefault(server, DNSStreamUpstream(server))
+    return upstream
+
+def race_delay(name):
+    #TCP/TLS 超过两倍平均用时还没回复就开始 UDP 查询
+    return min(max(upstream_rtt.get(name) * 2, 0.1), 1)
+
+def query_stream(data, callback, upstreams=None):
+    """Send through the fastest connected TCP/TLS upstream, return its name or None
+
+    Upstreams that are not connected yet connect in the background, the
+    caller should go on with UDP at once when None is returned.
+    """
+    for upstream in sorted(stream_upstreams if upstreams is None else upstreams, key=lambda x: upstream_rtt.get(x.name)):
+        if upstream.query(data, callback):
+            return upstream.name
+
+def from_stream(name, upstreams, servers):
+    """Whether a TCP/TLS reply from name answers a query sent to upstreams or servers"""
+    if any(x.name == name for x in upstreams):
+        return True
+    #截断后向同一服务器的 TCP 查询
+    return any(x in tcp_fallbacks and tcp_fallbacks[x].name == name for x in servers)
+
+class DNSQuery(object):
+    """One question sent to several servers under one transaction ID"""
+    __slots__ = ('txid', 'qname', 'qtype', 'servers', 'upstreams', 'blacklist', 'data', 'event', 'iplist',
+                 'ttl', 'negative', 'confirmed', 'deadline', 'next_send', 'rounds', 'sent')
+
+    def __init__(self, txid, qname, qtype, servers, upstreams, blacklist, timeout):
+        self.txid = txid
+        self.qname = qname
+        self.qtype = qtype
+        self.servers = servers
+        #同时使用的 TCP/TLS 上游
+        self.upstreams = upstreams
+        self.blacklist = blacklist
+        query = dnslib.DNSRecord(dnslib.DNSHeader(id=txid, rd=1), q=dnslib.DNSQuestion(qname, qtype))
+        #可以接收大于 512 字节的 UDP 回复
+        query.add_ar(dnslib.EDNS0(udp_len=4096))
+        self.data = query.pack()
+        self.event = threading.Event()
+        self.iplist = []
+        self.ttl = None
+        #回复了域名不存在或没有记录的服务器
+        self.negative = set()
+        #确认域名不存在或没有记录
+        self.confirmed = False
+        self.deadline = time() + timeout
+        self.next_send = 0
+        self.rounds = 0
+        self.sent = {}
+
+class DNSResolver(object):
+    """Multiplex queries over long-lived UDP sockets, one per upstream server"""
+
+    #没有回复时重新发送的间隔
+    resend_interval = 0.8
+    #第一轮只向最快的几个服务器发送
+    first_round_servers = 2
+    max_pending = 4096
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.socks = {}
+        self.servers = {}
+        #按事务 ID 查找等待回复的查询
+        self.pending = {}
+        #合并对同一问题的并发查询
+        self.inflight = {}
+        self.running = False
+        #没有等待回复的查询时，循环线程在此等待新的查询
+        self.wakeup = threading.Event()
+
+    def get_sock(self, server):
+        #调用前须持有 lock
+        sock = self.socks.get(server)
+        if sock is None:
+            family = socket.AF_INET6 if isipv6(server) else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            sock.connect((server, 53))
+            self.socks[server] = sock
+            self.servers[sock] = server
+        return sock
+
+    def send(self, query):
+        now = time()
+        query.next_send = now + self.resend_interval
+        servers = [x for x in upstream_rtt.sort(query.servers) if x not in query.negative]
+        if query.rounds == 0:
+            servers = servers[:self.first_round_servers]
+        query.rounds += 1
+        for server in servers:
             try:
-                for dnsserver in dns_v4_servers:
-                    sock_v4.sendto(query_data, (dnsserver, 53))
-                for dnsserver in dns_v6_servers:
-                    sock_v6.sendto(query_data, (dnsserver, 53))
-                while time() < timeout_at:
-                    ins, _, _ = select(socks, [], [], 0.1)
-                    for sock in ins:
-                        reply_data, _ = sock.recvfrom(512)
-                        reply = dnslib.DNSRecord.parse(reply_data)
-                        iplist = [str(x.rdata) for x in reply.rr if x.rtype == 1]
-                        if any(x in blacklist for x in iplist):
-                            logging.warning('query qname=%r reply bad iplist=%r', qname, iplist)
-                        else:
-                            logging.debug('query qname=%r reply iplist=%s', qname, iplist)
-                            return iplist
+                with self.lock:
+                    sock = self.get_sock(server)
+                sock.send(query.data)
+                query.sent.setdefault(server, now)
             except socket.error as e:
-                logging.warning('handle dns query=%s socket: %r', query, e)
-    finally:
-        for sock in socks:
-            sock.close()
+                logging.debug('send dns query qname=%r to %r failed: %r', query.qname, server, e)
+                exc_clear()
+
+    def submit(self, qname, qtype, servers, upstreams, blacklist, timeout):
+        key = qname, qtype, servers
+        with self.lock:
+            query = self.inflight.get(key)
+            if query:
+                return query
+            if len(self.pending) >= self.max_pending:
+                return
+            txid = random.randint(0, 0xffff)
+            while txid in self.pending:
+                txid = random.randint(0, 0xffff)
+            query = DNSQuery(txid, qname, qtype, servers, upstreams, blacklist, timeout)
+            self.pending[txid] = query
+            self.inflight[key] = query
+            self.wakeup.set()
+            if not self.running:
+                self.running = True
+                thread.start_new_thread(self.loop, ())
+        name = query_stream(query.data, self.handle_stream_reply, query.upstreams)
+        if name:
+            #UDP 延后发送，与 TCP/TLS 竞速
+            query.next_send = time() + race_delay(name)
+        else:
+            self.send(query)
+        return query
+
+    def finish(self, query):
+        #调用前须持有 lock
+        if self.pending.get(query.txid) is query:
+            del self.pending[query.txid]
+        key = query.qname, query.qtype, query.servers
+        if self.inflight.get(key) is query:
+            del self.inflight[key]
+        query.event.set()
+
+    def resolve(self, qname, servers, blacklist, timeout, qtypes=None):
+        """Return (iplist, ttl), A and AAAA queries are sent together"""
+        servers = tuple(x for x in servers if isip(x))
+        if not servers:
+            return [], None
+        #TCP/TLS 上游代替的是默认服务器，指定了其它服务器时只用 UDP 查询
+        upstreams = stream_upstreams if servers == tuple(x for x in GC.DNS_SERVERS if isip(x)) else ()
+        queries = [self.submit(qname, qtype, servers, upstreams, blacklist, timeout) for qtype in qtypes or profile_qtypes()]
+        iplist = []
+        ttls = []
+        negative = True
+        for query in queries:
+            if query is None:
+                negative = False
+                continue
+            query.event.wait(max(query.deadline - time(), 0) + 0.1)
+            if query.iplist:
+                iplist.extend(query.iplist)
+                ttls.append(query.ttl)
+            elif not query.confirmed:
+                negative = False
+        if iplist:
+            return iplist, min(max(min(ttls), dns_min_ttl), dns_max_ttl)
+        return [], dns_nxdomain_ttl if negative else dns_error_ttl
+
+    def handle_stream_reply(self, data, name):
+        self.handle_reply(name, data, True)
+
+    def handle_reply(self, server, data, stream=False):
+        try:
+            reply = dnslib.DNSRecord.parse(data)
+        except Exception as e:
+            logging.debug('parse dns reply from %r failed: %r', server, e)
+            return
+        with self.lock:
+            query = self.pending.get(reply.header.id)
+        if query is None or not reply.questions:
+            return
+        #TCP/TLS 回复须来自这次查询使用的上游
+        expected = from_stream(server, query.upstreams, query.servers) if stream else server in query.servers
+        if not expected:
+            return
+        question = reply.questions[0]
+        if question.qtype != query.qtype or str(question.qname).rstrip('.').lower() != query.qname.rstrip('.').lower():
+            return
+        if reply.header.tc:
+            #回复被截断，改用 TCP 查询
+            if not stream:
+                thread.start_new_thread(get_tcp_fallback(server).query, (query.data, self.handle_stream_reply, True))
+            return
+        if server in query.sent:
+            upstream_rtt.update(server, time() - query.sent[server])
+        rrs = [x for x in reply.rr if x.rtype == query.qtype]
+        iplist = [str(x.rdata) for x in rrs]
+        if any(x in query.blacklist for x in iplist):
+            logging.warning('query qname=%r reply bad iplist=%r', query.qname, iplist)
+            return
+        with self.lock:
+            if iplist:
+                logging.debug('query qname=%r qtype=%r reply iplist=%s', query.qname, query.qtype, iplist)
+                query.iplist = iplist
+                query.ttl = min(x.ttl for x in rrs)
+                self.finish(query)
+            elif reply.header.rcode in (0, 3):
+                #没有记录或域名不存在，TCP/TLS 的回复可信，UDP 等待其它服务器
+                query.negative.add(server)
+                if stream or len(query.negative) == len(query.servers):
+                    query.confirmed = True
+                    self.finish(query)
+
+    def loop(self):
+        while True:
+            with self.lock:
+                socks = list(self.servers)
+                pending = list(self.pending.values())
+                if not pending:
+                    #在锁内清除，submit 加入查询后再设置，不会错过唤醒
+                    self.wakeup.clear()
+            if not pending:
+                self.wakeup.wait()
+                continue
+            now = time()
+            for query in pending:
+                if now > query.deadline:
+                    with self.lock:
+                        self.finish(query)
+                elif now > query.next_send:
+                    self.send(query)
+            if not socks:
+                sleep(0.1)
+                continue
+            try:
+                ins, _, _ = select(socks, [], [], 0.1)
+            except (socket.error, ValueError) as e:
+                logging.debug('dns resolver select failed: %r', e)
+                exc_clear()
+                ins = []
+            for sock in ins:
+                while True:
+                    try:
+                        data = sock.recv(65536)
+                    except socket.error:
+                        #没有更多数据或 ICMP 端口不可达
+                        exc_clear()
+                        break
+                    self.handle_reply(self.servers.get(sock), data)
+
+resolver = DNSResolver()
@@ -0,0 +1,553 @@
+# coding:utf-8
+'''IP range sets packed in sorted integer arrays'''
+
+import os
+import sys
+import mmap
+import socket
+import struct
+import random
+from array import array
+from bisect import bisect, bisect_left
+from heapq import merge
+from binascii import hexlify, unhexlify
+from operator import sub
+from local.compat import PY3, xrange
+
+try:
+    from itertools import accumulate
+except ImportError:
+    def accumulate(iterable):
+        total = 0
+        for n in iterable:
+            total += n
+            yield total
+
+def ip4_to_int(ip):
+    if ip.count('.') != 3:
+        raise ValueError('invalid IPv4 address: %r' % ip)
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+def int_to_ip4(n):
+    return socket.inet_ntoa(struct.pack('!I', n))
+
+if hasattr(socket, 'inet_pton'):
+    def ip6_to_int(ip):
+        return int(hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
+
+    def int_to_ip6(n):
+        return socket.inet_ntop(socket.AF_INET6, unhexlify('%032x' % n))
+else:
+    # Windows 上的 Python 2 没有 inet_pton
+    def ip6_to_int(ip):
+        if '::' in ip:
+            head, tail = ip.split('::', 1)
+            head = head.split(':') if head else []
+            tail = tail.split(':') if tail else []
+            words = head + ['0'] * (8 - len(head) - len(tail)) + tail
+        else:
+            words = ip.split(':')
+        if len(words) != 8 or not all(0 < len(w) <= 4 for w in words):
+            raise ValueError('invalid IPv6 address: %r' % ip)
+        n = 0
+        for w in words:
+            n = n << 16 | int(w, 16)
+        return n
+
+    def int_to_ip6(n):
+        return ':'.join('%x' % (n >> s & 0xffff) for s in xrange(112, -16, -16))
+
+class Packed128(object):
+    '''A sequence of 128-bit unsigned ints stored big-endian in a buffer'''
+    __slots__ = 'buf',
+
+    def __init__(self, buf=None):
+        self.buf = bytearray() if buf is None else buf
+
+    def __len__(self):
+        return len(self.buf) // 16
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(len(self))
+            return Packed128(bytearray(self.buf[start*16:stop*16]))
+        if i < 0:
+            i += len(self)
+        return int(hexlify(self.buf[i*16:i*16+16]), 16)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def append(self, n):
+        self.buf += unhexlify('%032x' % n)
+
+    def extend(self, other):
+        self.buf += other.buf
+
+    def tobytes(self):
+        return bytes(self.buf)
+
+class Family(object):
+    def __init__(self, version, bits, new, to_int, to_str):
+        self.version = version
+        self.bits = bits
+        self.max = (1 << bits) - 1
+        self.new = new
+        self.to_int = to_int
+        self.to_str = to_str
+
+V4 = Family(4, 32, lambda: array('I'), ip4_to_int, int_to_ip4)
+V6 = Family(6, 128, Packed128, ip6_to_int, int_to_ip6)
+
+class Ranges(object):
+    '''Sorted, disjoint, inclusive [start, end] ranges of one address family'''
+
+    def __init__(self, family, starts=None, ends=None):
+        self.family = family
+        self.starts = family.new() if starts is None else starts
+        self.ends = family.new() if ends is None else ends
+
+    @classmethod
+    def from_pairs(cls, family, pairs, presorted=False):
+        #排序后合并重叠、相邻的区间
+        ranges = cls(family)
+        starts = ranges.starts
+        ends = ranges.ends
+        cur_start = cur_end = None
+        for start, end in (pairs if presorted else sorted(pairs)):
+            if cur_end is not None and start <= cur_end + 1:
+                if end > cur_end:
+                    cur_end = end
+                continue
+            if cur_end is not None:
+                starts.append(cur_start)
+                ends.append(cur_end)
+            cur_start, cur_end = start, end
+        if cur_end is not None:
+            starts.append(cur_start)
+            ends.append(cur_end)
+        return ranges
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends) if PY3 else iter(zip(self.starts, self.ends))
+
+    def __contains__(self, n):
+        i = bisect(self.starts, n) - 1
+        return i >= 0 and n <= self.ends[i]
+
+    def count(self):
+        return sum(map(sub, self.ends, self.starts)) + len(self)
+
+    def _copy(self, out, begin, end):
+        if begin < end:
+            if PY3 and isinstance(out.starts, array):
+                #映射的 memoryview 和 array 都可以直接复制内存
+                out.starts.frombytes(memoryview(self.starts)[begin:end].cast('B'))
+                out.ends.frombytes(memoryview(self.ends)[begin:end].cast('B'))
+            else:
+                out.starts.extend(self.starts[begin:end])
+                out.ends.extend(self.ends[begin:end])
+
+    def difference(self, other):
+        '''Ranges of self that are not in other
+
+        Untouched runs of self are copied as slices, so removing a few
+        ranges from a large set costs O(k log n) plus the copy.
+        '''
+        out = Ranges(self.family)
+        starts, ends = self.starts, self.ends
+        n = len(self)
+        pos = 0
+        #当前区间被截掉前半段后的新起点
+        head = None
+        for ostart, oend in other:
+            k = bisect_left(ends, ostart, pos)
+            if k > pos:
+                if head is not None:
+                    out.starts.append(head)
+                    out.ends.append(ends[pos])
+                    pos += 1
+                    head = None
+                self._copy(out, pos, k)
+                pos = k
+            while pos < n:
+                start = starts[pos] if head is None else head
+                if start > oend:
+                    break
+                end = ends[pos]
+                if start < ostart:
+                    out.starts.append(start)
+                    out.ends.append(ostart - 1)
+                if end > oend:
+                    head = oend + 1
+                    break
+                pos += 1
+                head = None
+            if pos >= n:
+                break
+        if pos < n:
+            if head is not None:
+                out.starts.append(head)
+                out.ends.append(ends[pos])
+                pos += 1
+            self._copy(out, pos, n)
+        return out
+
+    def intersection(self, other):
+        small, large = (self, other) if len(self) <= len(other) else (other, self)
+        out = Ranges(self.family)
+        lstarts, lends = large.starts, large.ends
+        n = len(large)
+        for start, end in small:
+            i = bisect_left(lends, start)
+            while i < n and lstarts[i] <= end:
+                out.starts.append(max(start, lstarts[i]))
+                out.ends.append(min(end, lends[i]))
+                i += 1
+        return out
+
+    def union(self, other):
+        return Ranges.from_pairs(self.family, list(self) + list(other))
+
+class IPSet(object):
+    '''IPv4 and IPv6 addresses, CIDR blocks and ranges as packed int ranges
+
+    Text lists take one entry per line: an address, a CIDR block or a
+    first-last range. The binary form can be memory-mapped.
+    '''
+
+    header = struct.Struct('<4sHHQdII')
+    magic = b'GXIP'
+    version = 1
+
+    def __init__(self, v4=None, v6=None):
+        self.v4 = Ranges(V4) if v4 is None else v4
+        self.v6 = Ranges(V6) if v6 is None else v6
+
+    @classmethod
+    def parse(cls, lines):
+        pairs = {4: [], 6: []}
+        #单个 IPv4 地址最常见，打包后批量转换、排序
+        singles = []
+        inet_aton = socket.inet_aton
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                if line.count('.') == 3 and '/' not in line and '-' not in line:
+                    singles.append(inet_aton(line))
+                    continue
+                family = V6 if ':' in line else V4
+                if '/' in line:
+                    ip, bits = line.split('/', 1)
+                    host = family.bits - int(bits)
+                    if not 0 <= host <= family.bits:
+                        continue
+                    start = family.to_int(ip) >> host << host
+                    end = start | (1 << host) - 1
+                elif '-' in line:
+                    first, last = line.split('-', 1)
+                    start = family.to_int(first.strip())
+                    end = family.to_int(last.strip())
+                    if start > end:
+                        continue
+                else:
+                    start = end = family.to_int(line)
+            except (socket.error, ValueError, struct.error):
+                continue
+            pairs[family.version].append((start, end))
+        packed = array('I')
+        if PY3:
+            packed.frombytes(b''.join(singles))
+        else:
+            packed.fromstring(b''.join(singles))
+        if sys.byteorder == 'little':
+            packed.byteswap()
+        del singles
+        runs = []
+        start = end = None
+        for n in sorted(packed):
+            if end is not None and n <= end + 1:
+                end = n
+                continue
+            if end is not None:
+                runs.append((start, end))
+            start = end = n
+        if end is not None:
+            runs.append((start, end))
+        if pairs[4]:
+            runs = merge(runs, sorted(pairs[4]))
+        v4 = Ranges.from_pairs(V4, runs, presorted=True)
+        return cls(v4, Ranges.from_pairs(V6, pairs[6]))
+
+    @classmethod
+    def from_prefixes(cls, prefixes):
+        '''IPv4 ranges matching textual prefixes such as '74.125.' or '1.2'''
+        pairs = []
+        for prefix in prefixes:
+            parts = prefix.split('.')
+            if ':' in prefix or len(parts) > 4 or not all(p.isdigit() for p in parts[:-1]):
+                continue
+            fixed = [int(p) for p in parts[:-1]]
+            if any(p > 255 for p in fixed):
+                continue
+            free = 3 - len(fixed)
+            for v in xrange(256):
+                if str(v).startswith(parts[-1]):
+                    base = 0
+                    for p in fixed + [v]:
+                        base = base << 8 | p
+                    pairs.append((base << 8 * free, (base + 1 << 8 * free) - 1))
+        return cls(Ranges.from_pairs(V4, pairs))
+
+    @classmethod
+    def from_file(cls, path, cachefile=None):
+        '''Load a text list, through the binary cache when it is up to date'''
+        st = os.stat(path)
+        stamp = st.st_size, st.st_mtime
+        if cachefile and os.path.exists(cachefile):
+            try:
+                ipset = cls.load(cachefile, stamp)
+                if ipset is not None:
+                    return ipset
+            except (IOError, OSError, ValueError, struct.error):
+                pass
+        with open(path, 'r') as fd:
+            ipset = cls.parse(fd)
+        if cachefile:
+            try:
+                ipset.save(cachefile, stamp)
+            except (IOError, OSError):
+                #映射中的文件在 Windows 上无法替换，下次再写
+                pass
+        return ipset
+
+    @classmethod
+    def load(cls, path, stamp=None):
+        with open(path, 'rb') as fd:
+            if os.fstat(fd.fileno()).st_size < cls.header.size:
+                return
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, size, mtime, n4, n6 = cls.header.unpack(mm[:cls.header.size])
+        if magic != cls.magic or version != cls.version:
+            return
+        if stamp and (size, mtime) != stamp:
+            return
+        if len(mm) != cls.header.size + n4 * 8 + n6 * 32:
+            return
+        offset = cls.header.size
+        if PY3 and sys.byteorder == 'little':
+            view = memoryview(mm)
+            get4 = lambda o, n: view[o:o+n*4].cast('I')
+            get6 = lambda o, n: Packed128(view[o:o+n*16])
+        else:
+            def get4(o, n):
+                a = array('I')
+                a.fromstring(mm[o:o+n*4])
+                if sys.byteorder == 'big':
+                    a.byteswap()
+                return a
+            get6 = lambda o, n: Packed128(bytearray(mm[o:o+n*16]))
+        starts4 = get4(offset, n4)
+        ends4 = get4(offset + n4 * 4, n4)
+        offset += n4 * 8
+        starts6 = get6(offset, n6)
+        ends6 = get6(offset + n6 * 16, n6)
+        return cls(Ranges(V4, starts4, ends4), Ranges(V6, starts6, ends6))
+
+    def save(self, path, stamp=(0, 0)):
+        def pack4(seq):
+            a = seq if isinstance(seq, array) else array('I', seq)
+            if sys.byteorder == 'big':
+                a = array('I', a)
+                a.byteswap()
+            return a.tobytes() if PY3 else a.tostring()
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'wb') as fd:
+            fd.write(self.header.pack(self.magic, self.version, 0, stamp[0], stamp[1],
+                                      len(self.v4), len(self.v6)))
+            fd.write(pack4(self.v4.starts))
+            fd.write(pack4(self.v4.ends))
+            fd.write(self.v6.starts.tobytes())
+            fd.write(self.v6.ends.tobytes())
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpfile, path)
+
+    def _ranges(self, ip):
+        if ':' in ip:
+            return self.v6, V6.to_int(ip)
+        return self.v4, V4.to_int(ip)
+
+    def __contains__(self, ip):
+        try:
+            ranges, n = self._ranges(ip)
+        except (socket.error, ValueError, struct.error):
+            return False
+        return n in ranges
+
+    def count(self):
+        return self.v4.count() + self.v6.count()
+
+    def difference(self, other):
+        return IPSet(self.v4.difference(other.v4), self.v6.difference(other.v6))
+
+    def intersection(self, other):
+        return IPSet(self.v4.intersection(other.v4), self.v6.intersection(other.v6))
+
+    def union(self, other):
+        return IPSet(self.v4.union(other.v4), self.v6.union(other.v6))
+
+class Cumulative(object):
+    '''Address counts up to and including each range, for bisect'''
+    __slots__ = 'acc',
+
+    def __init__(self, ranges):
+        #每个区间的地址数是 end - start + 1，加 1 在取值时补上
+        acc = accumulate(map(sub, ranges.ends, ranges.starts))
+        self.acc = array('d', acc) if ranges.family is V4 else list(acc)
+
+    def __len__(self):
+        return len(self.acc)
+
+    def __getitem__(self, i):
+        return self.acc[i] + i + 1
+
+class IPSampler(object):
+    '''Draw random addresses from an IPSet without repeats
+
+    Addresses are never materialised, so whole /12 blocks cost the same
+    as a single address. Drawn addresses are remembered until the set is
+    exhausted.
+    '''
+
+    #IPv6 区间往往极大，按此上限计算两种地址的抽取比例
+    v6_weight_max = 1 << 32
+
+    def __init__(self, ipset):
+        self.ipset = ipset
+        self.counts = ipset.v4.count(), ipset.v6.count()
+        self.total = sum(self.counts)
+        self.weights = self.counts[0], min(self.counts[1], self.v6_weight_max)
+        self.cumulative = None
+        self.taken = set()
+
+    def __len__(self):
+        return min(self.total - len(self.taken), sys.maxsize)
+
+    def __bool__(self):
+        return self.total > len(self.taken)
+
+    __nonzero__ = __bool__
+
+    def _key(self, family, n):
+        return n if family is V4 else n + (1 << 32)
+
+    def _random(self):
+        if self.cumulative is None:
+            self.cumulative = Cumulative(self.ipset.v4), Cumulative(self.ipset.v6)
+        weight = sum(self.weights)
+        index = 0 if random.random() * weight < self.weights[0] else 1
+        ranges = (self.ipset.v4, self.ipset.v6)[index]
+        cumulative = self.cumulative[index]
+        r = random.randrange(self.counts[index])
+        i = bisect(cumulative, r)
+        offset = r - (cumulative[i - 1] if i else 0)
+        return ranges.family, ranges.starts[i] + int(offset)
+
+    def pop(self):
+        if not self:
+            return
+        for _ in xrange(64):
+            family, n = self._random()
+            key = self._key(family, n)
+            if key not in self.taken:
+                self.taken.add(key)
+                return family.to_str(n)
+        #重复太多时顺序查找未取出的地址
+        for ranges in (self.ipset.v4, self.ipset.v6):
+            for start, end in ranges:
+                n = start
+                while n <= end:
+                    key = self._key(ranges.family, n)
+                    if key not in self.taken:
+                        self.taken.add(key)
+                        return ranges.family.to_str(n)
+                    n += 1
+
+def test(count=1000000, exclude=2000, draws=10000):
+    '''Compare with the string sets used by GAEFinder.readiplist before'''
+    import gc
+    import shutil
+    import tempfile
+    from time import time
+    from local import clogging as logging
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    def measure(name, func):
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        start = time()
+        result = func()
+        cost = time() - start
+        if tracemalloc:
+            memory = tracemalloc.get_traced_memory()[1] / 1048576.0
+            tracemalloc.stop()
+        else:
+            memory = 0
+        logging.info(u'%-24s %.3fs，峰值内存 %.1fMB', name, cost, memory)
+        return result
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ipfile = os.path.join(tmpdir, 'ip.txt')
+        cachefile = os.path.join(tmpdir, 'ip.bin')
+        base = ip4_to_int('64.0.0.0')
+        ips = [int_to_ip4(base + random.randrange(1 << 24)) for _ in xrange(count)]
+        with open(ipfile, 'w') as fd:
+            for ip in ips:
+                fd.write(ip)
+                fd.write('\n')
+            #整段 /12 不展开
+            fd.write('172.16.0.0/12\n')
+        excluded = set(random.sample(ips, exclude))
+
+        def string_sets():
+            ipset = set()
+            with open(ipfile, 'r') as fd:
+                for line in fd:
+                    if '/' not in line:
+                        ipset.add(line.strip('\r\n'))
+            return list(ipset - excluded)
+
+        def parse():
+            return IPSet.from_file(ipfile, cachefile).difference(IPSet.parse(excluded))
+
+        def load():
+            return IPSet.from_file(ipfile, cachefile).difference(IPSet.parse(excluded))
+
+        measure(u'字符串集合（不含 /12）', string_sets)
+        measure(u'解析文本并写入缓存', parse)
+        ipset = measure(u'映射缓存并做差集', load)
+        sampler = IPSampler(ipset)
+        start = time()
+        for _ in xrange(draws):
+            ip = sampler.pop()
+            assert ip not in excluded and ip in ipset
+        cost = time() - start
+        logging.info(u'共 %d 个地址，%d 个区间，随机抽取 %.2fus/次', ipset.count(),
+                     len(ipset.v4), cost / draws * 1e6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,218 @@
+# coding:utf-8
+'''LRU caches with lazy expiry'''
+
+import threading
+import collections
+from local.compat import monotonic, xrange
+
+class LRUCache(object):
+    """Modified from http://pypi.python.org/pypi/lru/"""
+
+    #写入时批量清理过期条目的间隔
+    sweep_interval = 1
+
+    def __init__(self, max_items, expire=None):
+        #按使用顺序排列，最近使用的在末尾
+        self.cache = collections.OrderedDict()
+        self.max_items = int(max_items)
+        self.expire = expire
+        #按写入顺序排列，有效期相同时也就是按过期顺序排列
+        self.key_expire = collections.OrderedDict()
+        self.next_sweep = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __setitem__(self, key, value, expire=None):
+        expire = expire or self.expire
+        with self.lock:
+            now = monotonic()
+            if key in self.key_expire:
+                del self.key_expire[key]
+            if expire:
+                self.key_expire[key] = now + expire
+            if now > self.next_sweep:
+                self._sweep(now)
+            self._mark(key)
+            self.cache[key] = value
+            if len(self.cache) > self.max_items:
+                self._evict()
+
+    def __getitem__(self, key):
+        with self.lock:
+            self._expire_check(key)
+            if key in self.cache:
+                self._mark(key)
+                return self.cache[key]
+            else:
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            self._expire_check(key)
+            return key in self.cache
+
+    def get(self, key, value=None):
+        with self.lock:
+            self._expire_check(key)
+            if key in self.cache:
+                self._mark(key)
+                return self.cache[key]
+            else:
+                return value
+
+    def pop(self, key, value=None):
+        with self.lock:
+            self.key_expire.pop(key, None)
+            return self.cache.pop(key, value)
+
+    def _expire_check(self, key):
+        if key in self.key_expire and monotonic() > self.key_expire[key]:
+            del self.key_expire[key]
+            del self.cache[key]
+
+    def _sweep(self, now):
+        #从最早写入的条目开始清理，遇到未过期的条目就停止
+        key_expire = self.key_expire
+        cache = self.cache
+        while key_expire:
+            key = next(iter(key_expire))
+            if key_expire[key] > now:
+                break
+            del key_expire[key]
+            del cache[key]
+        self.next_sweep = now + self.sweep_interval
+
+    def _evict(self):
+        key, _ = self.cache.popitem(last=False)
+        self.key_expire.pop(key, None)
+
+    def _mark(self, key):
+        cache = self.cache
+        if key in cache:
+            try:
+                cache.move_to_end(key)
+            except AttributeError:
+                # python 2 没有 move_to_end
+                cache[key] = cache.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.key_expire.clear()
+
+class StripedLRUCache(object):
+    '''Split keys over several LRUCache to reduce lock contention'''
+
+    def __init__(self, max_items, expire=None, stripes=16):
+        self.stripes = stripes
+        self.caches = [LRUCache(max(max_items // stripes, 1), expire) for _ in xrange(stripes)]
+
+    def _cache(self, key):
+        return self.caches[hash(key) % self.stripes]
+
+    def __len__(self):
+        return sum(len(cache) for cache in self.caches)
+
+    def __setitem__(self, key, value, expire=None):
+        self._cache(key).__setitem__(key, value, expire)
+
+    def __getitem__(self, key):
+        return self._cache(key)[key]
+
+    def __contains__(self, key):
+        return key in self._cache(key)
+
+    def get(self, key, value=None):
+        return self._cache(key).get(key, value)
+
+    def pop(self, key, value=None):
+        return self._cache(key).pop(key, value)
+
+    def clear(self):
+        for cache in self.caches:
+            cache.clear()
+
+def test(sizes=(10000, 100000, 1000000), max_items=1024, threads=8):
+    '''Compare with the deque based LRUCache used before'''
+    import random
+    from time import time
+    from local import clogging as logging
+
+    class DequeLRUCache(object):
+        #旧的实现，移动和过期检查都要 O(n) 的 deque.remove
+        def __init__(self, max_items, expire=None):
+            self.cache = {}
+            self.max_items = int(max_items)
+            self.expire = expire
+            self.key_expire = {}
+            self.key_order = collections.deque()
+            self.lock = threading.Lock()
+
+        def __setitem__(self, key, value, expire=None):
+            expire = expire or self.expire
+            with self.lock:
+                if expire:
+                    self.key_expire[key] = int(time()) + expire
+                self._mark(key)
+                self.cache[key] = value
+
+        def get(self, key, value=None):
+            with self.lock:
+                self._expire_check(key)
+                if key in self.cache:
+                    self._mark(key)
+                    return self.cache[key]
+                else:
+                    return value
+
+        def _expire_check(self, key):
+            if key in self.key_expire and time() > self.key_expire[key]:
+                self.key_order.remove(key)
+                del self.key_expire[key]
+                del self.cache[key]
+
+        def _mark(self, key):
+            key_order = self.key_order
+            if key in self.cache:
+                try:
+                    key_order.remove(key)
+                except ValueError:
+                    pass
+            key_order.appendleft(key)
+            while len(key_order) > self.max_items:
+                key = key_order.pop()
+                if key in self.key_expire:
+                    del self.key_expire[key]
+                del self.cache[key]
+
+    def run(cache, ops):
+        #三成写入，七成读取，键的范围是容量的两倍
+        for key, write in ops:
+            if write:
+                cache[key] = key
+            else:
+                cache.get(key)
+
+    def run_threads(cache, ops):
+        n = len(ops) // threads
+        workers = [threading.Thread(target=run, args=(cache, ops[i*n:(i+1)*n])) for i in xrange(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    for size in sizes:
+        ops = [(random.randrange(max_items * 2), random.random() < 0.3) for _ in xrange(size)]
+        for name, cache_class in (('deque', DequeLRUCache), ('ordered', LRUCache), ('striped', StripedLRUCache)):
+            for runner in (run, run_threads):
+                cache = cache_class(max_items, 300)
+                start = time()
+                runner(cache, ops)
+                cost = time() - start
+                logging.info(u'%-8s %-12s %8d 次操作：%.3fs，%.2fus/次',
+                             name, runner.__name__, size, cost, cost / size * 1e6)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,180 @@
+# coding:utf-8
+'''Per-IP reputation with exponential time decay, kept in SQLite'''
+
+import math
+import sqlite3
+import threading
+from time import time
+
+class ReputationStore(object):
+    '''Decayed success, failure and latency scores per IP
+
+    Every update decays the stored values to the current time, adds the
+    new outcome and writes only that row. The ranking score is computed
+    at write time and indexed, so the best IPs come out of an index scan.
+    compact() refreshes every score and drops records that have decayed
+    to nothing.
+    '''
+
+    #失败次数超出成功次数的倍数后不再作为候选，衰减后会被清理
+    max_failure_ratio = 10
+    #衰减后总权重低于此值的记录在整理时删除
+    min_weight = 0.05
+    #整理间隔，单位：秒
+    compact_interval = 3600 * 6
+
+    def __init__(self, path, halflife):
+        self.path = path
+        #衰减常数，halflife 单位：秒
+        self.decay = math.log(2) / halflife
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS reputation ('
+                          'ip TEXT PRIMARY KEY, success REAL NOT NULL, failure REAL NOT NULL, '
+                          'latency REAL NOT NULL, samples REAL NOT NULL, updated REAL NOT NULL, '
+                          'score REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS reputation_score ON reputation (score)')
+        self.conn.commit()
+        self.next_compact = time() + self.compact_interval
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM reputation').fetchone()[0]
+
+    def score(self, success, failure, latency):
+        #成功率越高、失败越少、延时越低越好
+        if failure > self.max_failure_ratio * max(success, 1):
+            return -1
+        return (success + 1.0) / (failure * failure + 0.1) / (1 + latency / 1000.0)
+
+    def _decayed(self, row, now):
+        success, failure, latency, samples, updated = row
+        factor = math.exp(-self.decay * max(now - updated, 0))
+        return success * factor, failure * factor, latency, samples * factor
+
+    def update(self, ip, success=0, failure=0, latency=None, create=True, now=None):
+        '''Add an outcome for ip, latency in milliseconds'''
+        now = now or time()
+        with self.lock:
+            row = self.conn.execute('SELECT success, failure, latency, samples, updated '
+                                    'FROM reputation WHERE ip=?', (ip,)).fetchone()
+            if row is None:
+                if not create:
+                    return
+                row = 0, 0, 0, 0, now
+            s, f, l, n = self._decayed(row, now)
+            s += success
+            f += failure
+            if latency is not None:
+                #按时间衰减的加权平均
+                l = (l * n + latency) / (n + 1)
+                n += 1
+            self.conn.execute('INSERT OR REPLACE INTO reputation VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (ip, s, f, l, n, now, self.score(s, f, l)))
+            self.conn.commit()
+        if now > self.next_compact:
+            self.compact(now)
+
+    def get(self, ip, now=None):
+        '''Return decayed (success, failure, latency) or None'''
+        with self.lock:
+            row = self.conn.execute('SELECT success, failure, latency, samples, updated '
+                                    'FROM reputation WHERE ip=?', (ip,)).fetchone()
+        if row:
+            return self._decayed(row, now or time())[:3]
+
+    def top(self, k, exclude=()):
+        '''The k best IPs, best first, skipping exclude and discarded IPs'''
+        with self.lock:
+            rows = self.conn.execute('SELECT ip FROM reputation WHERE score >= 0 '
+                                     'ORDER BY score DESC LIMIT ?', (k + len(exclude),))
+            ips = [ip for ip, in rows if ip not in exclude]
+        return ips[:k]
+
+    def compact(self, now=None):
+        '''Refresh scores to the current time and drop faded records'''
+        now = now or time()
+        with self.lock:
+            self.next_compact = now + self.compact_interval
+            rows = self.conn.execute('SELECT ip, success, failure, latency, samples, updated '
+                                     'FROM reputation').fetchall()
+            drop = []
+            refresh = []
+            for row in rows:
+                s, f, l, n = self._decayed(row[1:], now)
+                if s + f + n < self.min_weight:
+                    drop.append((row[0],))
+                else:
+                    refresh.append((s, f, n, now, self.score(s, f, l), row[0]))
+            self.conn.executemany('DELETE FROM reputation WHERE ip=?', drop)
+            self.conn.executemany('UPDATE reputation SET success=?, failure=?, samples=?, '
+                                  'updated=?, score=? WHERE ip=?', refresh)
+            self.conn.commit()
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return len(drop)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def test(count=20000, updates=2000, k=200):
+    '''Compare with rewriting a per-day statistics text file on every update'''
+    import os
+    import random
+    import shutil
+    import tempfile
+    from local import clogging as logging
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ips = ['%d.%d.%d.%d' % (random.randint(1, 254), random.randint(0, 255),
+                                random.randint(0, 255), random.randint(1, 254))
+               for _ in range(count)]
+        stats = dict((ip, (random.randint(0, 20), random.randint(0, 5))) for ip in ips)
+        statfile = os.path.join(tmpdir, 'statistics')
+        bakfile = statfile + 'bak'
+        start = time()
+        for i in range(updates):
+            ip = random.choice(ips)
+            good, bad = stats[ip]
+            stats[ip] = good + 1, bad
+            #旧的做法：备份后按排序重写整个文件
+            if os.path.exists(statfile):
+                if os.path.exists(bakfile):
+                    os.remove(bakfile)
+                os.rename(statfile, bakfile)
+            items = sorted(stats.items(), key=lambda x: -(x[1][0]+1.0)/(x[1][1]**2+0.1))
+            with open(statfile, 'w') as f:
+                for ip, (good, bad) in items:
+                    f.write('%s * %s * %s\n' % (ip.rjust(15), str(good).rjust(3), str(bad).rjust(3)))
+        old_update = (time() - start) / updates
+        start = time()
+        for i in range(updates // 10):
+            items = sorted(stats.items(), key=lambda x: (x[1][0]+1.0)/(x[1][1]**2+0.1))
+            [ip for ip, _ in items[-k:]]
+        old_top = (time() - start) / (updates // 10)
+
+        store = ReputationStore(os.path.join(tmpdir, 'reputation.db'), 3600 * 24 * 2)
+        now = time()
+        for ip, (good, bad) in stats.items():
+            store.update(ip, good, bad, random.randint(100, 800), now=now - random.randint(0, 3600 * 24 * 4))
+        start = time()
+        for i in range(updates):
+            store.update(random.choice(ips), success=1, latency=random.randint(100, 800))
+        new_update = (time() - start) / updates
+        start = time()
+        for i in range(updates // 10):
+            store.top(k)
+        new_top = (time() - start) / (updates // 10)
+        start = time()
+        store.compact()
+        compact = time() - start
+        store.close()
+        logging.info(u'%d 个 IP，文本文件：更新 %.2fms/次，前 %d 名 %.2fms/次', count, old_update * 1000, k, old_top * 1000)
+        logging.info(u'%d 个 IP，SQLite：更新 %.3fms/次，前 %d 名 %.3fms/次，整理 %.2fs', count, new_update * 1000, k, new_top * 1000, compact)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,223 @@
+# coding:utf-8
+'''Pick connection candidates by Thompson sampling over live estimates'''
+
+import math
+import random
+import heapq
+import threading
+from local.compat import monotonic, xrange
+
+class IPSelector(object):
+    '''Per address EWMA latency and decayed success/failure counts
+
+    Every connection outcome updates only its own record. A selection draws
+    one sample of success probability (Beta posterior) and latency per
+    candidate, and returns the k candidates with the lowest expected cost
+    of getting a connection, so good addresses are usually tried first
+    while uncertain ones still get their turn. Addresses never tried are
+    drawn from a small random subsample with a prior at the pool mean, so
+    hundreds of unknown addresses do not crowd out the known good ones.
+    The subsample grows when fewer than k addresses are known.
+    '''
+
+    #EWMA 平滑系数，与 TCP RTT 估计（RFC 6298）相同
+    alpha = 0.125
+    beta = 0.25
+    #每次选择时参与抽样的未知地址数量
+    explore = 2
+    #成功、失败次数的半衰期，单位：秒，失败过的地址会逐渐恢复机会
+    halflife = 600
+
+    def __init__(self, penalty, max_items=1024, default_latency=0.5):
+        #一次失败的代价，单位：秒
+        self.penalty = penalty
+        self.max_items = max_items
+        self.decay = math.log(2) / self.halflife
+        #addr -> [srtt, rttvar, success, failure, updated]
+        self.records = {}
+        #所有成功链接的平均延时，作为未知地址的先验
+        self.mean = default_latency
+        self.lock = threading.Lock()
+        self.selections = 0
+        self.explored = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def _record(self, addr, now):
+        record = self.records.get(addr)
+        if record is None:
+            if len(self.records) >= self.max_items:
+                self._evict()
+            record = self.records[addr] = [None, None, 0.0, 0.0, now]
+        else:
+            factor = math.exp(-self.decay * (now - record[4]))
+            record[2] *= factor
+            record[3] *= factor
+            record[4] = now
+        return record
+
+    def _evict(self):
+        #移除最久没有更新的四分之一
+        records = self.records
+        for addr in heapq.nsmallest(len(records) // 4 or 1, records, key=lambda addr: records[addr][4]):
+            del records[addr]
+
+    def success(self, addr, latency):
+        with self.lock:
+            record = self._record(addr, monotonic())
+            if record[0] is None:
+                record[0] = latency
+                record[1] = latency / 2
+            else:
+                record[1] += self.beta * (abs(latency - record[0]) - record[1])
+                record[0] += self.alpha * (latency - record[0])
+            record[2] += 1
+            self.mean += self.alpha * (latency - self.mean)
+
+    def failure(self, addr):
+        with self.lock:
+            self._record(addr, monotonic())[3] += 1
+
+    def cancelled(self, addr, cost):
+        '''A cancelled attempt lasted at least cost, only raise the latency'''
+        with self.lock:
+            record = self._record(addr, monotonic())
+            if record[0] is None:
+                record[0] = cost
+                record[1] = cost / 2
+            elif record[0] < cost:
+                record[0] += self.alpha * (cost - record[0])
+
+    def latency(self, addr):
+        '''EWMA latency, False if unknown'''
+        record = self.records.get(addr)
+        return record and record[0] or False
+
+    def _sample(self, record, now):
+        srtt, rttvar, success, failure, updated = record
+        factor = math.exp(-self.decay * (now - updated))
+        success *= factor
+        failure *= factor
+        if srtt is None:
+            srtt = self.mean
+            rttvar = self.mean / 2
+        p = max(random.betavariate(success + 1, failure + 1), 1e-3)
+        latency = max(random.gauss(srtt, rttvar / math.sqrt(success + 1)), 0)
+        return latency + (1 - p) / p * self.penalty
+
+    def select(self, addrs, k):
+        '''Return up to k of addrs, the one to try first comes first'''
+        if len(addrs) <= 1:
+            return list(addrs)
+        now = monotonic()
+        records = self.records
+        known = []
+        unknown = []
+        with self.lock:
+            for addr in addrs:
+                record = records.get(addr)
+                if record is None or record[2] + record[3] == 0:
+                    unknown.append(addr)
+                else:
+                    known.append((self._sample(record, now), addr))
+            #已知地址不足 k 个时用更多未知地址补足，保持选择的数量
+            explore = max(self.explore, k - len(known))
+            if len(unknown) > explore:
+                unknown = random.sample(unknown, explore)
+            prior = [None, None, 0.0, 0.0, now]
+            for addr in unknown:
+                known.append((self._sample(records.get(addr, prior), now), addr))
+            addrs = [addr for _, addr in heapq.nsmallest(k, known)]
+            self.selections += 1
+            self.explored += sum(1 for addr in addrs if addr in unknown)
+        return addrs
+
+    def status(self):
+        with self.lock:
+            return u'IP 选择：已知 %d，平均延时 %dms，选择 %d 次，试探未知 %d 个' % (
+                   len(self.records), self.mean * 1000, self.selections, self.explored)
+
+def test(count=300, calls=5000, window=4):
+    '''Simulate staggered connection races against the old last-sample sort'''
+    from local import clogging as logging
+    from time import time
+
+    random.seed(1)
+    penalty = 2.5
+    truth = {}
+    for i in xrange(count):
+        addr = ('10.0.%d.%d' % (i // 256, i % 256), 443)
+        #约 15% 的地址经常失败
+        p = random.uniform(0.1, 0.4) if random.random() < 0.15 else random.uniform(0.9, 1.0)
+        truth[addr] = p, random.lognormvariate(math.log(0.3), 0.6)
+    addrs = list(truth)
+
+    def attempt_delay(latency):
+        return 0.25 if not latency else max(0.1, min(latency * 1.25, 1.0))
+
+    def race(order, get_latency, on_success, on_failure, on_cancelled):
+        #与 ConnectionRacer 相同：前一个失败或超过尝试延时后发起下一个
+        pending = list(order)
+        running = []
+        now = 0
+        while pending or running:
+            next_start = float('inf')
+            if pending:
+                addr = pending.pop(0)
+                p, latency = truth[addr]
+                if random.random() < p:
+                    running.append((now + latency * random.uniform(0.8, 1.5), now, addr, True))
+                else:
+                    running.append((now + random.uniform(1, penalty), now, addr, False))
+                if pending:
+                    next_start = now + attempt_delay(get_latency(addr))
+            running.sort()
+            while running and running[0][0] <= next_start:
+                finish, start, addr, ok = running.pop(0)
+                if ok:
+                    on_success(addr, finish - start)
+                    for _, other_start, other, _ in running:
+                        on_cancelled(other, finish - other_start)
+                    return finish
+                on_failure(addr)
+                if pending:
+                    next_start = finish
+                    break
+            now = next_start
+        return None
+
+    def run(name, pick, get_latency, on_success, on_failure, on_cancelled):
+        total = 0
+        failed = 0
+        cost = 0
+        for i in xrange(calls):
+            start = time()
+            order = pick()
+            cost += time() - start
+            result = race(order, get_latency, on_success, on_failure, on_cancelled)
+            if result is None:
+                failed += 1
+            elif i >= calls // 5:
+                total += result
+        logging.info(u'%s：平均链接 %dms，整轮失败 %d/%d，选择 %.3fms/次', name,
+                     total * 1000 / (calls - calls // 5), failed, calls, cost * 1000 / calls)
+
+    last = {}
+    def old_pick():
+        addresses = sorted(addrs, key=lambda addr: last.get(addr, False))
+        w = (window + 1) // 2
+        return addresses[:w] + random.sample(addresses[w:], window - w)
+    def old_cancelled(addr, cost):
+        if last.get(addr, 0) < cost:
+            last[addr] = cost
+    run(u'按上次时间排序', old_pick, lambda addr: last.get(addr, False),
+        last.__setitem__, lambda addr: last.__setitem__(addr, 8 + random.random()), old_cancelled)
+
+    selector = IPSelector(penalty)
+    run(u'Thompson 抽样', lambda: selector.select(addrs, window), selector.latency,
+        selector.success, selector.failure, selector.cancelled)
+    logging.info(selector.status())
+
+if __name__ == '__main__':
+    test()
@@ -18,6 +18,7 @@ if PY3:
     from configparser import ConfigParser
     xrange = range
     exc_clear = lambda: None
+    from time import monotonic
     #可添加属性
     class socketMod(socket.socket): pass
     socket.socket = socketMod
@@ -35,3 +36,5 @@ else:
     from ConfigParser import ConfigParser
     xrange = xrange
     exc_clear = sys.exc_clear
+    #没有单调时钟
+    from time import time as monotonic
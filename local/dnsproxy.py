@@ -20,9 +20,11 @@ import time
 from . import clogging as logging
 import heapq
 import socket
-import select
+import random
 import struct
 import dnslib
+from .compat import xrange
+from .common.dns import upstream_rtt, query_stream, from_stream, race_delay, get_tcp_fallback
 try:
     import pygeoip
 except ImportError:
@@ -42,75 +44,124 @@ def win32dns_query_dnsserver_list():
     return out
 
 
+class CacheEntry(object):
+    """A cached reply, kept packed as received"""
+    __slots__ = ('data', 'ttl', 'expire', 'generation', 'hits')
+
+    def __init__(self, data, ttl, expire, generation):
+        self.data = data
+        self.ttl = ttl
+        self.expire = expire
+        self.generation = generation
+        self.hits = 0
+
+
 class ExpireCache(object):
     """ A dictionary-like object, supporting expire semantics."""
+
+    #写入时批量清理过期条目的间隔
+    cleanup_interval = 1
+
     def __init__(self, max_size=1024):
         self.__maxsize = max_size
-        self.__values = {}
-        self.__expire_times = {}
+        self.__entries = {}
+        #(过期时间, 代数, 键)，更新或删除后旧记录留在堆中，出堆时按代数跳过
         self.__expire_heap = []
+        self.__generation = 0
+        self.__next_cleanup = 0
 
     def size(self):
-        return len(self.__values)
+        return len(self.__entries)
 
     def clear(self):
-        self.__values.clear()
-        self.__expire_times.clear()
+        self.__entries.clear()
         del self.__expire_heap[:]
 
     def exists(self, key):
-        return key in self.__values
+        return key in self.__entries
 
     def set(self, key, value, expire):
-        try:
-            et = self.__expire_times[key]
-            pos = self.__expire_heap.index((et, key))
-            del self.__expire_heap[pos]
-            if pos < len(self.__expire_heap):
-                heapq._siftup(self.__expire_heap, pos)
-        except KeyError:
-            pass
-        et = int(time.time() + expire)
-        self.__expire_times[key] = et
-        heapq.heappush(self.__expire_heap, (et, key))
-        self.__values[key] = value
-        self.cleanup()
+        self.__generation += 1
+        now = time.time()
+        entry = CacheEntry(value, expire, now + expire, self.__generation)
+        self.__entries[key] = entry
+        heapq.heappush(self.__expire_heap, (entry.expire, entry.generation, key))
+        if now > self.__next_cleanup or len(self.__entries) > self.__maxsize:
+            self.cleanup(now)
+        elif len(self.__expire_heap) > 2 * len(self.__entries) + 1024:
+            self.compact()
 
-    def get(self, key):
-        et = self.__expire_times[key]
-        if et < time.time():
-            self.cleanup()
+    def get_entry(self, key):
+        entry = self.__entries[key]
+        if entry.expire < time.time():
+            del self.__entries[key]
             raise KeyError(key)
-        return self.__values[key]
+        return entry
+
+    def get(self, key):
+        return self.get_entry(key).data
 
     def delete(self, key):
-        et = self.__expire_times.pop(key)
-        pos = self.__expire_heap.index((et, key))
-        del self.__expire_heap[pos]
-        if pos < len(self.__expire_heap):
-            heapq._siftup(self.__expire_heap, pos)
-        del self.__values[key]
-
-    def cleanup(self):
-        t = int(time.time())
+        del self.__entries[key]
+
+    def compact(self):
+        #丢弃堆中失效的旧记录
+        self.__expire_heap = [(entry.expire, entry.generation, key) for key, entry in self.__entries.items()]
+        heapq.heapify(self.__expire_heap)
+
+    def cleanup(self, now=None):
+        now = now or time.time()
         eh = self.__expire_heap
-        ets = self.__expire_times
-        v = self.__values
+        entries = self.__entries
         size = self.__maxsize
         heappop = heapq.heappop
-        #Delete expired, ticky
-        while eh and eh[0][0] <= t or len(v) > size:
-            _, key = heappop(eh)
-            del v[key], ets[key]
+        #删除过期条目，超出容量时删除最早过期的条目
+        while eh and (eh[0][0] <= now or len(entries) > size):
+            _, generation, key = heappop(eh)
+            entry = entries.get(key)
+            if entry and entry.generation == generation:
+                del entries[key]
+        self.__next_cleanup = now + self.cleanup_interval
+
+
+class PendingQuery(object):
+    """An upstream query shared by every client asking the same question"""
+    __slots__ = ('key', 'txid', 'data', 'servers', 'upstreams', 'need_reply_servers', 'waiters', 'deadline', 'next_send', 'rounds', 'sent')
+
+    def __init__(self, key, txid, data, servers, upstreams, timeout):
+        self.key = key
+        self.txid = txid
+        self.data = struct.pack('!H', txid) + data[2:]
+        self.servers = servers
+        self.upstreams = upstreams
+        self.need_reply_servers = set(servers)
+        #等待回复的客户端，(原始事务 ID, 地址)
+        self.waiters = []
+        self.deadline = time.time() + timeout
+        self.next_send = 0
+        self.rounds = 0
+        self.sent = {}
 
 
 class DNSServer(gevent.server.DatagramServer):
     """DNS Proxy based on gevent/dnslib"""
 
+    #没有回复时重新发送的间隔
+    resend_interval = 1
+    #剩余有效期少于这个比例时，再次命中就预取
+    prefetch_ratio = 0.1
+    #命中几次才算热门域名
+    prefetch_hits = 2
+    #第一轮只向最快的几个服务器发送
+    first_round_servers = 2
+
     def __init__(self, *args, **kwargs):
         dns_blacklist = kwargs.pop('dns_blacklist')
         dns_servers = kwargs.pop('dns_servers')
         dns_timeout = kwargs.pop('dns_timeout', 2)
+        dns_port = kwargs.pop('dns_port', 53)
+        #优先使用的 TCP/TLS 上游，UDP 作为竞速备用
+        self.dns_stream_upstreams = kwargs.pop('dns_stream_upstreams', ())
         super(self.__class__, self).__init__(*args, **kwargs)
         self.dns_servers = dns_servers
         self.dns_v4_servers = [x for x in self.dns_servers if ':' not in x]
@@ -118,8 +169,15 @@ class DNSServer(gevent.server.DatagramServer):
         self.dns_intranet_servers = set([x for x in self.dns_servers if x.startswith(('10.', '172.', '192.168.'))])
         self.dns_blacklist = set(dns_blacklist)
         self.dns_timeout = int(dns_timeout)
+        self.dns_port = dns_port
         self.dns_cache = ExpireCache(max_size=65536)
         self.dns_trust_servers = set(['8.8.8.8', '8.8.4.4'])
+        #每个上游服务器一个长期使用的套接字，按事务 ID 分发回复
+        self.upstream_socks = {}
+        self.pending = {}
+        #合并相同 (qname, qtype) 的并发查询
+        self.inflight = {}
+        self.queries = self.cache_hits = self.coalesced = self.upstream_queries = self.prefetches = 0
         if pygeoip:
             for dirname in ('.', '/usr/share/GeoIP/', '/usr/local/share/GeoIP/'):
                 filename = os.path.join(dirname, 'GeoIP.dat')
@@ -130,79 +188,184 @@ class DNSServer(gevent.server.DatagramServer):
                             self.dns_trust_servers.add(dnsserver)
                     break
 
+    def start(self):
+        super(self.__class__, self).start()
+        for dnsserver in self.dns_servers:
+            sock = socket.socket(socket.AF_INET6 if ':' in dnsserver else socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.connect((dnsserver, self.dns_port))
+            except socket.error as e:
+                logging.warning('connect dns server %r failed: %r', dnsserver, e)
+                sock.close()
+                continue
+            self.upstream_socks[dnsserver] = sock
+            gevent.spawn(self.read_upstream, sock, dnsserver)
+        gevent.spawn(self.check_pending)
+
+    def status(self):
+        return u'DNS 代理：查询 %d，缓存命中 %d，合并 %d，上游查询 %d，预取 %d，缓存 %d 项' % (
+               self.queries, self.cache_hits, self.coalesced, self.upstream_queries, self.prefetches, self.dns_cache.size())
+
+    def send_upstream(self, query):
+        now = time.time()
+        query.next_send = now + self.resend_interval
+        servers = upstream_rtt.sort(query.need_reply_servers)
+        if query.rounds == 0:
+            servers = servers[:self.first_round_servers]
+        query.rounds += 1
+        for dnsserver in servers:
+            sock = self.upstream_socks.get(dnsserver)
+            if sock:
+                try:
+                    sock.send(query.data)
+                    query.sent.setdefault(dnsserver, now)
+                except socket.error as e:
+                    logging.debug('send to dns server %r failed: %r', dnsserver, e)
+
+    def query_upstream(self, key, data, servers, waiter=None):
+        query = self.inflight.get(key)
+        if query:
+            self.coalesced += 1
+            if waiter:
+                query.waiters.append(waiter)
+            return query
+        txid = random.randint(0, 0xffff)
+        while txid in self.pending:
+            txid = random.randint(0, 0xffff)
+        #TCP/TLS 上游代替的是默认服务器，内网域名等只用 UDP 查询
+        upstreams = self.dns_stream_upstreams if servers == tuple(self.dns_servers) else ()
+        query = PendingQuery(key, txid, data, servers, upstreams, self.dns_timeout * 2)
+        self.pending[txid] = query
+        self.inflight[key] = query
+        self.upstream_queries += 1
+        #发送前登记，发送时让出也不会错过回复
+        if waiter:
+            query.waiters.append(waiter)
+        name = query_stream(query.data, self.handle_stream_reply, query.upstreams)
+        if name:
+            query.next_send = time.time() + race_delay(name)
+        else:
+            self.send_upstream(query)
+        return query
+
+    def finish(self, query):
+        self.pending.pop(query.txid, None)
+        if self.inflight.get(query.key) is query:
+            del self.inflight[query.key]
+
+    def check_pending(self):
+        while True:
+            gevent.sleep(0.2)
+            now = time.time()
+            for query in list(self.pending.values()):
+                if now > query.deadline:
+                    logging.warning('query qname=%r qtype=%r timed out, need_reply_servers=%s', query.key[0], query.key[1], query.need_reply_servers)
+                    self.finish(query)
+                elif now > query.next_send:
+                    self.send_upstream(query)
+
+    def read_upstream(self, sock, reply_server):
+        while True:
+            try:
+                reply_data = sock.recv(65536)
+            except socket.error as e:
+                #ICMP 端口不可达等
+                logging.debug('receive from dns server %r failed: %r', reply_server, e)
+                gevent.sleep(0.1)
+                continue
+            try:
+                self.handle_reply(reply_data, reply_server)
+            except Exception as e:
+                logging.warning('handle reply from dns server %r failed: %r', reply_server, e)
+
+    def handle_stream_reply(self, reply_data, name):
+        try:
+            self.handle_reply(reply_data, name, True)
+        except Exception as e:
+            logging.warning('handle reply from dns server %r failed: %r', name, e)
+
+    def handle_reply(self, reply_data, reply_server, stream=False):
+        txid, = struct.unpack('!H', reply_data[:2])
+        query = self.pending.get(txid)
+        if query is None:
+            return
+        #TCP/TLS 回复须来自这次查询使用的上游
+        expected = from_stream(reply_server, query.upstreams, query.servers) if stream else reply_server in query.need_reply_servers
+        if not expected:
+            return
+        reply = dnslib.DNSRecord.parse(reply_data)
+        qname, qtype = query.key
+        if not reply.questions or str(reply.q.qname) != qname or reply.q.qtype != qtype:
+            return
+        if reply.header.tc:
+            #回复被截断，改用 TCP 向同一服务器查询
+            if not stream:
+                gevent.spawn(get_tcp_fallback(reply_server).query, query.data, self.handle_stream_reply, True)
+            return
+        if reply_server in query.sent:
+            upstream_rtt.update(reply_server, time.time() - query.sent[reply_server])
+        iplist = [str(x.rdata) for x in reply.rr]
+        if any(x in self.dns_blacklist for x in iplist):
+            logging.warning('query qname=%r reply bad iplist=%r, continue', qname, iplist)
+            return
+        if reply.header.rcode and not iplist and not stream and reply_server not in self.dns_trust_servers:
+            query.need_reply_servers.discard(reply_server)
+            if query.need_reply_servers:
+                logging.warning('query qname=%r qtype=%r reply nonzero rcode=%r, wait other need_reply_servers=%s, continue', qname, qtype, reply.header.rcode, query.need_reply_servers)
+                return
+            else:
+                logging.info('query qname=%r qtype=%r reply nonzero rcode=%r', qname, qtype, reply.header.rcode)
+        self.finish(query)
+        ttl = min(x.ttl for x in reply.rr) if reply.rr else 600
+        logging.debug('query qname=%r qtype=%r reply_server=%r reply iplist=%s, ttl=%r', qname, qtype, reply_server, iplist, ttl)
+        if iplist or qname.endswith('.in-addr.arpa'):
+            self.dns_cache.set(query.key, reply_data, ttl)
+        for request_id, address in query.waiters:
+            self.sendto(request_id + reply_data[2:], address)
+
+    def prefetch(self, key, entry):
+        #热门域名在过期前重新查询，回复后更新缓存
+        entry.hits += 1
+        if entry.hits < self.prefetch_hits or key in self.inflight:
+            return
+        if entry.expire - time.time() < max(entry.ttl * self.prefetch_ratio, 1):
+            self.prefetches += 1
+            entry.hits = 0
+            data = dnslib.DNSRecord(q=dnslib.DNSQuestion(key[0], key[1])).pack()
+            self.query_upstream(key, data, self.get_servers(key[0]))
+
+    def get_servers(self, qname):
+        is_local_hostname = '.' not in qname.rstrip('.')
+        if 'USERDNSDOMAIN' in os.environ:
+            is_local_hostname = qname.lower().rstrip('.').endswith('.' + os.environ['USERDNSDOMAIN'].lower())
+        if is_local_hostname:
+            return tuple(x for x in self.dns_servers if x in self.dns_intranet_servers)
+        return tuple(self.dns_servers)
+
     def handle(self, data, address):
         logging.debug('receive from %r data=%r', address, data)
         request = dnslib.DNSRecord.parse(data)
         qname = str(request.q.qname)
         qtype = request.q.qtype
+        key = qname, qtype
+        self.queries += 1
         try:
-            reply_data = self.dns_cache.get((qname, qtype))
+            entry = self.dns_cache.get_entry(key)
         except KeyError:
-            reply_data = ''
-        sock_v4 = sock_v6 = None
-        socks = []
-        is_local_hostname = '.' not in qname
-        if 'USERDNSDOMAIN' in os.environ:
-            is_local_hostname = qname.lower().endswith('.' + os.environ['USERDNSDOMAIN'].lower())
-        if is_local_hostname and not self.dns_intranet_servers:
+            pass
+        else:
+            self.cache_hits += 1
+            self.sendto(data[:2] + entry.data[2:], address)
+            self.prefetch(key, entry)
+            return
+        servers = self.get_servers(qname)
+        if not servers:
             logging.warning('qname=%r is a plain hostname, need intranet dns server!!!', qname)
             reply = dnslib.DNSRecord(header=dnslib.DNSHeader(id=request.header.id, rcode=3))
             self.sendto(reply.pack(), address)
             return
-        dns_v4_servers = self.dns_v4_servers if not is_local_hostname else [x for x in self.dns_intranet_servers if ':' not in x]
-        dns_v6_servers = self.dns_v6_servers if not is_local_hostname else [x for x in self.dns_intranet_servers if ':' in x]
-        if dns_v4_servers:
-            sock_v4 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            socks.append(sock_v4)
-        if dns_v6_servers:
-            sock_v6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-            socks.append(sock_v6)
-        for _ in xrange(2):
-            if reply_data:
-                break
-            try:
-                need_reply_servers = set()
-                for dnsserver in dns_v4_servers:
-                    sock_v4.sendto(data, (dnsserver, 53))
-                    need_reply_servers.add(dnsserver)
-                for dnsserver in dns_v6_servers:
-                    sock_v6.sendto(data, (dnsserver, 53))
-                    need_reply_servers.add(dnsserver)
-                timeout_at = time.time() + self.dns_timeout
-                while time.time() < timeout_at:
-                    if reply_data:
-                        break
-                    ins, _, _ = select.select(socks, [], [], 0.1)
-                    for sock in ins:
-                        reply_data, (reply_server, _) = sock.recvfrom(512)
-                        reply = dnslib.DNSRecord.parse(reply_data)
-                        iplist = [str(x.rdata) for x in reply.rr]
-                        if any(x in self.dns_blacklist for x in iplist):
-                            logging.warning('query qname=%r reply bad iplist=%r, continue', qname, iplist)
-                            reply_data = ''
-                            continue
-                        if reply.header.rcode and not iplist and need_reply_servers and reply_server not in self.dns_trust_servers:
-                            try:
-                                need_reply_servers.remove(reply_server)
-                            except KeyError:
-                                pass
-                            if need_reply_servers:
-                                logging.warning('query qname=%r qtype=%r reply nonzero rcode=%r, wait other need_reply_servers=%s, continue', qname, qtype, reply.header.rcode, need_reply_servers)
-                                reply_data = ''
-                                continue
-                            else:
-                                logging.info('query qname=%r qtype=%r reply nonzero rcode=%r', qname, qtype, reply.header.rcode)
-                        ttl = max(x.ttl for x in reply.rr) if reply.rr else 600
-                        logging.debug('query qname=%r qtype=%r reply_server=%r reply iplist=%s, ttl=%r', qname, qtype, reply_server, iplist, ttl)
-                        if iplist or qname.endswith('.in-addr.arpa'):
-                            self.dns_cache.set((qname, qtype), reply_data, ttl*2)
-                        break
-            except socket.error as e:
-                logging.warning('handle dns data=%r socket: %r', data, e)
-        for sock in socks:
-            sock.close()
-        if reply_data:
-            return self.sendto(data[:2] + reply_data[2:], address)
+        #不等待回复，由 read_upstream 转发给所有等待的客户端
+        self.query_upstream(key, data, servers, (data[:2], address))
 
 
 def test():
@@ -214,5 +377,137 @@ def test():
     DNSServer(('', 53), dns_servers=dns_servers, dns_blacklist=dns_blacklist).serve_forever()
 
 
+def benchmark(clients=200, queries=50000, names=2000, upstream_delay=0.02, ttl=3):
+    """Measure queries per second and latency against a local stub upstream"""
+    logging.setLevel(logging.WARNING)
+    upstream_queries = [0]
+
+    class StubUpstream(gevent.server.DatagramServer):
+        def handle(self, data, address):
+            upstream_queries[0] += 1
+            request = dnslib.DNSRecord.parse(data)
+            reply = request.reply()
+            reply.add_answer(dnslib.RR(request.q.qname, dnslib.QTYPE.A, rdata=dnslib.A('10.0.0.1'), ttl=ttl))
+            gevent.sleep(upstream_delay)
+            self.sendto(reply.pack(), address)
+
+    upstream = StubUpstream(('127.0.0.1', 0))
+    upstream.start()
+    server = DNSServer(('127.0.0.1', 0), dns_servers=['127.0.0.1'], dns_blacklist=[], dns_port=upstream.address[1])
+    server.start()
+    #少数热门域名占大部分查询
+    pool = ['host%d.example.com' % int(names ** random.random()) for _ in xrange(queries)]
+    latencies = []
+
+    def client(n):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        for i in xrange(n, queries, clients):
+            data = dnslib.DNSRecord.question(pool[i]).pack()
+            start = time.time()
+            sock.sendto(data, server.address)
+            try:
+                sock.recv(512)
+            except socket.timeout:
+                continue
+            latencies.append(time.time() - start)
+        sock.close()
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(client, n) for n in xrange(clients)])
+    elapsed = time.time() - start
+    latencies.sort()
+    logging.warning('%d 个客户端，%d 次查询，回复 %d，%.0f 次/秒，p50 %.1fms，p99 %.1fms，上游收到 %d 次',
+                    clients, queries, len(latencies), len(latencies) / elapsed,
+                    latencies[len(latencies)//2] * 1000, latencies[int(len(latencies)*0.99)] * 1000, upstream_queries[0])
+    logging.warning(server.status())
+    server.stop()
+    upstream.stop()
+
+
+def benchmark_cache(size=65536, rounds=3):
+    """Compare ExpireCache with the version that searched the heap list"""
+    logging.setLevel(logging.WARNING)
+
+    class ListHeapExpireCache(object):
+        #旧的实现，更新已有键要 O(n) 的 list.index，每次写入都完整清理
+        def __init__(self, max_size=1024):
+            self.maxsize = max_size
+            self.values = {}
+            self.expire_times = {}
+            self.expire_heap = []
+
+        def set(self, key, value, expire):
+            try:
+                et = self.expire_times[key]
+                pos = self.expire_heap.index((et, key))
+                del self.expire_heap[pos]
+                if pos < len(self.expire_heap):
+                    heapq._siftup(self.expire_heap, pos)
+            except KeyError:
+                pass
+            et = int(time.time() + expire)
+            self.expire_times[key] = et
+            heapq.heappush(self.expire_heap, (et, key))
+            self.values[key] = value
+            self.cleanup()
+
+        def get(self, key):
+            et = self.expire_times[key]
+            if et < time.time():
+                self.cleanup()
+                raise KeyError(key)
+            return self.values[key]
+
+        def cleanup(self):
+            t = int(time.time())
+            eh = self.expire_heap
+            ets = self.expire_times
+            v = self.values
+            while eh and eh[0][0] <= t or len(v) > self.maxsize:
+                _, key = heapq.heappop(eh)
+                del v[key], ets[key]
+
+    reply = dnslib.DNSRecord.question('www.example.com').reply().pack()
+    keys = [('host%d.example.com.' % i, 1) for i in xrange(size)]
+    for cache_class in (ListHeapExpireCache, ExpireCache):
+        cache = cache_class(max_size=size)
+        start = time.time()
+        for key in keys:
+            cache.set(key, reply, 600 + random.randint(0, 600))
+        insert = size / (time.time() - start)
+        #旧实现更新太慢，只取一部分
+        update_keys = random.sample(keys, size if cache_class is ExpireCache else 2000)
+        start = time.time()
+        for key in update_keys:
+            cache.set(key, reply, 600 + random.randint(0, 600))
+        update = len(update_keys) / (time.time() - start)
+        start = time.time()
+        for _ in xrange(rounds):
+            for key in keys:
+                cache.get(key)
+        get = size * rounds / (time.time() - start)
+        #全部过期后清理
+        start = time.time()
+        now = time.time() + 1300
+        if cache_class is ExpireCache:
+            cache.cleanup(now)
+        else:
+            time_time = time.time
+            time.time = lambda: now
+            try:
+                cache.cleanup()
+            finally:
+                time.time = time_time
+        cleanup = size / (time.time() - start)
+        logging.warning('%s %d 项：插入 %.0f/s，更新 %.0f/s，读取 %.0f/s，清理 %.0f/s',
+                        cache_class.__name__, size, insert, update, get, cleanup)
+
+
 if __name__ == '__main__':
-    test()
+    if 'benchmark_cache' in sys.argv:
+        benchmark_cache()
+    elif 'benchmark' in sys.argv:
+        benchmark()
+    else:
+        test()
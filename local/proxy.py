@@ -260,8 +260,9 @@ def main():
         try:
             sys.path += ['.']
             from .dnsproxy import DNSServer
+            from .common.dns import stream_upstreams
             host, port = GC.DNS_LISTEN.split(':')
-            server = DNSServer((host, int(port)), dns_servers=GC.DNS_SERVERS, dns_blacklist=GC.DNS_BLACKLIST)
+            server = DNSServer((host, int(port)), dns_servers=GC.DNS_SERVERS, dns_blacklist=GC.DNS_BLACKLIST, dns_stream_upstreams=stream_upstreams)
             thread.start_new_thread(server.serve_forever, ())
         except ImportError:
             logging.exception('GotoX DNSServer requires dnslib and gevent 1.0')